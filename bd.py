@@ -1,23 +1,182 @@
+import io
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from itertools import chain
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
-from typing import Dict
+from typing import Dict, Iterator
+import esquema
+from cache_regiones import cache_regiones, CACHE_REGIONES_ACTIVO
+
+
+# Cargar variables de entorno
+#################################
+
+load_dotenv(dotenv_path="_mientorno.env")
+CONFIG_BD = {
+    'host': os.getenv("PG_HOST", "localhost"),
+    'database': os.getenv("PG_DATABASE", "postgres"),
+    'user': os.getenv("PG_USER", "postgres"),
+    'password': os.getenv("PG_PASSWORD", "postgres"),
+    'port': int(os.getenv("PG_PORT", "5432")),
+}
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_POOL_ESPERA_MAX = float(os.getenv("PG_POOL_ESPERA_MAX", "30"))
+# Una conexión ociosa más de estos segundos se verifica con SELECT 1 antes de entregarla
+PG_POOL_VERIFICAR_S = float(os.getenv("PG_POOL_VERIFICAR_S", "60"))
 
 
 # ==================== CONEXIÓN A BASE DE DATOS ====================
 
+class PoolConexiones:
+    """
+    Pool de conexiones compartido y seguro entre hilos (sesiones de chat, ingesta, referencias).
+
+    - Las conexiones se piden con `with pool.conexion() as conn:` y se devuelven siempre,
+      con rollback de cualquier transacción abierta.
+    - Si todas están en uso, se espera hasta PG_POOL_ESPERA_MAX segundos en lugar de fallar.
+    - Las conexiones cerradas o que no responden se reemplazan al entregarlas.
+    - Contadores de uso en metricas().
+    """
+
+    def __init__(self, minimo: int = PG_POOL_MIN, maximo: int = PG_POOL_MAX, **config):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.config = config or CONFIG_BD
+        self._pool = None
+        self._candado = threading.Lock()
+        self._cupos = threading.BoundedSemaphore(maximo)
+        self._ultimo_uso = {}
+
+        self.entregadas = 0
+        self.en_uso = 0
+        self.reconexiones = 0
+        self.errores = 0
+        self.agotado = 0
+        self._espera_total = 0.0
+
+    def _obtener_pool(self) -> ThreadedConnectionPool:
+        with self._candado:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(self.minimo, self.maximo, **self.config)
+                conn = self._pool.getconn()
+                try:
+                    esquema.asegurar_esquema(conn)
+                finally:
+                    self._pool.putconn(conn)
+            return self._pool
+
+    def _saludable(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.time() - self._ultimo_uso.get(id(conn), 0) < PG_POOL_VERIFICAR_S:
+            return True
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def tomar(self, cursor_factory=None):
+        """Saca una conexión del pool (esperando si está agotado). Devolver con devolver()."""
+        inicio = time.time()
+        if not self._cupos.acquire(timeout=PG_POOL_ESPERA_MAX):
+            with self._candado:
+                self.agotado += 1
+            raise PoolError(f"Pool de PostgreSQL agotado ({self.maximo} conexiones en uso)")
+        try:
+            pool = self._obtener_pool()
+            conn = pool.getconn()
+            if not self._saludable(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+                with self._candado:
+                    self.reconexiones += 1
+        except Exception:
+            self._cupos.release()
+            with self._candado:
+                self.errores += 1
+            raise
+        conn.cursor_factory = cursor_factory
+        with self._candado:
+            self.entregadas += 1
+            self.en_uso += 1
+            self._espera_total += time.time() - inicio
+        return conn
+
+    def devolver(self, conn):
+        """Devuelve la conexión al pool descartando cualquier transacción pendiente."""
+        cerrar = bool(conn.closed)
+        if not cerrar:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.cursor_factory = None
+            except psycopg2.Error:
+                cerrar = True
+        self._ultimo_uso[id(conn)] = time.time()
+        try:
+            self._obtener_pool().putconn(conn, close=cerrar)
+        finally:
+            with self._candado:
+                self.en_uso -= 1
+            self._cupos.release()
+
+    @contextmanager
+    def conexion(self, cursor_factory=RealDictCursor):
+        """Conexión del pool como context manager (filas como dict por defecto, como conexion_bd)."""
+        conn = self.tomar(cursor_factory)
+        try:
+            yield conn
+        except Exception:
+            with self._candado:
+                self.errores += 1
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.devolver(conn)
+
+    def metricas(self) -> dict:
+        with self._candado:
+            return {
+                "maximo": self.maximo,
+                "en_uso": self.en_uso,
+                "entregadas": self.entregadas,
+                "reconexiones": self.reconexiones,
+                "errores": self.errores,
+                "agotado": self.agotado,
+                "espera_promedio_ms": round(self._espera_total / self.entregadas * 1000, 2) if self.entregadas else None,
+            }
+
+    def cerrar(self):
+        with self._candado:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+pool = PoolConexiones()
+conexion = pool.conexion
+
+
 def conexion_bd():
-    """Conexión a la base de datos (ajusta según tu configuración)"""
+    """Conexión directa (fuera del pool) para scripts; en la aplicación usar bd.conexion()"""
     try:
 
-        conn = psycopg2.connect(
-            host='localhost',
-            database='postgres',
-            user='postgres',
-            password='postgres',
-            port=5432,
-            cursor_factory=RealDictCursor
-        )
+        conn = psycopg2.connect(cursor_factory=RealDictCursor, **CONFIG_BD)
+        esquema.asegurar_esquema(conn)
         return conn
     except Exception as e:
         print(f"Error de conexión: {e}")
@@ -34,88 +193,541 @@ def normalizar_texto(texto) -> str:
     texto = texto.title() if texto else None
     return texto
 
-def obtener_datos_celda(_conn, pais, departamento, ciudad: str = None, limit: int = 5000) -> pd.DataFrame:
-    """Obtiene los datos de las celdas"""
+# Columnas del DataFrame de obtener_datos_celda (una fila por celda y mes)
+COLUMNAS_DATOS_CELDA = [
+    'id_celda', 'pais_region', 'departamento_region', 'ciudad_region', 'geometry', 'lat', 'lon',
+    'area_m2', 'fecha', 'temp_promedio', 'precipitacion_promedio', 'humedad_promedio',
+    'elevacion_promedio', 'viento_promedio', 'puntuacion_calidad_datos'
+]
+
+# Una fila por celda con su serie mensual en arreglos: la geometría viaja una sola vez por celda
+# y el clima se lee por el índice (id_celda, fecha) de clima_mensual
+CONSULTA_DATOS_CELDA = """
+    SELECT
+        c.id_celda,
+        c.pais_region,
+        c.departamento_region,
+        c.ciudad_region,
+        ST_AsGeoJSON(c.geometria),
+        c.lat,
+        c.lon,
+        c.area_m2,
+        c.elevacion_promedio,
+        c.puntuacion_calidad_datos,
+        m.fechas,
+        m.temp_promedio,
+        m.precipitacion_promedio,
+        m.humedad_promedio,
+        m.viento_promedio
+    FROM celdas c
+    JOIN LATERAL (
+        SELECT
+            array_agg(fecha ORDER BY fecha) AS fechas,
+            array_agg(temp_promedio ORDER BY fecha) AS temp_promedio,
+            array_agg(precipitacion_promedio ORDER BY fecha) AS precipitacion_promedio,
+            array_agg(humedad_promedio ORDER BY fecha) AS humedad_promedio,
+            array_agg(viento_promedio ORDER BY fecha) AS viento_promedio
+        FROM clima_mensual
+        WHERE id_celda = c.id_celda
+    ) m ON m.fechas IS NOT NULL
+"""
+
+
+def _bloque_datos_celda(filas: list) -> pd.DataFrame:
+    """Convierte un bloque de filas (tuplas, una por celda) en columnas NumPy tipadas, una fila por mes."""
+    columnas = list(zip(*filas))
+    meses = np.fromiter((len(fechas) for fechas in columnas[10]), dtype=np.int64, count=len(filas))
+
+    def por_celda(indice, dtype):
+        return np.repeat(np.asarray(columnas[indice], dtype=dtype), meses)
+
+    def por_mes(indice, dtype):
+        return np.asarray(list(chain.from_iterable(columnas[indice])), dtype=dtype)
+
+    # Se conserva el redondeo a 2 decimales de la consulta anterior
+    datos = {
+        'id_celda': por_celda(0, np.int64),
+        'pais_region': pd.Categorical(por_celda(1, object)),
+        'departamento_region': pd.Categorical(por_celda(2, object)),
+        'ciudad_region': pd.Categorical(por_celda(3, object)),
+        'geometry': por_celda(4, object),
+        'lat': por_celda(5, np.float64),
+        'lon': por_celda(6, np.float64),
+        'area_m2': por_celda(7, np.float64),
+        'elevacion_promedio': por_celda(8, np.float64).round(2),
+        'puntuacion_calidad_datos': por_celda(9, np.float64).round(2),
+        'fecha': por_mes(10, 'datetime64[ns]'),
+        'temp_promedio': por_mes(11, np.float64).round(2),
+        'precipitacion_promedio': por_mes(12, np.float64).round(2),
+        'humedad_promedio': por_mes(13, np.float64).round(2),
+        'viento_promedio': por_mes(14, np.float64).round(2),
+    }
+    return pd.DataFrame(datos, columns=COLUMNAS_DATOS_CELDA)
+
+
+def leer_datos_celda(_conn, pais, departamento, ciudad: str = None,
+                     tamaño_bloque: int = 2000) -> Iterator[pd.DataFrame]:
+    """
+    Lee los datos de las celdas de una región en bloques de `tamaño_bloque` celdas con un cursor
+    del lado del servidor: la memoria no depende del tamaño de la región. Cada bloque es un
+    DataFrame con una fila por celda y mes (columnas COLUMNAS_DATOS_CELDA).
+    Sin ciudad, lee todas las regiones.
+    """
+    # Claves normalizadas (sin tildes ni mayúsculas/minúsculas): podan particiones y usan idx_celdas_clave_region
+    consulta = CONSULTA_DATOS_CELDA
+    parametros = []
+    if ciudad:
+        consulta += " WHERE c.pais_clave = clave_region(%s) AND c.departamento_clave = clave_region(%s) AND c.ciudad_clave = clave_region(%s)"
+        parametros = [pais, departamento, ciudad]
+    consulta += " ORDER BY c.id_celda"
+
+    # Cursor con nombre = cursor del servidor; tuplas en lugar de un dict por fila
+    cursor = _conn.cursor(name=f"datos_celda_{uuid.uuid4().hex[:12]}", cursor_factory=psycopg2.extensions.cursor)
+    cursor.itersize = tamaño_bloque
+    try:
+        cursor.execute(consulta, parametros)
+        while True:
+            filas = cursor.fetchmany(tamaño_bloque)
+            if not filas:
+                break
+            yield _bloque_datos_celda(filas)
+    finally:
+        if not _conn.closed:
+            cursor.close()
+
+
+def _con_cache(consulta: str, pais, departamento, ciudad, parametros: tuple, calcular) -> pd.DataFrame:
+    """
+    Resultado de calcular() pasando por la caché de regiones (solo consultas acotadas a un país,
+    departamento o ciudad y resultados no vacíos). Retorna una copia: quien llama puede
+    modificar su DataFrame.
+    """
+    if not pais or not CACHE_REGIONES_ACTIVO:
+        return calcular()
+    cache_regiones.escuchar(CONFIG_BD)
+    clave = cache_regiones.clave(pais, departamento, ciudad, consulta, *parametros)
+    df = cache_regiones.obtener(clave)
+    if df is None:
+        # Si una ingesta invalida la región durante calcular(), el resultado no se guarda
+        generacion = cache_regiones.generacion(clave)
+        df = calcular()
+        if df.empty:
+            return df
+        cache_regiones.guardar(clave, df, generacion)
+    return df.copy()
+
+
+def obtener_datos_celda(_conn, pais, departamento, ciudad: str = None, limit: int = None,
+                        columnas: list = None) -> pd.DataFrame:
+    """
+    Obtiene los datos de las celdas (una fila por celda y mes) leyendo la región completa
+    con leer_datos_celda. `limit` acota la cantidad de filas solo si se indica; `columnas`
+    elige un subconjunto de COLUMNAS_DATOS_CELDA.
+    Los resultados por ciudad se guardan en la caché de regiones hasta que una ingesta
+    escribe en esa región.
+    """
     if not _conn:
         return pd.DataFrame()
-    
-    # mayusculas para evitar problemas de case sensitive
-    pais = normalizar_texto(pais).upper()
-    departamento = departamento.upper()
-    ciudad = ciudad.upper()    
-    
-    cursor = _conn.cursor()
-    
-    query = """
-        SELECT 
-            id_celda,
-            pais_region,
-            departamento_region,
-            ciudad_region,
-            ST_AsGeoJSON(geometria) as geometry,
-            ST_Y(centroide) as lat,
-            ST_X(centroide) as lon,
-            area_m2,
-            fecha,
-            round(temp_promedio::numeric, 2) as temp_promedio,
-            round(precipitacion_promedio::numeric, 2) as precipitacion_promedio,
-            round(humedad_promedio::numeric, 2) as humedad_promedio,
-            round(elevacion_promedio::numeric, 2) as elevacion_promedio,
-            round(viento_promedio::numeric, 2) as viento_promedio,
-            round(puntuacion_calidad_datos::numeric, 2) as puntuacion_calidad_datos
-        FROM celdas_terreno
+
+    def calcular():
+        df = _leer_region(_conn, pais, departamento, ciudad, limit)
+        return df[columnas] if columnas and not df.empty else df
+
+    # Sin ciudad se leen todas las regiones: no se guarda en la caché
+    if not ciudad:
+        return calcular()
+    return _con_cache('datos_celda', pais, departamento, ciudad, (limit, columnas), calcular)
+
+
+def _leer_region(_conn, pais, departamento, ciudad, limit) -> pd.DataFrame:
+    bloques = []
+    filas = 0
+    lector = leer_datos_celda(_conn, pais, departamento, ciudad)
+    try:
+        for bloque in lector:
+            bloques.append(bloque)
+            filas += len(bloque)
+            if limit is not None and filas >= limit:
+                break
+    finally:
+        lector.close()
+    if not bloques:
+        return pd.DataFrame()
+
+    df = pd.concat(bloques, ignore_index=True)
+    # Las categorías pueden diferir entre bloques: se vuelven a unificar
+    for col in ('pais_region', 'departamento_region', 'ciudad_region'):
+        df[col] = df[col].astype('category')
+    return df.iloc[:limit] if limit is not None else df
+
+
+# Lectura columnar con COPY binario
+#################################
+# Todas las columnas del COPY son de ancho fijo (los NULL numéricos llegan como NaN), así que
+# el flujo binario se interpreta de una vez como un arreglo estructurado de NumPy.
+# Las regiones viajan como un código entero y la geometría (texto) en una consulta aparte por celda.
+
+_CAMPOS_COPY = [
+    ('codigo_region', '>i4'), ('id_celda', '>i8'),
+    ('lat', '>f8'), ('lon', '>f8'), ('area_m2', '>f8'), ('fecha', '>i4'),
+    ('temp_promedio', '>f4'), ('precipitacion_promedio', '>f4'), ('humedad_promedio', '>f4'),
+    ('elevacion_promedio', '>f4'), ('viento_promedio', '>f4'), ('puntuacion_calidad_datos', '>f4'),
+]
+# Cada tupla: cantidad de campos (int16) y, por campo, su largo (int32) seguido del valor
+_DTYPE_COPY = np.dtype(
+    [('campos', '>i2')] + [campo for nombre, tipo in _CAMPOS_COPY for campo in ((f'largo_{nombre}', '>i4'), (nombre, tipo))]
+)
+_FIRMA_COPY = b'PGCOPY\n\xff\r\n\x00'
+# Los DATE binarios son días desde 2000-01-01
+_EPOCA_PG = np.datetime64('2000-01-01', 'D')
+
+
+def _regiones_de(_conn, pais, departamento, ciudad) -> list:
+    """(pais_region, departamento_region, ciudad_region) distintas de la consulta, en orden."""
+    consulta = "SELECT DISTINCT pais_region, departamento_region, ciudad_region FROM celdas c"
+    parametros = []
+    if ciudad:
+        consulta += " WHERE c.pais_clave = clave_region(%s) AND c.departamento_clave = clave_region(%s) AND c.ciudad_clave = clave_region(%s)"
+        parametros = [pais, departamento, ciudad]
+    with _conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute(consulta + " ORDER BY 1, 2, 3", parametros)
+        return cursor.fetchall()
+
+
+def _decodificar_copy_binario(datos: bytes) -> np.ndarray:
+    """Arreglo estructurado (big-endian) con las tuplas de un COPY ... (FORMAT binary)."""
+    if bytes(datos[:len(_FIRMA_COPY)]) != _FIRMA_COPY:
+        raise ValueError("El flujo no es un COPY binario de PostgreSQL")
+    largo_extension = int.from_bytes(bytes(datos[15:19]), 'big')
+    inicio = 19 + largo_extension
+    # El flujo termina con el int16 -1
+    cuerpo = memoryview(datos)[inicio:len(datos) - 2]
+    if len(cuerpo) % _DTYPE_COPY.itemsize:
+        raise ValueError("COPY binario con campos de ancho variable o NULL inesperados")
+    return np.frombuffer(cuerpo, dtype=_DTYPE_COPY)
+
+
+def leer_datos_celda_columnar(_conn, pais, departamento, ciudad: str = None, geometria: bool = True) -> pd.DataFrame:
     """
-    
+    Lectura rápida de los datos de las celdas (una fila por celda y mes) con COPY binario:
+    llena directamente arreglos int64/float64 (id, coordenadas, área), float32 (clima, elevación,
+    calidad) y datetime64, con las regiones como columnas categóricas. Sin redondeo ni
+    conversiones fila a fila. Con geometria=False se omite la columna 'geometry'.
+    """
+    if not _conn:
+        return pd.DataFrame()
+
+    regiones = _regiones_de(_conn, pais, departamento, ciudad)
+    if not regiones:
+        return pd.DataFrame()
+    paises, departamentos, ciudades = (list(nivel) for nivel in zip(*regiones))
+
+    filtro = ""
+    parametros = [paises, departamentos, ciudades]
     if ciudad:
-        query += f" WHERE Upper (ciudad_region) = '{ciudad}' and Upper (pais_region) = '{pais}' AND Upper (departamento_region) = '{departamento}'"
-    
-    query += f" LIMIT {limit}"
-    
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    cursor.close()
-    
-    df = pd.DataFrame(rows)
-    
-    columnas_numericas = [
-        'area_m2', 'lat', 'lon', 'temp_promedio', 
-        'precipitacion_promedio', 'humedad_promedio', 
-        'elevacion_promedio', 'viento_promedio', 'puntuacion_calidad_datos'
-    ]
-    
-    for col in columnas_numericas:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
-#    print ("Dataframe ********** :")
-#    print (df)
-    return df
+        filtro = " WHERE c.pais_clave = clave_region(%s) AND c.departamento_clave = clave_region(%s) AND c.ciudad_clave = clave_region(%s)"
+        parametros += [pais, departamento, ciudad]
+    sin_nulos = "COALESCE({}, 'NaN')"
+    consulta = f"""
+        SELECT
+            (r.codigo - 1)::int4,
+            c.id_celda,
+            {sin_nulos.format('c.lat')}::float8,
+            {sin_nulos.format('c.lon')}::float8,
+            {sin_nulos.format('c.area_m2')}::float8,
+            m.fecha,
+            {sin_nulos.format('m.temp_promedio')}::float4,
+            {sin_nulos.format('m.precipitacion_promedio')}::float4,
+            {sin_nulos.format('m.humedad_promedio')}::float4,
+            {sin_nulos.format('c.elevacion_promedio')}::float4,
+            {sin_nulos.format('m.viento_promedio')}::float4,
+            {sin_nulos.format('c.puntuacion_calidad_datos')}::float4
+        FROM celdas c
+        JOIN clima_mensual m ON m.id_celda = c.id_celda
+        JOIN unnest(%s::text[], %s::text[], %s::text[]) WITH ORDINALITY AS r (pais, departamento, ciudad, codigo)
+          ON r.pais = c.pais_region AND r.departamento = c.departamento_region AND r.ciudad = c.ciudad_region
+        {filtro}
+    """
+    buffer = io.BytesIO()
+    with _conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        # COPY no admite parámetros: se interpolan con mogrify
+        consulta = cursor.mogrify(consulta, parametros).decode()
+        cursor.copy_expert(f"COPY ({consulta}) TO STDOUT WITH (FORMAT binary)", buffer)
+    tuplas = _decodificar_copy_binario(buffer.getbuffer())
+    if tuplas.size == 0:
+        return pd.DataFrame()
 
+    datos = {}
+    codigos = tuplas['codigo_region'].astype(np.int32)
+    for columna, valores in (('pais_region', paises), ('departamento_region', departamentos), ('ciudad_region', ciudades)):
+        categorias, codigos_nivel = np.unique(np.asarray(valores, dtype=object), return_inverse=True)
+        datos[columna] = pd.Categorical.from_codes(codigos_nivel[codigos], categories=categorias)
+    for nombre, tipo in _CAMPOS_COPY[1:]:
+        if nombre == 'fecha':
+            dias = tuplas['fecha'].astype(np.int32).astype('timedelta64[D]')
+            datos['fecha'] = (_EPOCA_PG + dias).astype('datetime64[ns]')
+        else:
+            # A orden de bytes nativo conservando el ancho (float32 sigue siendo float32)
+            datos[nombre] = tuplas[nombre].astype(np.dtype(tipo).newbyteorder('='))
 
-def obtener_estadisticas(_conn, attribute: str, region: str = None) -> Dict:
-    """Obtiene estadísticas de un atributo"""
+    df = pd.DataFrame(datos)
+    if geometria:
+        df['geometry'] = _geometrias_por_celda(_conn, df['id_celda'].to_numpy())
+    return df[[columna for columna in COLUMNAS_DATOS_CELDA if columna in df.columns]]
+
+
+def _geometrias_por_celda(_conn, ids: np.ndarray) -> np.ndarray:
+    """GeoJSON de cada id (una consulta por celda distinta, no por mes), alineado con `ids`."""
+    unicos, posiciones = np.unique(ids, return_inverse=True)
+    with _conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute(
+            "SELECT DISTINCT ON (id_celda) id_celda, ST_AsGeoJSON(geometria) FROM celdas WHERE id_celda = ANY(%s)",
+            (unicos.tolist(),)
+        )
+        por_id = dict(cursor.fetchall())
+    geometrias = np.array([por_id.get(int(id_celda)) for id_celda in unicos], dtype=object)
+    return geometrias[posiciones]
+
+
+def obtener_celdas_mapa(_conn, pais, departamento, ciudad, limite: int = 5000) -> list:
+    """
+    Celdas ya ingestadas de una región (una fila por celda, clima promedio) para pintar
+    el mapa mientras la ingesta sigue en curso. El color usa la calidad de datos (0-100).
+    """
     if not _conn:
-        return {}
+        return []
     
     cursor = _conn.cursor()
-    
-    query = f"""
+    cursor.execute("""
         SELECT 
-            MIN({attribute}) as min_val,
-            MAX({attribute}) as max_val,
-            AVG({attribute}) as avg_val,
-            STDDEV({attribute}) as std_val,
-            COUNT({attribute}) as count_val
-        FROM celdas_terreno
-        WHERE {attribute} IS NOT NULL
-    """
-    
-    if region:
-        query += f" AND ciudad_region = '{region}'"
-    
-    cursor.execute(query)
-    result = cursor.fetchone()
+            c.id_celda,
+            ST_AsGeoJSON(c.geometria) as geometry,
+            c.lat,
+            c.lon,
+            c.elevacion_promedio,
+            r.temp_promedio,
+            r.precipitacion_promedio,
+            r.humedad_promedio,
+            r.viento_promedio,
+            100 * c.puntuacion_calidad_datos as score
+        FROM celdas c
+        LEFT JOIN resumen_clima_celda r ON r.id_celda = c.id_celda
+        WHERE c.pais_clave = clave_region(%s) AND c.departamento_clave = clave_region(%s) AND c.ciudad_clave = clave_region(%s)
+        LIMIT %s
+    """, (pais, departamento, ciudad, limite))
+    filas = cursor.fetchall()
     cursor.close()
     
-    return dict(result) if result else {}
+    celdas = [dict(fila) for fila in filas]
+    for celda in celdas:
+        celda['explicacion'] = "⏳ Ingesta en curso: color según calidad de datos, aún sin evaluar."
+    return celdas
+
+
+# Parámetros de las reglas del cultivo → columna de la BD (los mismos que usa funciones.evaluar_idoneidad_terreno)
+COLUMNAS_REGLAS = {
+    'temp': 'temp_promedio', 'temperatura': 'temp_promedio',
+    'humedad': 'humedad_promedio',
+    'precipitacion': 'precipitacion_promedio',
+    'viento': 'viento_promedio',
+    'altitud': 'elevacion_promedio', 'elevacion': 'elevacion_promedio',
+    'suelo': 'tipo_suelo'
+}
+
+# Origen de cada columna evaluable en la consulta de idoneidad (valores redondeados a 2 decimales
+# como en obtener_datos_celda, para puntuar igual que la evaluación en pandas)
+_COLUMNAS_EVALUABLES = {
+    'temp_promedio': 'm.temp_promedio',
+    'precipitacion_promedio': 'm.precipitacion_promedio',
+    'humedad_promedio': 'm.humedad_promedio',
+    'viento_promedio': 'm.viento_promedio',
+    'elevacion_promedio': 'c.elevacion_promedio',
+}
+
+
+def _compilar_reglas(reglas: dict) -> tuple:
+    """
+    Traduce las reglas {parametro: {'min', 'max'}} a expresiones SQL de puntaje mensual y de
+    motivo de fallo. Los nombres de columna salen de COLUMNAS_REGLAS; los valores van como parámetros.
+    """
+    puntajes, motivos, parametros = [], [], {}
+    for numero, (parametro, rango) in enumerate(reglas.items()):
+        columna = COLUMNAS_REGLAS.get(parametro.lower())
+        # Sin columna en la BD (p. ej. tipo de suelo) o sin rango numérico: no cuenta como factor
+        if columna not in _COLUMNAS_EVALUABLES or not (isinstance(rango, dict) and 'min' in rango and 'max' in rango):
+            continue
+        valor = f"ROUND({_COLUMNAS_EVALUABLES[columna]}::numeric, 2)::float8"
+        puntaje = f"puntaje_rango({valor}, %(min_{numero})s, %(max_{numero})s)"
+        puntajes.append(puntaje)
+        motivos.append(
+            f"CASE WHEN {puntaje} = 0 THEN %(parametro_{numero})s || ' fuera de rango (' "
+            f"|| COALESCE({valor}::text, 'nan') || '); ' END"
+        )
+        parametros.update({f"min_{numero}": float(rango['min']), f"max_{numero}": float(rango['max']),
+                           f"parametro_{numero}": parametro})
+    return puntajes, motivos, parametros
+
+
+def evaluar_idoneidad(_conn, pais, departamento, ciudad, reglas: dict, top_k: int = None) -> pd.DataFrame:
+    """
+    Evalúa la idoneidad de las celdas de una región dentro de PostgreSQL, con la misma lógica que
+    funciones.evaluar_idoneidad_terreno: puntaje por mes (promedio de los factores, 0-100) y
+    score anual = promedio de los meses. Se puntúa cada fila de clima_mensual (con varios años, un
+    mes fuera de rango no se diluye en la climatología); los promedios anuales salen de
+    resumen_clima_celda. Retorna una fila por celda (o solo las top_k mejores) con score, promedios,
+    geometría y motivo_fallo; la explicación se agrega con funciones.explicar_idoneidad. Pasa por
+    la caché de regiones, como obtener_datos_celda.
+    """
+    if not _conn:
+        return pd.DataFrame()
+    return _con_cache('idoneidad', pais, departamento, ciudad, (reglas, top_k),
+                      lambda: _evaluar_idoneidad(_conn, pais, departamento, ciudad, reglas, top_k))
+
+
+def _evaluar_idoneidad(_conn, pais, departamento, ciudad, reglas: dict, top_k: int) -> pd.DataFrame:
+    puntajes, motivos, parametros = _compilar_reglas(reglas or {})
+    score_mes = f"ROUND((({' + '.join(puntajes)}) / {len(puntajes)})::numeric, 1)" if puntajes else "0"
+    motivo = f"CONCAT({', '.join(motivos)})" if motivos else "''"
+    parametros.update({'pais': pais, 'departamento': departamento, 'ciudad': ciudad, 'top_k': top_k})
+
+    # Se puntúa cada fila mensual (como evaluar_idoneidad_terreno); solo los promedios anuales
+    # salen de resumen_clima_celda y la geometría se lee solo para las celdas del resultado
+    consulta = f"""
+        WITH meses AS (
+            SELECT
+                c.id_celda, c.pais_clave, c.departamento_clave, c.ciudad_clave,
+                {score_mes} AS score_mes,
+                {motivo} AS motivo
+            FROM celdas c
+            JOIN clima_mensual m ON m.id_celda = c.id_celda
+            WHERE c.pais_clave = clave_region(%(pais)s) AND c.departamento_clave = clave_region(%(departamento)s)
+              AND c.ciudad_clave = clave_region(%(ciudad)s)
+        ),
+        puntajes AS (
+            SELECT
+                id_celda, pais_clave, departamento_clave, ciudad_clave,
+                ROUND(AVG(score_mes), 1)::float8 AS score,
+                COALESCE(STRING_AGG(DISTINCT motivo, ' ') FILTER (WHERE motivo <> ''), '') AS motivo_fallo
+            FROM meses
+            GROUP BY id_celda, pais_clave, departamento_clave, ciudad_clave
+            ORDER BY score DESC, id_celda
+            LIMIT %(top_k)s
+        )
+        SELECT
+            p.id_celda, p.score, c.lat, c.lon, ST_AsGeoJSON(c.geometria) AS geometry,
+            ROUND(r.temp_promedio::numeric, 2)::float8 AS temp_promedio,
+            ROUND(r.precipitacion_promedio::numeric, 2)::float8 AS precipitacion_promedio,
+            ROUND(c.elevacion_promedio::numeric, 2)::float8 AS elevacion_promedio,
+            ROUND(r.humedad_promedio::numeric, 2)::float8 AS humedad_promedio,
+            ROUND(r.viento_promedio::numeric, 2)::float8 AS viento_promedio,
+            p.motivo_fallo
+        FROM puntajes p
+        JOIN celdas c USING (id_celda, pais_clave, departamento_clave, ciudad_clave)
+        JOIN resumen_clima_celda r ON r.id_celda = p.id_celda
+        ORDER BY p.score DESC, p.id_celda
+    """
+    with _conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute(consulta, parametros)
+        columnas = [descripcion[0] for descripcion in cursor.description]
+        filas = cursor.fetchall()
+    df = pd.DataFrame(filas, columns=columnas)
+    columnas_numericas = ['score', 'lat', 'lon', 'temp_promedio', 'precipitacion_promedio',
+                          'elevacion_promedio', 'humedad_promedio', 'viento_promedio']
+    df[columnas_numericas] = df[columnas_numericas].astype(np.float64)
+    return df
+
+
+# Estadísticas por región
+#################################
+
+ATRIBUTOS_CLIMA = [
+    'temp_promedio', 'precipitacion_promedio', 'humedad_promedio', 'viento_promedio', 'elevacion_promedio',
+]
+PERCENTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+def estadisticas_region(_conn, pais, departamento: str = None, ciudad: str = None,
+                        agrupar: tuple = ('region', 'mes')) -> pd.DataFrame:
+    """
+    Estadísticas de todos los atributos climáticos (ATRIBUTOS_CLIMA) de un país, departamento o
+    ciudad en una sola lectura: n, mínimo, máximo, promedio, desviación y percentiles (p10..p90).
+
+    Retorna una fila por nivel y atributo. 'nivel' es 'total' (siempre), 'region' (por ciudad, o por
+    departamento si solo se indica el país), 'mes' (mes del año 1-12) y 'region_mes', según `agrupar`.
+    Pasa por la caché de regiones y se invalida cuando una ingesta escribe en la región.
+    """
+    if not _conn or not pais:
+        return pd.DataFrame()
+    agrupar = tuple(sorted(set(agrupar) & {'region', 'mes'}))
+    return _con_cache('estadisticas', pais, departamento, ciudad, agrupar,
+                      lambda: _estadisticas_region(_conn, pais, departamento, ciudad, agrupar))
+
+
+def _estadisticas_region(_conn, pais, departamento, ciudad, agrupar: tuple) -> pd.DataFrame:
+    filtros = ["c.pais_clave = clave_region(%(pais)s)"]
+    if departamento:
+        filtros.append("c.departamento_clave = clave_region(%(departamento)s)")
+    if ciudad:
+        filtros.append("c.ciudad_clave = clave_region(%(ciudad)s)")
+    region = "c.ciudad_region" if departamento or ciudad else "c.departamento_region"
+
+    # Conjuntos de agrupación y nombre de cada nivel según GROUPING()
+    conjuntos = ["(atributo)"]
+    if agrupar == ('mes', 'region'):
+        conjuntos += ["(atributo, region)", "(atributo, mes)", "(atributo, region, mes)"]
+        nivel = "CASE GROUPING(region, mes) WHEN 0 THEN 'region_mes' WHEN 1 THEN 'region' WHEN 2 THEN 'mes' ELSE 'total' END"
+    elif agrupar == ('region',):
+        conjuntos.append("(atributo, region)")
+        nivel = "CASE GROUPING(region) WHEN 0 THEN 'region' ELSE 'total' END"
+    elif agrupar == ('mes',):
+        conjuntos.append("(atributo, mes)")
+        nivel = "CASE GROUPING(mes) WHEN 0 THEN 'mes' ELSE 'total' END"
+    else:
+        nivel = "'total'"
+    columna_region = "region" if 'region' in agrupar else "NULL::text AS region"
+    columna_mes = "mes" if 'mes' in agrupar else "NULL::integer AS mes"
+
+    valores = ", ".join(
+        f"('{atributo}', {'c' if atributo == 'elevacion_promedio' else 'm'}.{atributo})" for atributo in ATRIBUTOS_CLIMA
+    )
+    # Una lectura de celdas + clima_mensual; los atributos se despliegan en filas y
+    # GROUPING SETS calcula todos los niveles sobre esa misma lectura
+    consulta = f"""
+        SELECT
+            {nivel} AS nivel,
+            {columna_region},
+            {columna_mes},
+            atributo,
+            COUNT(valor) AS n,
+            MIN(valor) AS minimo,
+            MAX(valor) AS maximo,
+            AVG(valor) AS promedio,
+            STDDEV_SAMP(valor) AS desviacion,
+            percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY valor) AS percentiles
+        FROM (
+            SELECT {region} AS region, EXTRACT(MONTH FROM m.fecha)::INTEGER AS mes, v.atributo, v.valor
+            FROM celdas c
+            JOIN clima_mensual m ON m.id_celda = c.id_celda
+            CROSS JOIN LATERAL (VALUES {valores}) AS v (atributo, valor)
+            WHERE {" AND ".join(filtros)}
+        ) datos
+        GROUP BY GROUPING SETS ({", ".join(conjuntos)})
+        ORDER BY atributo, nivel DESC, region, mes
+    """
+    parametros = {'pais': pais, 'departamento': departamento, 'ciudad': ciudad, 'percentiles': PERCENTILES}
+    with _conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute(consulta, parametros)
+        columnas = [descripcion[0] for descripcion in cursor.description]
+        filas = cursor.fetchall()
+    df = pd.DataFrame(filas, columns=columnas)
+    if df.empty:
+        return df
+
+    percentiles = np.array([p if p is not None else [None] * len(PERCENTILES) for p in df.pop('percentiles')],
+                           dtype=np.float64)
+    for indice, percentil in enumerate(PERCENTILES):
+        df[f"p{round(percentil * 100)}"] = percentiles[:, indice]
+    df[['minimo', 'maximo', 'promedio', 'desviacion']] = df[['minimo', 'maximo', 'promedio', 'desviacion']].astype(np.float64)
+    df['mes'] = df['mes'].astype('Int64')
+    return df
 
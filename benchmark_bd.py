@@ -0,0 +1,207 @@
+"""
+Benchmark de consultas por región a medida que crece la tabla de celdas.
+
+Crea un esquema aislado (benchmark_bd) con las mismas migraciones de esquema.py, lo llena
+con regiones sintéticas hasta cada tamaño pedido y mide la lectura de una región fija:
+
+    - clave:   bd.obtener_datos_celda (claves normalizadas: poda de particiones + índice)
+    - UPPER(): el filtro anterior con UPPER(columna), que recorre todas las particiones
+
+Con --lectores compara, para una región de cada tamaño (filas de clima), la lectura con
+bd.obtener_datos_celda y con bd.leer_datos_celda_columnar (COPY binario): tiempo y memoria.
+
+Ejemplos:
+    python benchmark_bd.py
+    python benchmark_bd.py --tamaños 100000,1000000,5000000 --celdas-region 2000 --meses 12
+    python benchmark_bd.py --lectores --filas 100000,1000000
+"""
+import argparse
+import os
+import statistics
+import time
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+# Se mide la lectura desde PostgreSQL, no la caché de regiones
+os.environ.setdefault("CACHE_REGIONES", "0")
+import bd
+import esquema
+
+
+ESQUEMA = "benchmark_bd"
+
+# Región consultada en cada medición (la primera que se genera)
+REGION_OBJETIVO = ("Benchmark País 0", "Departamento 0", "Ciudad 0")
+
+CONSULTA_UPPER = """
+    SELECT m.id_celda, m.fecha, m.temp_promedio, m.precipitacion_promedio,
+           m.humedad_promedio, m.viento_promedio
+    FROM clima_mensual m
+    JOIN celdas c ON c.id_celda = m.id_celda
+    WHERE UPPER(c.ciudad_region) = UPPER(%s) AND UPPER(c.pais_region) = UPPER(%s)
+      AND UPPER(c.departamento_region) = UPPER(%s)
+"""
+
+
+def conectar():
+    """Conexión con search_path en el esquema del benchmark (PostGIS y unaccent siguen en public)."""
+    conexion = psycopg2.connect(
+        cursor_factory=RealDictCursor, options=f"-c search_path={ESQUEMA},public", **bd.CONFIG_BD
+    )
+    with conexion.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE; CREATE SCHEMA {ESQUEMA};")
+    conexion.commit()
+    esquema.migrar(conexion)
+    return conexion
+
+
+def region(numero: int) -> tuple:
+    """(país, departamento, ciudad) sintéticos: 4 ciudades por departamento y 5 departamentos por país."""
+    return (f"Benchmark País {numero // 20}", f"Departamento {(numero // 4) % 5}", f"Ciudad {numero % 4}")
+
+
+def agregar_regiones(conexion, desde: int, hasta: int, celdas_region: int, meses: int):
+    """Inserta las regiones [desde, hasta) con `celdas_region` celdas y `meses` meses de clima cada una."""
+    for numero in range(desde, hasta):
+        agregar_region(conexion, region(numero), numero * celdas_region, celdas_region, meses)
+    with conexion.cursor() as cursor:
+        cursor.execute("ANALYZE celdas; ANALYZE clima_mensual;")
+    conexion.commit()
+
+
+def agregar_region(conexion, nombre: tuple, base: int, celdas_region: int, meses: int):
+    """Inserta una región sintética con ids base .. base + celdas_region - 1."""
+    pais, departamento, ciudad = nombre
+    with conexion.cursor() as cursor:
+        cursor.execute("SELECT asegurar_particion_celdas(%s, %s)", (pais, departamento))
+        cursor.execute("""
+            INSERT INTO celdas (
+                id_celda, pais_region, departamento_region, ciudad_region,
+                pais_clave, departamento_clave, ciudad_clave,
+                geometria, centroide, lat, lon, area_m2,
+                elevacion_promedio, puntuacion_calidad_datos
+            )
+            SELECT %(base)s + g, %(pais)s, %(departamento)s, %(ciudad)s,
+                   clave_region(%(pais)s), clave_region(%(departamento)s), clave_region(%(ciudad)s),
+                   ST_MakeEnvelope(x, y, x + 0.02, y + 0.02, 4326), ST_SetSRID(ST_MakePoint(x + 0.01, y + 0.01), 4326),
+                   y + 0.01, x + 0.01, 4000000, random() * 4000, random()
+            FROM generate_series(0, %(celdas)s - 1) g,
+                 LATERAL (SELECT -80 + (g %% 100) * 0.02 AS x, -15 + (g / 100) * 0.02 AS y) p;
+
+            INSERT INTO clima_mensual (id_celda, fecha, temp_promedio, precipitacion_promedio,
+                                       humedad_promedio, viento_promedio)
+            SELECT %(base)s + g, DATE '2023-01-01' + make_interval(months => mes),
+                   random() * 30, random() * 200, random() * 100, random() * 10
+            FROM generate_series(0, %(celdas)s - 1) g, generate_series(0, %(meses)s - 1) mes;
+        """, {'base': base, 'pais': pais, 'departamento': departamento, 'ciudad': ciudad,
+              'celdas': celdas_region, 'meses': meses})
+    conexion.commit()
+
+
+def medir(funcion, repeticiones: int) -> float:
+    """Mediana en milisegundos, tras una ejecución de calentamiento."""
+    funcion()
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tiempos)
+
+
+def consulta_upper(conexion):
+    pais, departamento, ciudad = REGION_OBJETIVO
+    with conexion.cursor() as cursor:
+        cursor.execute(CONSULTA_UPPER, (ciudad, pais, departamento))
+        return cursor.fetchall()
+
+
+def particiones_leidas(conexion) -> int:
+    """Cantidad de particiones de celdas que recorre la consulta por clave (poda de particiones)."""
+    pais, departamento, ciudad = REGION_OBJETIVO
+    with conexion.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute("""
+            EXPLAIN SELECT id_celda FROM celdas
+            WHERE pais_clave = clave_region(%s) AND departamento_clave = clave_region(%s)
+              AND ciudad_clave = clave_region(%s)
+        """, (pais, departamento, ciudad))
+        plan = "\n".join(fila[0] for fila in cursor.fetchall())
+    return sum(1 for linea in plan.splitlines() if " on celdas_" in linea)
+
+
+def comparar_tamaños(conexion, tamaños: list, celdas_region: int, meses: int, repeticiones: int):
+    """Lectura de la región objetivo (por clave y con UPPER()) a medida que la tabla crece hasta cada tamaño."""
+    pais, departamento, ciudad = REGION_OBJETIVO
+    print(f"📏 Región medida: {ciudad}, {departamento}, {pais} ({celdas_region} celdas × {meses} meses)")
+    print(f"{'celdas':>12} {'filas clima':>14} {'particiones':>12} {'clave (ms)':>12} {'UPPER() (ms)':>14}")
+
+    regiones = 0
+    for tamaño in tamaños:
+        objetivo = max(1, tamaño // celdas_region)
+        inicio = time.time()
+        agregar_regiones(conexion, regiones, objetivo, celdas_region, meses)
+        regiones = max(regiones, objetivo)
+        carga = time.time() - inicio
+
+        ms_clave = medir(lambda: bd.obtener_datos_celda(conexion, pais, departamento, ciudad), repeticiones)
+        ms_upper = medir(lambda: consulta_upper(conexion), repeticiones)
+        total_celdas = regiones * celdas_region
+        print(f"{total_celdas:>12,} {total_celdas * meses:>14,} {particiones_leidas(conexion):>12} "
+              f"{ms_clave:>12.1f} {ms_upper:>14.1f}   (carga {carga:.0f} s)")
+
+
+def comparar_lectores(conexion, filas: list, meses: int, repeticiones: int):
+    """Tiempo y memoria de obtener_datos_celda frente a leer_datos_celda_columnar por tamaño de región."""
+    print(f"{'filas':>12} {'lector':>28} {'ms':>10} {'MB':>8}")
+    for numero, total in enumerate(sorted(filas)):
+        celdas = max(1, total // meses)
+        nombre = ("Benchmark Lectores", "Departamento 0", f"Ciudad {total}")
+        # Ids fuera del rango de las regiones de la comparación de particiones
+        agregar_region(conexion, nombre, (1 << 40) + numero * (1 << 32), celdas, meses)
+        with conexion.cursor() as cursor:
+            cursor.execute("ANALYZE celdas; ANALYZE clima_mensual;")
+        conexion.commit()
+
+        lectores = {
+            'obtener_datos_celda': lambda: bd.obtener_datos_celda(conexion, *nombre),
+            'leer_datos_celda_columnar': lambda: bd.leer_datos_celda_columnar(conexion, *nombre),
+            'columnar sin geometría': lambda: bd.leer_datos_celda_columnar(conexion, *nombre, geometria=False),
+        }
+        for etiqueta, lector in lectores.items():
+            ms = medir(lector, repeticiones)
+            megas = lector().memory_usage(deep=True).sum() / 2 ** 20
+            print(f"{celdas * meses:>12,} {etiqueta:>28} {ms:>10.1f} {megas:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de lectura por región en celdas particionadas")
+    parser.add_argument("--tamaños", default="10000,100000,1000000,3000000",
+                        help="Cantidades totales de celdas a medir, separadas por coma")
+    parser.add_argument("--celdas-region", type=int, default=2000)
+    parser.add_argument("--meses", type=int, default=12)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--conservar", action="store_true", help=f"No borrar el esquema {ESQUEMA} al terminar")
+    parser.add_argument("--lectores", action="store_true",
+                        help="Comparar obtener_datos_celda con la lectura columnar (COPY binario)")
+    parser.add_argument("--filas", default="100000,1000000",
+                        help="Con --lectores: filas de clima de cada región medida, separadas por coma")
+    args = parser.parse_args()
+
+    conexion = conectar()
+    try:
+        if args.lectores:
+            comparar_lectores(conexion, [int(valor) for valor in args.filas.split(",")], args.meses, args.repeticiones)
+        else:
+            comparar_tamaños(conexion, sorted(int(valor) for valor in args.tamaños.split(",")),
+                             args.celdas_region, args.meses, args.repeticiones)
+    finally:
+        if not args.conservar:
+            with conexion.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE")
+            conexion.commit()
+        conexion.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from planificador_ee import planificador
+
+
+# Cargar variables de entorno
+#################################
+
+load_dotenv(dotenv_path="_mientorno.env")
+CACHE_RUTA = os.getenv("GEE_CACHE_RUTA", "cache_ee.sqlite")
+CACHE_MAX_MB = float(os.getenv("GEE_CACHE_MAX_MB", "512"))
+CACHE_TTL_DIAS = float(os.getenv("GEE_CACHE_TTL_DIAS", "30"))
+CACHE_ACTIVO = os.getenv("GEE_CACHE", "1") != "0"
+
+# Hilos que deben consultar GEE aunque haya respuesta guardada (ver forzar_descarga)
+_hilo = threading.local()
+
+
+# Claves de caché
+#################################
+
+def clave(*partes) -> str:
+    """
+    Clave direccionada por contenido a partir de partes arbitrarias
+    (dataset, bandas, hash de geometría, escala, fechas...).
+    """
+    texto = json.dumps(partes, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def clave_objeto_ee(objeto_ee) -> str:
+    """
+    Clave de un objeto de Earth Engine a partir de su grafo de cálculo serializado.
+    El grafo incluye el ID del dataset, las bandas, la geometría, la escala y el
+    rango de fechas, por lo que dos consultas iguales comparten la misma clave
+    y cualquier cambio en la consulta genera una clave distinta.
+    """
+    return clave("ee", objeto_ee.serialize())
+
+
+@contextmanager
+def forzar_descarga():
+    """
+    Dentro del bloque (y en este hilo) ninguna lectura de la caché acierta: cada consulta
+    llega a GEE y su respuesta reemplaza a la guardada. Para datos que pueden haber cambiado
+    desde que se guardaron, como meses aún no consolidados.
+    """
+    anterior = getattr(_hilo, "forzar", False)
+    _hilo.forzar = True
+    try:
+        yield
+    finally:
+        _hilo.forzar = anterior
+
+
+# Caché persistente
+#################################
+
+class CacheEE:
+    """
+    Caché en disco (SQLite) de respuestas de GEE.
+    Los valores se guardan como JSON comprimido con zlib, con expiración por
+    TTL y desalojo LRU cuando se supera el tamaño máximo.
+    """
+
+    def __init__(self, ruta: str = CACHE_RUTA, max_mb: float = CACHE_MAX_MB,
+                 ttl_dias: float = CACHE_TTL_DIAS):
+        self.ruta = ruta
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_segundos = ttl_dias * 24 * 3600
+        self.aciertos = 0
+        self.fallos = 0
+        self._candado = threading.Lock()
+        self._conexion = None
+
+    def _conectar(self):
+        if self._conexion is None:
+            self._conexion = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False)
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute("""
+                CREATE TABLE IF NOT EXISTS respuestas (
+                    clave TEXT PRIMARY KEY,
+                    valor BLOB NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    creado REAL NOT NULL,
+                    ultimo_acceso REAL NOT NULL
+                )
+            """)
+            self._conexion.execute(
+                "CREATE INDEX IF NOT EXISTS idx_respuestas_acceso ON respuestas (ultimo_acceso)"
+            )
+            self._conexion.commit()
+        return self._conexion
+
+    def obtener(self, clave_cache: str):
+        """Retorna el valor guardado o None si no existe o expiró."""
+        datos = self.obtener_bytes(clave_cache)
+        if datos is None:
+            return None
+        return json.loads(datos.decode("utf-8"))
+
+    def guardar(self, clave_cache: str, valor):
+        """Guarda un valor serializable a JSON y aplica el desalojo LRU."""
+        if valor is None:
+            return
+        self.guardar_bytes(clave_cache, json.dumps(valor, separators=(",", ":")).encode("utf-8"))
+
+    def obtener_bytes(self, clave_cache: str):
+        """Como obtener(), pero retorna los bytes guardados sin decodificar."""
+        ahora = time.time()
+        if getattr(_hilo, "forzar", False):
+            with self._candado:
+                self.fallos += 1
+            return None
+        with self._candado:
+            conexion = self._conectar()
+            fila = conexion.execute(
+                "SELECT valor, creado FROM respuestas WHERE clave = ?", (clave_cache,)
+            ).fetchone()
+            if fila is None:
+                self.fallos += 1
+                return None
+            valor, creado = fila
+            if ahora - creado > self.ttl_segundos:
+                conexion.execute("DELETE FROM respuestas WHERE clave = ?", (clave_cache,))
+                conexion.commit()
+                self.fallos += 1
+                return None
+            conexion.execute(
+                "UPDATE respuestas SET ultimo_acceso = ? WHERE clave = ?", (ahora, clave_cache)
+            )
+            conexion.commit()
+            self.aciertos += 1
+        return zlib.decompress(valor)
+
+    def guardar_bytes(self, clave_cache: str, datos: bytes):
+        """Como guardar(), para valores ya serializados (p.ej. arreglos .npy)."""
+        comprimido = zlib.compress(datos)
+        ahora = time.time()
+        with self._candado:
+            conexion = self._conectar()
+            conexion.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, valor, bytes, creado, ultimo_acceso) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (clave_cache, sqlite3.Binary(comprimido), len(comprimido), ahora, ahora),
+            )
+            self._desalojar(conexion, ahora)
+            conexion.commit()
+
+    def _desalojar(self, conexion, ahora: float):
+        """Elimina expirados y, si se supera max_bytes, los menos usados recientemente."""
+        conexion.execute("DELETE FROM respuestas WHERE creado < ?", (ahora - self.ttl_segundos,))
+        total = conexion.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Liberar hasta el 90% del máximo para no desalojar en cada escritura
+        objetivo = total - int(self.max_bytes * 0.9)
+        liberado = 0
+        claves = []
+        for clave_lru, bytes_lru in conexion.execute(
+            "SELECT clave, bytes FROM respuestas ORDER BY ultimo_acceso ASC"
+        ):
+            claves.append((clave_lru,))
+            liberado += bytes_lru
+            if liberado >= objetivo:
+                break
+        conexion.executemany("DELETE FROM respuestas WHERE clave = ?", claves)
+
+    def obtener_arreglo(self, clave_cache: str):
+        """Retorna un arreglo NumPy guardado con guardar_arreglo o None."""
+        import io
+        import numpy as np
+        datos = self.obtener_bytes(clave_cache)
+        if datos is None:
+            return None
+        return np.load(io.BytesIO(datos), allow_pickle=False)
+
+    def guardar_arreglo(self, clave_cache: str, arreglo):
+        import io
+        import numpy as np
+        buffer = io.BytesIO()
+        np.save(buffer, arreglo, allow_pickle=False)
+        self.guardar_bytes(clave_cache, buffer.getvalue())
+
+    def obtener_o_calcular(self, clave_cache: str, funcion):
+        """Retorna el valor de la caché o lo calcula con funcion() y lo guarda."""
+        valor = self.obtener(clave_cache)
+        if valor is not None:
+            return valor
+        valor = funcion()
+        self.guardar(clave_cache, valor)
+        return valor
+
+    def limpiar(self):
+        with self._candado:
+            conexion = self._conectar()
+            conexion.execute("DELETE FROM respuestas")
+            conexion.commit()
+
+    def estadisticas(self) -> dict:
+        with self._candado:
+            conexion = self._conectar()
+            entradas, total = conexion.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM respuestas"
+            ).fetchone()
+        return {
+            "entradas": entradas,
+            "bytes": total,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+        }
+
+
+cache = CacheEE()
+
+
+def compactar(info):
+    """
+    Reduce una respuesta de getInfo() a lo que usan los decodificadores:
+    de las FeatureCollections solo se conservan las propiedades de cada feature.
+    """
+    if isinstance(info, dict) and "features" in info:
+        return {"features": [{"properties": f.get("properties", {})} for f in info["features"]]}
+    if isinstance(info, list):
+        return [compactar(elemento) for elemento in info]
+    return info
+
+
+def respuesta_puede_ser_anterior(momento: datetime, ahora: datetime = None) -> bool:
+    """
+    True si una respuesta guardada puede haberse obtenido antes de `momento` (una entrada vive
+    hasta el TTL de la caché). Si los datos cambiaron en `momento`, la respuesta guardada puede
+    estar desactualizada y conviene consultar GEE con forzar_descarga().
+    """
+    ahora = ahora or datetime.now()
+    return momento + timedelta(seconds=cache.ttl_segundos) > ahora
+
+
+def descargar(objeto_ee):
+    """
+    Equivalente a objeto_ee.getInfo() pasando por la caché persistente.
+    Las llamadas que llegan a GEE pasan por el planificador (concurrencia y reintentos).
+    """
+    if not CACHE_ACTIVO:
+        return planificador.ejecutar(objeto_ee.getInfo)
+    return cache.obtener_o_calcular(
+        clave_objeto_ee(objeto_ee),
+        lambda: compactar(planificador.ejecutar(objeto_ee.getInfo)),
+    )
@@ -0,0 +1,220 @@
+import json
+import os
+import select
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+
+# Cargar variables de entorno
+#################################
+
+load_dotenv(dotenv_path="_mientorno.env")
+CACHE_REGIONES_ACTIVO = os.getenv("CACHE_REGIONES", "1") != "0"
+CACHE_REGIONES_MAX_MB = float(os.getenv("CACHE_REGIONES_MAX_MB", "256"))
+CACHE_REGIONES_TTL_S = float(os.getenv("CACHE_REGIONES_TTL_S", "900"))
+# Escuchar en PostgreSQL las invalidaciones de otros procesos (ingestas en segundo plano)
+CACHE_REGIONES_ESCUCHAR = os.getenv("CACHE_REGIONES_ESCUCHAR", "1") != "0"
+
+# Canal de LISTEN/NOTIFY por el que ingesta_bd avisa qué región escribió
+CANAL_INVALIDACION = "regiones_actualizadas"
+
+
+# Claves de caché
+#################################
+
+def clave_region(texto: str) -> str:
+    """Nombre de región normalizado: sin tildes, en mayúsculas y sin espacios extremos."""
+    if texto is None:
+        return ""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).strip().upper()
+
+
+def region(pais: str, departamento: str, ciudad: str) -> tuple:
+    return (clave_region(pais), clave_region(departamento), clave_region(ciudad))
+
+
+def _tamaño(valor) -> int:
+    """Bytes aproximados de un resultado (DataFrame, lista de dicts u otro objeto)."""
+    if hasattr(valor, "memory_usage"):
+        return int(valor.memory_usage(index=True, deep=True).sum())
+    if isinstance(valor, list):
+        return sys.getsizeof(valor) + sum(sys.getsizeof(json.dumps(v, default=str)) for v in valor)
+    return sys.getsizeof(valor)
+
+
+# Caché en memoria
+#################################
+
+class CacheRegiones:
+    """
+    Caché en memoria de resultados de consultas por región (datos de celdas, evaluaciones).
+
+    - Clave: región normalizada + nombre de la consulta + sus parámetros (columnas, reglas...).
+    - Desalojo LRU por tamaño total (max_mb) y expiración por TTL como red de seguridad.
+    - invalidar(pais, departamento, ciudad) descarta las entradas de la región (y de su departamento
+      y país); ingesta_bd lo llama al escribir y además lo publica con NOTIFY para los demás procesos (ver escuchar()).
+    - Generación por región: invalidar() la incrementa; guardar() descarta un resultado calculado
+      antes de una invalidación (ver generacion()), para no servir una lectura anterior a la ingesta.
+    - Contadores de aciertos, fallos, desalojos e invalidaciones en metricas().
+    """
+
+    def __init__(self, max_mb: float = CACHE_REGIONES_MAX_MB, ttl_segundos: float = CACHE_REGIONES_TTL_S):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_segundos = ttl_segundos
+        self._candado = threading.Lock()
+        self._entradas = OrderedDict()
+        self._por_region = {}
+        self._generaciones = {}
+        self._limpiezas = 0
+        self._bytes = 0
+        self._oyente = None
+
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+
+    @staticmethod
+    def clave(pais: str, departamento: str, ciudad: str, consulta: str, *parametros) -> tuple:
+        texto = json.dumps(parametros, sort_keys=True, default=str, ensure_ascii=False)
+        return (region(pais, departamento, ciudad), consulta, texto)
+
+    def obtener(self, clave_cache: tuple):
+        """Retorna el valor guardado o None si no existe o expiró."""
+        ahora = time.time()
+        with self._candado:
+            entrada = self._entradas.get(clave_cache)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            valor, creado, _ = entrada
+            if ahora - creado > self.ttl_segundos:
+                self._quitar(clave_cache)
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave_cache)
+            self.aciertos += 1
+            return valor
+
+    def generacion(self, clave_cache: tuple) -> tuple:
+        """Generación de la región de la clave; se toma antes de calcular el valor a guardar."""
+        with self._candado:
+            return (self._limpiezas, self._generaciones.get(clave_cache[0], 0))
+
+    def guardar(self, clave_cache: tuple, valor, generacion: tuple = None):
+        """
+        Guarda un valor y desaloja los menos usados recientemente si se supera max_bytes.
+        Con `generacion` (de generacion()), no guarda si la región se invalidó mientras se calculaba.
+        """
+        if valor is None:
+            return
+        tamaño = _tamaño(valor)
+        if tamaño > self.max_bytes:
+            return
+        with self._candado:
+            if generacion is not None and generacion != (self._limpiezas, self._generaciones.get(clave_cache[0], 0)):
+                return
+            if clave_cache in self._entradas:
+                self._quitar(clave_cache)
+            self._entradas[clave_cache] = (valor, time.time(), tamaño)
+            self._por_region.setdefault(clave_cache[0], set()).add(clave_cache)
+            self._bytes += tamaño
+            while self._bytes > self.max_bytes:
+                self._quitar(next(iter(self._entradas)))
+                self.desalojos += 1
+
+    def _quitar(self, clave_cache: tuple):
+        _, _, tamaño = self._entradas.pop(clave_cache)
+        self._bytes -= tamaño
+        claves = self._por_region.get(clave_cache[0])
+        if claves is not None:
+            claves.discard(clave_cache)
+            if not claves:
+                del self._por_region[clave_cache[0]]
+
+    def invalidar(self, pais: str, departamento: str, ciudad: str) -> int:
+        """
+        Descarta todas las entradas de la región y las de su departamento y país completos
+        (p. ej. estadísticas por departamento); retorna cuántas había.
+        """
+        clave_pais, clave_departamento, clave_ciudad = region(pais, departamento, ciudad)
+        regiones = [(clave_pais, clave_departamento, clave_ciudad),
+                    (clave_pais, clave_departamento, ""), (clave_pais, "", "")]
+        with self._candado:
+            for r in regiones:
+                self._generaciones[r] = self._generaciones.get(r, 0) + 1
+            claves = [clave_cache for r in regiones for clave_cache in self._por_region.get(r, ())]
+            for clave_cache in claves:
+                self._quitar(clave_cache)
+            if claves:
+                self.invalidaciones += 1
+        return len(claves)
+
+    def limpiar(self):
+        with self._candado:
+            self._entradas.clear()
+            self._por_region.clear()
+            self._bytes = 0
+            self._limpiezas += 1
+
+    def escuchar(self, config: dict):
+        """
+        Inicia (una vez) un hilo que escucha CANAL_INVALIDACION en PostgreSQL e invalida las
+        regiones que escriben otros procesos. Si la conexión se pierde, se vacía la caché
+        (pudo perderse algún aviso) y se reconecta.
+        """
+        if not CACHE_REGIONES_ESCUCHAR:
+            return
+        with self._candado:
+            if self._oyente is not None:
+                return
+            self._oyente = threading.Thread(target=self._escuchar, args=(config,), daemon=True, name="cache_regiones")
+        self._oyente.start()
+
+    def _escuchar(self, config: dict):
+        while True:
+            conexion = None
+            try:
+                conexion = psycopg2.connect(**config)
+                conexion.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conexion.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CANAL_INVALIDACION}")
+                self.limpiar()
+                while True:
+                    if select.select([conexion], [], [], 60) == ([], [], []):
+                        continue
+                    conexion.poll()
+                    while conexion.notifies:
+                        aviso = conexion.notifies.pop(0)
+                        self.invalidar(*json.loads(aviso.payload))
+            except Exception as e:
+                print(f"⚠️ Caché de regiones: escucha de invalidaciones interrumpida ({e}); reintento en 10 s")
+                time.sleep(10)
+            finally:
+                if conexion is not None and not conexion.closed:
+                    conexion.close()
+
+    def metricas(self) -> dict:
+        with self._candado:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._entradas),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / consultas, 3) if consultas else None,
+                "desalojos": self.desalojos,
+                "invalidaciones": self.invalidaciones,
+                "escuchando": self._oyente is not None and self._oyente.is_alive(),
+            }
+
+
+cache_regiones = CacheRegiones()
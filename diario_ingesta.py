@@ -0,0 +1,169 @@
+import psycopg2.extensions
+from psycopg2.extras import execute_batch, execute_values
+from typing import Dict, Iterable, List
+from cache_regiones import clave_region
+
+
+# Estados de una celda dentro de una ingesta
+#################################
+
+PENDIENTE = "pendiente"
+COMPLETADA = "completada"
+FALLIDA = "fallida"
+
+
+def clave_ingesta(pais: str, departamento: str, ciudad: str, tamaño_celda_m: int,
+                  fecha_inicio: str, fecha_fin: str) -> str:
+    """
+    Identificador de una ingesta: región (normalizada con clave_region, como las claves de
+    celdas), tamaño de grilla y rango de fechas.
+    """
+    return (f"{clave_region(pais)}|{clave_region(departamento)}|{clave_region(ciudad)}|"
+            f"{tamaño_celda_m}m|{fecha_inicio}|{fecha_fin}")
+
+
+def progreso_ingesta(conexion, id_ingesta: str) -> Dict[str, int]:
+    """Cantidad de celdas por estado de una ingesta (se puede leer desde otro proceso)."""
+    with conexion.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute("""
+            SELECT estado, COUNT(*) FROM ingesta_celdas WHERE id_ingesta = %s GROUP BY estado;
+        """, (id_ingesta,))
+        conteo = {PENDIENTE: 0, COMPLETADA: 0, FALLIDA: 0}
+        conteo.update(dict(cursor.fetchall()))
+    return conteo
+
+
+def ingesta_en_curso(conexion, pais: str, departamento: str, ciudad: str) -> bool:
+    """
+    True si el diario tiene una ingesta de la región sin terminar: en ejecución o interrumpida.
+    La región ya tiene celdas desde el primer lote, pero no está completa.
+    """
+    with conexion.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        cursor.execute("SELECT to_regclass('ingestas') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return False
+        cursor.execute("""
+            SELECT 1 FROM ingestas
+            WHERE estado = 'en_curso'
+              AND clave_region(pais_region) = clave_region(%s)
+              AND clave_region(departamento_region) = clave_region(%s)
+              AND clave_region(ciudad_region) = clave_region(%s)
+            LIMIT 1;
+        """, (pais, departamento, ciudad))
+        return cursor.fetchone() is not None
+
+
+# Diario de ingesta
+#################################
+
+class DiarioIngesta:
+    """
+    Diario persistente (PostgreSQL) de una ingesta de región.
+
+    Registra el estado de cada celda (pendiente, completada o fallida) para que
+    una ingesta interrumpida se pueda reanudar sin repetir las celdas ya escritas.
+    Las celdas fallidas quedan en una cola de reintento (ver fallidas()) con el
+    número de intentos y el último error.
+    """
+
+    def __init__(self, conexion, pais: str, departamento: str, ciudad: str,
+                 tamaño_celda_m: int, fecha_inicio: str, fecha_fin: str):
+        self.id_ingesta = clave_ingesta(pais, departamento, ciudad, tamaño_celda_m, fecha_inicio, fecha_fin)
+        self.conexion = conexion
+        self.cursor = self.conexion.cursor()
+        self._crear_tablas()
+        self.cursor.execute("""
+            INSERT INTO ingestas (id_ingesta, pais_region, departamento_region, ciudad_region,
+                                  tamaño_celda_m, fecha_inicio, fecha_fin, estado)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 'en_curso')
+            ON CONFLICT (id_ingesta) DO UPDATE SET estado = 'en_curso', actualizado = NOW();
+        """, (self.id_ingesta, pais, departamento, ciudad, tamaño_celda_m, fecha_inicio, fecha_fin))
+        self.conexion.commit()
+
+    def _crear_tablas(self):
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingestas (
+                id_ingesta TEXT PRIMARY KEY,
+                pais_region TEXT NOT NULL,
+                departamento_region TEXT NOT NULL,
+                ciudad_region TEXT NOT NULL,
+                tamaño_celda_m INTEGER NOT NULL,
+                fecha_inicio DATE NOT NULL,
+                fecha_fin DATE NOT NULL,
+                estado TEXT NOT NULL,
+                creado TIMESTAMP NOT NULL DEFAULT NOW(),
+                actualizado TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            CREATE TABLE IF NOT EXISTS ingesta_celdas (
+                id_ingesta TEXT NOT NULL REFERENCES ingestas (id_ingesta) ON DELETE CASCADE,
+                id_celda BIGINT NOT NULL,
+                estado TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                actualizado TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id_ingesta, id_celda)
+            );
+            CREATE INDEX IF NOT EXISTS idx_ingesta_celdas_estado ON ingesta_celdas (id_ingesta, estado);
+        """)
+        self.conexion.commit()
+
+    def registrar(self, ids_celdas: Iterable[int]):
+        """Registra las celdas de la grilla como pendientes (las ya registradas conservan su estado)."""
+        execute_values(self.cursor, """
+            INSERT INTO ingesta_celdas (id_ingesta, id_celda, estado)
+            VALUES %s
+            ON CONFLICT (id_ingesta, id_celda) DO NOTHING;
+        """, [(self.id_ingesta, id_celda, PENDIENTE) for id_celda in ids_celdas], page_size=1000)
+        self.conexion.commit()
+
+    def estados(self) -> Dict[int, str]:
+        """Retorna {id_celda: estado} de todas las celdas de la ingesta."""
+        self.cursor.execute(
+            "SELECT id_celda, estado FROM ingesta_celdas WHERE id_ingesta = %s", (self.id_ingesta,)
+        )
+        return dict(self.cursor.fetchall())
+
+    def marcar(self, completadas: List[int], fallidas: Dict[int, str]):
+        """Marca celdas como completadas y envía las fallidas ({id_celda: error}) a la cola de reintento."""
+        if completadas:
+            self.cursor.execute("""
+                UPDATE ingesta_celdas
+                SET estado = %s, intentos = intentos + 1, ultimo_error = NULL, actualizado = NOW()
+                WHERE id_ingesta = %s AND id_celda = ANY(%s);
+            """, (COMPLETADA, self.id_ingesta, list(completadas)))
+        if fallidas:
+            execute_batch(self.cursor, """
+                UPDATE ingesta_celdas
+                SET estado = %s, intentos = intentos + 1, ultimo_error = %s, actualizado = NOW()
+                WHERE id_ingesta = %s AND id_celda = %s;
+            """, [(FALLIDA, error, self.id_ingesta, id_celda) for id_celda, error in fallidas.items()],
+                page_size=1000)
+        self.conexion.commit()
+
+    def fallidas(self) -> Dict[int, Dict]:
+        """Cola de reintento: {id_celda: {'intentos', 'ultimo_error'}} de las celdas fallidas."""
+        self.cursor.execute("""
+            SELECT id_celda, intentos, ultimo_error FROM ingesta_celdas
+            WHERE id_ingesta = %s AND estado = %s;
+        """, (self.id_ingesta, FALLIDA))
+        return {id_celda: {'intentos': intentos, 'ultimo_error': error}
+                for id_celda, intentos, error in self.cursor.fetchall()}
+
+    def progreso(self) -> Dict[str, int]:
+        """Cantidad de celdas por estado."""
+        return progreso_ingesta(self.conexion, self.id_ingesta)
+
+    def finalizar(self) -> Dict[str, int]:
+        """Cierra la ejecución: la ingesta queda 'completa' o 'con_fallos' según el estado de sus celdas."""
+        conteo = self.progreso()
+        estado = 'completa' if conteo[PENDIENTE] == 0 and conteo[FALLIDA] == 0 else 'con_fallos'
+        self.cursor.execute(
+            "UPDATE ingestas SET estado = %s, actualizado = NOW() WHERE id_ingesta = %s",
+            (estado, self.id_ingesta)
+        )
+        self.conexion.commit()
+        return conteo
+
+    def cerrar(self):
+        """Cierra el cursor; la conexión es de quien creó el diario."""
+        self.cursor.close()
@@ -0,0 +1,600 @@
+import psycopg2
+import psycopg2.extensions
+
+
+# Migraciones versionadas del esquema de PostgreSQL
+#################################
+# Cada migración es (versión, descripción, SQL). Se aplican en orden, una sola
+# vez, y quedan registradas en esquema_version.
+
+MIGRACIONES = [
+    (1, "Separar geometría estática de celdas del clima mensual", """
+        CREATE TABLE IF NOT EXISTS celdas (
+            id_celda TEXT PRIMARY KEY,
+            pais_region TEXT,
+            departamento_region TEXT,
+            ciudad_region TEXT,
+            geometria GEOMETRY(Polygon, 4326),
+            centroide GEOMETRY(Point, 4326),
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            area_m2 DOUBLE PRECISION,
+            elevacion_promedio DOUBLE PRECISION,
+            puntuacion_calidad_datos DOUBLE PRECISION,
+            ultima_actualizacion TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS clima_mensual (
+            id_celda TEXT NOT NULL REFERENCES celdas (id_celda) ON DELETE CASCADE,
+            fecha DATE NOT NULL,
+            temp_promedio DOUBLE PRECISION,
+            precipitacion_promedio DOUBLE PRECISION,
+            humedad_promedio DOUBLE PRECISION,
+            viento_promedio DOUBLE PRECISION,
+            ultima_actualizacion TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (id_celda, fecha)
+        );
+
+        -- Migrar los datos de la tabla anterior (una fila por celda y mes) si existe
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.tables
+                WHERE table_schema = current_schema()
+                  AND table_name = 'celdas_terreno'
+                  AND table_type = 'BASE TABLE'
+            ) THEN
+                INSERT INTO celdas (
+                    id_celda, pais_region, departamento_region, ciudad_region,
+                    geometria, centroide, lat, lon, area_m2,
+                    elevacion_promedio, puntuacion_calidad_datos, ultima_actualizacion
+                )
+                SELECT DISTINCT ON (id_celda)
+                    id_celda, pais_region, departamento_region, ciudad_region,
+                    geometria, centroide, ST_Y(centroide), ST_X(centroide), area_m2,
+                    elevacion_promedio, puntuacion_calidad_datos, ultima_actualizacion
+                FROM celdas_terreno
+                ORDER BY id_celda, fecha DESC
+                ON CONFLICT (id_celda) DO NOTHING;
+
+                INSERT INTO clima_mensual (
+                    id_celda, fecha, temp_promedio, precipitacion_promedio,
+                    humedad_promedio, viento_promedio, ultima_actualizacion
+                )
+                SELECT
+                    id_celda, fecha, temp_promedio, precipitacion_promedio,
+                    humedad_promedio, viento_promedio, ultima_actualizacion
+                FROM celdas_terreno
+                ON CONFLICT (id_celda, fecha) DO NOTHING;
+
+                ALTER TABLE celdas_terreno RENAME TO celdas_terreno_legacy;
+            END IF;
+        END $$;
+
+        -- Vista de compatibilidad con el formato anterior (una fila por celda y mes)
+        CREATE OR REPLACE VIEW celdas_terreno AS
+        SELECT
+            c.id_celda, c.pais_region, c.departamento_region, c.ciudad_region,
+            c.geometria, c.centroide, c.lat, c.lon, c.area_m2,
+            m.fecha, m.temp_promedio, m.precipitacion_promedio, m.humedad_promedio,
+            c.elevacion_promedio, m.viento_promedio, c.puntuacion_calidad_datos,
+            m.ultima_actualizacion
+        FROM celdas c
+        JOIN clima_mensual m ON m.id_celda = c.id_celda;
+
+        CREATE INDEX IF NOT EXISTS idx_celdas_geometria ON celdas USING GIST (geometria);
+        CREATE INDEX IF NOT EXISTS idx_celdas_region ON celdas (pais_region, departamento_region, ciudad_region);
+    """),
+    (2, "Caché local de límites GAUL nivel 2", """
+        CREATE TABLE IF NOT EXISTS limites_gaul (
+            adm0_name TEXT NOT NULL,
+            adm1_name TEXT NOT NULL,
+            adm2_name TEXT NOT NULL,
+            lon_min DOUBLE PRECISION NOT NULL,
+            lat_min DOUBLE PRECISION NOT NULL,
+            lon_max DOUBLE PRECISION NOT NULL,
+            lat_max DOUBLE PRECISION NOT NULL,
+            geometria GEOMETRY(MultiPolygon, 4326),
+            cargado TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (adm0_name, adm1_name, adm2_name)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_limites_gaul_nombres
+            ON limites_gaul (UPPER(adm0_name), UPPER(adm1_name), UPPER(adm2_name));
+        CREATE INDEX IF NOT EXISTS idx_limites_gaul_geometria ON limites_gaul USING GIST (geometria);
+    """),
+    (3, "ids de celda BIGINT de la grilla global (ver indice_celdas.py); celdas y diario de ingesta se re-ingestan", """
+        -- Mismas fórmulas que indice_celdas.py: id = (tamaño_m << 44) | (fila << 22) | columna
+        CREATE OR REPLACE FUNCTION celda_columnas(tamaño_m INTEGER, fila INTEGER) RETURNS INTEGER AS $$
+            SELECT GREATEST(1, FLOOR(360 * 111319.49 * COS(RADIANS(-90 + (fila + 0.5) * tamaño_m / 111319.49)) / tamaño_m))::INTEGER
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+        CREATE OR REPLACE FUNCTION celda_id(tamaño_m INTEGER, lon DOUBLE PRECISION, lat DOUBLE PRECISION) RETURNS BIGINT AS $$
+            SELECT (tamaño_m::BIGINT << 44) | (f.fila::BIGINT << 22)
+                   | LEAST(FLOOR((lon + 180) / (360.0 / celda_columnas(tamaño_m, f.fila))),
+                           celda_columnas(tamaño_m, f.fila) - 1)::BIGINT
+            FROM (SELECT FLOOR((lat + 90) * 111319.49 / tamaño_m)::INTEGER AS fila) f
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+        CREATE OR REPLACE FUNCTION celda_poligono(id BIGINT) RETURNS GEOMETRY AS $$
+            SELECT ST_MakeEnvelope(
+                -180 + p.columna * d.ancho, -90 + p.fila * d.alto,
+                -180 + (p.columna + 1) * d.ancho, -90 + (p.fila + 1) * d.alto, 4326)
+            FROM (SELECT (id >> 44)::INTEGER AS tamaño_m, ((id >> 22) & 4194303)::INTEGER AS fila,
+                         (id & 4194303)::INTEGER AS columna) p,
+                 LATERAL (SELECT p.tamaño_m / 111319.49 AS alto,
+                                 360.0 / celda_columnas(p.tamaño_m, p.fila) AS ancho) d
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+        CREATE OR REPLACE FUNCTION celda_centroide(id BIGINT) RETURNS GEOMETRY AS $$
+            SELECT ST_Centroid(celda_poligono(id))
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+        CREATE TABLE celdas_nueva (
+            id_celda BIGINT PRIMARY KEY,
+            pais_region TEXT,
+            departamento_region TEXT,
+            ciudad_region TEXT,
+            geometria GEOMETRY(Polygon, 4326),
+            centroide GEOMETRY(Point, 4326),
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            area_m2 DOUBLE PRECISION,
+            elevacion_promedio DOUBLE PRECISION,
+            puntuacion_calidad_datos DOUBLE PRECISION,
+            ultima_actualizacion TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE clima_mensual_nueva (
+            id_celda BIGINT NOT NULL REFERENCES celdas_nueva (id_celda) ON DELETE CASCADE,
+            fecha DATE NOT NULL,
+            temp_promedio DOUBLE PRECISION,
+            precipitacion_promedio DOUBLE PRECISION,
+            humedad_promedio DOUBLE PRECISION,
+            viento_promedio DOUBLE PRECISION,
+            ultima_actualizacion TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (id_celda, fecha)
+        );
+
+        -- Las celdas anteriores no se convierten: su huella no coincide con la de ninguna
+        -- celda de la grilla global (varias caerían en la misma celda y el clima se habría
+        -- medido sobre otra superficie). Las tablas nuevas empiezan vacías y las regiones se
+        -- vuelven a ingestar: existe_region() no encuentra celdas y el agente encola la
+        -- ingesta al pedirla. Los datos anteriores (ids de texto) se conservan en celdas_v1 y
+        -- clima_mensual_v1.
+        DROP VIEW IF EXISTS celdas_terreno;
+        ALTER TABLE clima_mensual RENAME TO clima_mensual_v1;
+        ALTER TABLE celdas RENAME TO celdas_v1;
+        ALTER INDEX IF EXISTS idx_celdas_geometria RENAME TO idx_celdas_v1_geometria;
+        ALTER INDEX IF EXISTS idx_celdas_region RENAME TO idx_celdas_v1_region;
+        ALTER TABLE celdas_nueva RENAME TO celdas;
+        ALTER TABLE clima_mensual_nueva RENAME TO clima_mensual;
+
+        CREATE INDEX idx_celdas_geometria ON celdas USING GIST (geometria);
+        CREATE INDEX idx_celdas_region ON celdas (pais_region, departamento_region, ciudad_region);
+
+        CREATE VIEW celdas_terreno AS
+        SELECT
+            c.id_celda, c.pais_region, c.departamento_region, c.ciudad_region,
+            c.geometria, c.centroide, c.lat, c.lon, c.area_m2,
+            m.fecha, m.temp_promedio, m.precipitacion_promedio, m.humedad_promedio,
+            c.elevacion_promedio, m.viento_promedio, c.puntuacion_calidad_datos,
+            m.ultima_actualizacion
+        FROM celdas c
+        JOIN clima_mensual m ON m.id_celda = c.id_celda;
+
+        -- Se reinicia el diario de ingesta: sus ids de texto ya no corresponden a ninguna
+        -- celda, y una ingesta 'completa' no debe saltar celdas que ya no existen.
+        -- Borrar las ingestas borra sus celdas (ON DELETE CASCADE).
+        DO $$
+        BEGIN
+            IF to_regclass('ingestas') IS NOT NULL THEN
+                DELETE FROM ingestas;
+            END IF;
+            IF to_regclass('ingesta_celdas') IS NOT NULL THEN
+                ALTER TABLE ingesta_celdas ALTER COLUMN id_celda TYPE BIGINT USING NULL;
+            END IF;
+        END $$;
+        DROP TABLE IF EXISTS celdas_terreno_staging;
+    """),
+    (4, "Claves de región normalizadas y celdas particionadas por país/departamento", """
+        CREATE EXTENSION IF NOT EXISTS unaccent SCHEMA public;
+
+        -- Clave de búsqueda de una región: sin tildes, en mayúsculas y sin espacios extremos.
+        -- unaccent con diccionario explícito para poder declararla IMMUTABLE
+        CREATE OR REPLACE FUNCTION clave_region(texto TEXT) RETURNS TEXT AS $$
+            SELECT UPPER(public.unaccent('public.unaccent'::regdictionary, BTRIM(texto)))
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE STRICT;
+
+        -- Crea (si falta) la partición del país y la subpartición del departamento.
+        -- Se llama antes de insertar celdas de una región nueva (ver ingesta_bd.insertar_celdas).
+        CREATE OR REPLACE FUNCTION asegurar_particion_celdas(pais TEXT, departamento TEXT) RETURNS VOID AS $$
+        DECLARE
+            clave_pais TEXT := clave_region(pais);
+            clave_departamento TEXT := clave_region(departamento);
+            tabla_pais TEXT := format('celdas_%s_%s',
+                left(regexp_replace(lower(clave_pais), '[^a-z0-9]+', '_', 'g'), 24),
+                left(md5(clave_pais), 6));
+            tabla_departamento TEXT := format('%s_%s_%s', tabla_pais,
+                left(regexp_replace(lower(clave_departamento), '[^a-z0-9]+', '_', 'g'), 20),
+                left(md5(clave_departamento), 6));
+        BEGIN
+            IF to_regclass(tabla_departamento) IS NOT NULL THEN
+                RETURN;
+            END IF;
+            -- Serializa la creación entre procesos que ingestan en paralelo
+            PERFORM pg_advisory_xact_lock(hashtext('asegurar_particion_celdas'));
+            IF to_regclass(tabla_pais) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF celdas FOR VALUES IN (%L) PARTITION BY LIST (departamento_clave)',
+                               tabla_pais, clave_pais);
+            END IF;
+            IF to_regclass(tabla_departamento) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%L)',
+                               tabla_departamento, tabla_pais, clave_departamento);
+            END IF;
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- clima_mensual deja de referenciar a celdas: en una tabla particionada el id
+        -- de celda solo es único junto con la clave de partición
+        DROP VIEW IF EXISTS celdas_terreno;
+        DO $$
+        DECLARE
+            restriccion RECORD;
+        BEGIN
+            FOR restriccion IN
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = 'clima_mensual'::regclass AND contype = 'f'
+            LOOP
+                EXECUTE format('ALTER TABLE clima_mensual DROP CONSTRAINT %I', restriccion.conname);
+            END LOOP;
+        END $$;
+
+        ALTER TABLE celdas RENAME TO celdas_v3;
+        ALTER INDEX IF EXISTS idx_celdas_geometria RENAME TO idx_celdas_v3_geometria;
+        ALTER INDEX IF EXISTS idx_celdas_region RENAME TO idx_celdas_v3_region;
+
+        CREATE TABLE celdas (
+            id_celda BIGINT NOT NULL,
+            pais_region TEXT NOT NULL,
+            departamento_region TEXT NOT NULL,
+            ciudad_region TEXT NOT NULL,
+            pais_clave TEXT NOT NULL,
+            departamento_clave TEXT NOT NULL,
+            ciudad_clave TEXT NOT NULL,
+            geometria GEOMETRY(Polygon, 4326),
+            centroide GEOMETRY(Point, 4326),
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            area_m2 DOUBLE PRECISION,
+            elevacion_promedio DOUBLE PRECISION,
+            puntuacion_calidad_datos DOUBLE PRECISION,
+            ultima_actualizacion TIMESTAMP DEFAULT NOW(),
+            CONSTRAINT pk_celdas_region PRIMARY KEY (id_celda, pais_clave, departamento_clave)
+        ) PARTITION BY LIST (pais_clave);
+
+        -- Los índices del padre se crean en cada partición
+        CREATE INDEX idx_celdas_clave_region ON celdas (pais_clave, departamento_clave, ciudad_clave, id_celda);
+        CREATE INDEX idx_celdas_geometria ON celdas USING GIST (geometria);
+
+        SELECT asegurar_particion_celdas(pais_region, departamento_region)
+        FROM (
+            SELECT DISTINCT pais_region, departamento_region FROM celdas_v3
+            WHERE pais_region IS NOT NULL AND departamento_region IS NOT NULL
+        ) regiones;
+
+        INSERT INTO celdas (
+            id_celda, pais_region, departamento_region, ciudad_region,
+            pais_clave, departamento_clave, ciudad_clave,
+            geometria, centroide, lat, lon, area_m2,
+            elevacion_promedio, puntuacion_calidad_datos, ultima_actualizacion
+        )
+        SELECT
+            id_celda, pais_region, departamento_region, COALESCE(ciudad_region, ''),
+            clave_region(pais_region), clave_region(departamento_region), COALESCE(clave_region(ciudad_region), ''),
+            geometria, centroide, lat, lon, area_m2,
+            elevacion_promedio, puntuacion_calidad_datos, ultima_actualizacion
+        FROM celdas_v3
+        WHERE pais_region IS NOT NULL AND departamento_region IS NOT NULL;
+
+        DROP TABLE celdas_v3;
+
+        CREATE VIEW celdas_terreno AS
+        SELECT
+            c.id_celda, c.pais_region, c.departamento_region, c.ciudad_region,
+            c.pais_clave, c.departamento_clave, c.ciudad_clave,
+            c.geometria, c.centroide, c.lat, c.lon, c.area_m2,
+            m.fecha, m.temp_promedio, m.precipitacion_promedio, m.humedad_promedio,
+            c.elevacion_promedio, m.viento_promedio, c.puntuacion_calidad_datos,
+            m.ultima_actualizacion
+        FROM celdas c
+        JOIN clima_mensual m ON m.id_celda = c.id_celda;
+
+        -- Nombres GAUL: la misma clave para buscar límites sin UPPER() en cada consulta
+        DROP INDEX IF EXISTS idx_limites_gaul_nombres;
+        CREATE INDEX idx_limites_gaul_claves
+            ON limites_gaul (clave_region(adm0_name), clave_region(adm1_name), clave_region(adm2_name));
+    """),
+    (5, "Puntaje de idoneidad por rango en SQL (igual a funciones.calcular_score_ponderado)", """
+        -- 100 dentro de [minimo, maximo] (o si el rango es nulo); fuera, baja 3 puntos por
+        -- cada 1 % del rango de distancia, sin bajar de 0. Un valor NULL puntúa 0.
+        CREATE OR REPLACE FUNCTION puntaje_rango(valor DOUBLE PRECISION, minimo DOUBLE PRECISION,
+                                                 maximo DOUBLE PRECISION) RETURNS DOUBLE PRECISION AS $$
+            SELECT CASE
+                WHEN maximo - minimo = 0 THEN 100.0
+                WHEN valor BETWEEN minimo AND maximo THEN 100.0
+                WHEN valor IS NULL THEN 0.0
+                WHEN valor < minimo THEN GREATEST(0.0, 100.0 - 3 * 100.0 * (minimo - valor) / (maximo - minimo))
+                ELSE GREATEST(0.0, 100.0 - 3 * 100.0 * (valor - maximo) / (maximo - minimo))
+            END
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+    """),
+    (6, "Resumen climático materializado por celda", """
+        -- Una fila por celda: matriz mensual (12 valores, promedio de cada mes del año entre
+        -- los años ingestados) y estadísticas anuales sobre todas las filas mensuales.
+        CREATE TABLE IF NOT EXISTS resumen_clima_celda (
+            id_celda BIGINT PRIMARY KEY,
+            meses INTEGER NOT NULL,
+            fecha_inicio DATE NOT NULL,
+            fecha_fin DATE NOT NULL,
+            temp_mensual DOUBLE PRECISION[] NOT NULL,
+            precipitacion_mensual DOUBLE PRECISION[] NOT NULL,
+            humedad_mensual DOUBLE PRECISION[] NOT NULL,
+            viento_mensual DOUBLE PRECISION[] NOT NULL,
+            temp_promedio DOUBLE PRECISION,
+            temp_min DOUBLE PRECISION,
+            temp_max DOUBLE PRECISION,
+            temp_desviacion DOUBLE PRECISION,
+            precipitacion_promedio DOUBLE PRECISION,
+            precipitacion_min DOUBLE PRECISION,
+            precipitacion_max DOUBLE PRECISION,
+            precipitacion_desviacion DOUBLE PRECISION,
+            humedad_promedio DOUBLE PRECISION,
+            humedad_min DOUBLE PRECISION,
+            humedad_max DOUBLE PRECISION,
+            humedad_desviacion DOUBLE PRECISION,
+            viento_promedio DOUBLE PRECISION,
+            viento_min DOUBLE PRECISION,
+            viento_max DOUBLE PRECISION,
+            viento_desviacion DOUBLE PRECISION,
+            actualizado TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+
+        -- Recalcula el resumen solo de las celdas indicadas (ver ingesta_bd.insertar_celdas)
+        CREATE OR REPLACE FUNCTION refrescar_resumen_clima(ids BIGINT[]) RETURNS VOID AS $$
+        BEGIN
+            DELETE FROM resumen_clima_celda r
+            WHERE r.id_celda = ANY(ids)
+              AND NOT EXISTS (SELECT 1 FROM clima_mensual m WHERE m.id_celda = r.id_celda);
+
+            INSERT INTO resumen_clima_celda (
+                id_celda, meses, fecha_inicio, fecha_fin,
+                temp_mensual, precipitacion_mensual, humedad_mensual, viento_mensual,
+                temp_promedio, temp_min, temp_max, temp_desviacion,
+                precipitacion_promedio, precipitacion_min, precipitacion_max, precipitacion_desviacion,
+                humedad_promedio, humedad_min, humedad_max, humedad_desviacion,
+                viento_promedio, viento_min, viento_max, viento_desviacion
+            )
+            WITH por_mes AS (
+                SELECT id_celda, EXTRACT(MONTH FROM fecha)::INTEGER AS mes,
+                       AVG(temp_promedio) AS temp, AVG(precipitacion_promedio) AS precipitacion,
+                       AVG(humedad_promedio) AS humedad, AVG(viento_promedio) AS viento
+                FROM clima_mensual
+                WHERE id_celda = ANY(ids)
+                GROUP BY id_celda, mes
+            ),
+            matriz AS (
+                -- Siempre 12 posiciones (enero..diciembre); NULL si el mes no tiene datos
+                SELECT i.id_celda,
+                       array_agg(p.temp ORDER BY s.mes) AS temp,
+                       array_agg(p.precipitacion ORDER BY s.mes) AS precipitacion,
+                       array_agg(p.humedad ORDER BY s.mes) AS humedad,
+                       array_agg(p.viento ORDER BY s.mes) AS viento
+                FROM (SELECT DISTINCT unnest(ids) AS id_celda) i
+                CROSS JOIN generate_series(1, 12) AS s (mes)
+                LEFT JOIN por_mes p ON p.id_celda = i.id_celda AND p.mes = s.mes
+                GROUP BY i.id_celda
+            ),
+            anual AS (
+                SELECT id_celda, COUNT(*) AS meses, MIN(fecha) AS fecha_inicio, MAX(fecha) AS fecha_fin,
+                       AVG(temp_promedio) AS temp_promedio, MIN(temp_promedio) AS temp_min,
+                       MAX(temp_promedio) AS temp_max, STDDEV_SAMP(temp_promedio) AS temp_desviacion,
+                       AVG(precipitacion_promedio) AS precipitacion_promedio, MIN(precipitacion_promedio) AS precipitacion_min,
+                       MAX(precipitacion_promedio) AS precipitacion_max, STDDEV_SAMP(precipitacion_promedio) AS precipitacion_desviacion,
+                       AVG(humedad_promedio) AS humedad_promedio, MIN(humedad_promedio) AS humedad_min,
+                       MAX(humedad_promedio) AS humedad_max, STDDEV_SAMP(humedad_promedio) AS humedad_desviacion,
+                       AVG(viento_promedio) AS viento_promedio, MIN(viento_promedio) AS viento_min,
+                       MAX(viento_promedio) AS viento_max, STDDEV_SAMP(viento_promedio) AS viento_desviacion
+                FROM clima_mensual
+                WHERE id_celda = ANY(ids)
+                GROUP BY id_celda
+            )
+            SELECT a.id_celda, a.meses, a.fecha_inicio, a.fecha_fin,
+                   m.temp, m.precipitacion, m.humedad, m.viento,
+                   a.temp_promedio, a.temp_min, a.temp_max, a.temp_desviacion,
+                   a.precipitacion_promedio, a.precipitacion_min, a.precipitacion_max, a.precipitacion_desviacion,
+                   a.humedad_promedio, a.humedad_min, a.humedad_max, a.humedad_desviacion,
+                   a.viento_promedio, a.viento_min, a.viento_max, a.viento_desviacion
+            FROM anual a
+            JOIN matriz m ON m.id_celda = a.id_celda
+            ON CONFLICT (id_celda) DO UPDATE SET
+                meses = EXCLUDED.meses, fecha_inicio = EXCLUDED.fecha_inicio, fecha_fin = EXCLUDED.fecha_fin,
+                temp_mensual = EXCLUDED.temp_mensual, precipitacion_mensual = EXCLUDED.precipitacion_mensual,
+                humedad_mensual = EXCLUDED.humedad_mensual, viento_mensual = EXCLUDED.viento_mensual,
+                temp_promedio = EXCLUDED.temp_promedio, temp_min = EXCLUDED.temp_min,
+                temp_max = EXCLUDED.temp_max, temp_desviacion = EXCLUDED.temp_desviacion,
+                precipitacion_promedio = EXCLUDED.precipitacion_promedio, precipitacion_min = EXCLUDED.precipitacion_min,
+                precipitacion_max = EXCLUDED.precipitacion_max, precipitacion_desviacion = EXCLUDED.precipitacion_desviacion,
+                humedad_promedio = EXCLUDED.humedad_promedio, humedad_min = EXCLUDED.humedad_min,
+                humedad_max = EXCLUDED.humedad_max, humedad_desviacion = EXCLUDED.humedad_desviacion,
+                viento_promedio = EXCLUDED.viento_promedio, viento_min = EXCLUDED.viento_min,
+                viento_max = EXCLUDED.viento_max, viento_desviacion = EXCLUDED.viento_desviacion,
+                actualizado = NOW();
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- Carga inicial con los datos ya ingestados
+        SELECT refrescar_resumen_clima(ARRAY(SELECT DISTINCT id_celda FROM clima_mensual));
+    """),
+    (7, "Nombres de particiones de departamento dentro de NAMEDATALEN", """
+        -- Con 24 + 20 caracteres de slug el nombre de un departamento llegaba a 66 caracteres y
+        -- PostgreSQL lo truncaba a 63, recortando el md5. El slug del departamento se acorta
+        -- a 17 caracteres: 'celdas_' + 24 + '_' + 6 + '_' + 17 + '_' + 6 = 63.
+        CREATE OR REPLACE FUNCTION nombre_particion_departamento(tabla_pais TEXT, clave_departamento TEXT)
+        RETURNS TEXT AS $$
+            SELECT format('%s_%s_%s', tabla_pais,
+                left(regexp_replace(lower(clave_departamento), '[^a-z0-9]+', '_', 'g'), 17),
+                left(md5(clave_departamento), 6));
+        $$ LANGUAGE sql IMMUTABLE;
+
+        CREATE OR REPLACE FUNCTION asegurar_particion_celdas(pais TEXT, departamento TEXT) RETURNS VOID AS $$
+        DECLARE
+            clave_pais TEXT := clave_region(pais);
+            clave_departamento TEXT := clave_region(departamento);
+            tabla_pais TEXT := format('celdas_%s_%s',
+                left(regexp_replace(lower(clave_pais), '[^a-z0-9]+', '_', 'g'), 24),
+                left(md5(clave_pais), 6));
+            tabla_departamento TEXT := nombre_particion_departamento(tabla_pais, clave_departamento);
+        BEGIN
+            IF to_regclass(tabla_departamento) IS NOT NULL THEN
+                RETURN;
+            END IF;
+            -- Serializa la creación entre procesos que ingestan en paralelo
+            PERFORM pg_advisory_xact_lock(hashtext('asegurar_particion_celdas'));
+            IF to_regclass(tabla_pais) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF celdas FOR VALUES IN (%L) PARTITION BY LIST (departamento_clave)',
+                               tabla_pais, clave_pais);
+            END IF;
+            IF to_regclass(tabla_departamento) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%L)',
+                               tabla_departamento, tabla_pais, clave_departamento);
+            END IF;
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- Renombrar las particiones de departamento existentes (la clave sale de su rango)
+        DO $$
+        DECLARE
+            particion RECORD;
+            nombre_nuevo TEXT;
+        BEGIN
+            FOR particion IN
+                SELECT pais.relname AS tabla_pais, departamento.relname AS tabla_departamento,
+                       replace(substring(pg_get_expr(departamento.relpartbound, departamento.oid)
+                                         FROM '^FOR VALUES IN \\(''(.*)''\\)$'), '''''', '''') AS clave_departamento
+                FROM pg_inherits h_pais
+                JOIN pg_class pais ON pais.oid = h_pais.inhrelid
+                JOIN pg_inherits h_departamento ON h_departamento.inhparent = pais.oid
+                JOIN pg_class departamento ON departamento.oid = h_departamento.inhrelid
+                WHERE h_pais.inhparent = 'celdas'::regclass AND departamento.relkind = 'r'
+            LOOP
+                CONTINUE WHEN particion.clave_departamento IS NULL;
+                nombre_nuevo := nombre_particion_departamento(particion.tabla_pais, particion.clave_departamento);
+                IF nombre_nuevo <> particion.tabla_departamento THEN
+                    EXECUTE format('ALTER TABLE %I RENAME TO %I', particion.tabla_departamento, nombre_nuevo);
+                END IF;
+            END LOOP;
+        END $$;
+    """),
+    (8, "Una fila de celdas por ciudad: la ciudad entra en la clave primaria", """
+        -- Con ids globales, una celda que cruza el límite entre dos ciudades del mismo
+        -- departamento tiene el mismo id en ambas. Con la clave (id, país, departamento) la
+        -- segunda ingesta actualizaba la fila de la primera y la celda quedaba solo en la
+        -- primera ciudad. Con la ciudad en la clave, cada ciudad tiene su fila; el clima
+        -- (clima_mensual, por id) se comparte. Las celdas de borde que ya se perdieron
+        -- vuelven al re-ingestar la segunda ciudad.
+        ALTER TABLE celdas DROP CONSTRAINT pk_celdas_region;
+        ALTER TABLE celdas ADD CONSTRAINT pk_celdas_region
+            PRIMARY KEY (id_celda, pais_clave, departamento_clave, ciudad_clave);
+    """),
+    (9, "puntaje_rango: un valor faltante puntúa 0 aunque el rango sea nulo", """
+        -- La versión 5 evaluaba el rango nulo antes que el valor NULL y daba 100 a un dato
+        -- faltante. Igual que funciones.calcular_score_ponderado, NULL (o NaN) puntúa 0 primero.
+        CREATE OR REPLACE FUNCTION puntaje_rango(valor DOUBLE PRECISION, minimo DOUBLE PRECISION,
+                                                 maximo DOUBLE PRECISION) RETURNS DOUBLE PRECISION AS $$
+            SELECT CASE
+                WHEN valor IS NULL OR valor = 'NaN' THEN 0.0
+                WHEN maximo - minimo = 0 THEN 100.0
+                WHEN valor BETWEEN minimo AND maximo THEN 100.0
+                WHEN valor < minimo THEN GREATEST(0.0, 100.0 - 3 * 100.0 * (minimo - valor) / (maximo - minimo))
+                ELSE GREATEST(0.0, 100.0 - 3 * 100.0 * (valor - maximo) / (maximo - minimo))
+            END
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+    """),
+]
+
+
+# Candado transaccional de PostgreSQL (pg_advisory_xact_lock) que serializa las migraciones entre
+# procesos: los trabajadores de ingesta_lote y de ColaIngestas migran al arrancar
+BLOQUEO_MIGRACIONES = 7465736
+
+
+def _bloquear(cursor):
+    """Espera el candado de migraciones; se libera al terminar la transacción."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (BLOQUEO_MIGRACIONES,))
+
+
+def version_actual(conexion) -> int:
+    with conexion.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        _bloquear(cursor)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS esquema_version (
+                version INTEGER PRIMARY KEY,
+                descripcion TEXT NOT NULL,
+                aplicada TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+        """)
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM esquema_version")
+        version = cursor.fetchone()[0]
+    conexion.commit()
+    return version
+
+
+def migrar(conexion) -> int:
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción y con el candado de
+    migraciones tomado: si otro proceso la aplicó mientras se esperaba, se salta.
+    Retorna la versión final del esquema.
+    """
+    version = version_actual(conexion)
+    for numero, descripcion, sql in MIGRACIONES:
+        if numero <= version:
+            continue
+        try:
+            with conexion.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                _bloquear(cursor)
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM esquema_version")
+                if cursor.fetchone()[0] >= numero:
+                    conexion.commit()
+                    version = numero
+                    continue
+                print(f"🛠️ Aplicando migración {numero}: {descripcion}")
+                cursor.execute(sql)
+                cursor.execute(
+                    "INSERT INTO esquema_version (version, descripcion) VALUES (%s, %s)",
+                    (numero, descripcion)
+                )
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+        version = numero
+    return version
+
+
+_esquema_verificado = False
+
+def asegurar_esquema(conexion):
+    """Ejecuta migrar() una sola vez por proceso."""
+    global _esquema_verificado
+    if _esquema_verificado or conexion is None:
+        return
+    migrar(conexion)
+    _esquema_verificado = True
+
+
+if __name__ == "__main__":
+    import bd
+    conexion = bd.conexion_bd()
+    print(f"✅ Esquema en versión {migrar(conexion)}")
+    conexion.close()
@@ -283,6 +283,7 @@ def calcular_score_ponderado(valor, min_val, max_val):
     Reglas:
     - Dentro del rango [min_val, max_val] = 100 pts
     - Fuera del rango = disminuye proporcionalmente según la distancia al rango
+    - Sin dato (None o NaN) = 0 pts, aunque el rango sea nulo (igual que puntaje_rango en SQL)
     """
     
     try:
@@ -290,6 +291,9 @@ def calcular_score_ponderado(valor, min_val, max_val):
         min_v = float(min_val)
         max_v = float(max_val)
         
+        if np.isnan(val):
+            return 0.0
+        
         rango_total = max_v - min_v
         if rango_total == 0:
             return 100.0
@@ -421,34 +425,42 @@ def evaluar_idoneidad_terreno(df_celdas, reglas):
         # Renombrar score_mes -> score
         df_resultado.rename(columns={'score_mes': 'score'}, inplace=True)
         df_resultado['score'] = df_resultado['score'].round(1)
-        df_resultado['explicacion'] = "Datos insuficientes." # Default pesimista
-        
-        # Generar explicación final
-        # Si el score es bajo pero no hay "motivo_fallo" grave, es por inestabilidad
-        #df_resultado['explicacion'] = "Condiciones óptimas todo el año."
-        
-        # Lógica de explicación
-        mask_bajo = df_resultado['score'] < 60
-        mask_medio = (df_resultado['score'] >= 60) & (df_resultado['score'] < 80)
-        mask_alto = df_resultado['score'] >= 80
-        mask_con_fallos = df_resultado['motivo_fallo'] != ""
-        
-        df_resultado.loc[mask_bajo & mask_con_fallos, 'explicacion'] = \
-            "Problemas estacionales detectados: " + df_resultado['motivo_fallo'].str.slice(0, 100) + "..."
-            
-        df_resultado.loc[mask_bajo & ~mask_con_fallos, 'explicacion'] = \
-            "Condiciones variables o inestables reducen el potencial."
-
-        df_resultado.loc[mask_medio, 'explicacion'] = "Condiciones aceptables con variaciones."
-        df_resultado.loc[mask_alto, 'explicacion'] = "Condiciones adecuadas y estables."
-        
-        df_resultado['score'] = df_resultado['score'].fillna(0.0)
+        df_resultado = explicar_idoneidad(df_resultado)
 
     except Exception as e:
         print(f"⚠️ Error durante la agrupación final: {e}")
         df_resultado = pd.DataFrame()
     return df_resultado
 
+def explicar_idoneidad(df_resultado):
+    """
+    Agrega la columna 'explicacion' a un resultado con 'score' y 'motivo_fallo' por celda
+    (de evaluar_idoneidad_terreno o de bd.evaluar_idoneidad).
+    """
+    df_resultado['explicacion'] = "Datos insuficientes." # Default pesimista
+    
+    # Generar explicación final
+    # Si el score es bajo pero no hay "motivo_fallo" grave, es por inestabilidad
+    #df_resultado['explicacion'] = "Condiciones óptimas todo el año."
+    
+    # Lógica de explicación
+    mask_bajo = df_resultado['score'] < 60
+    mask_medio = (df_resultado['score'] >= 60) & (df_resultado['score'] < 80)
+    mask_alto = df_resultado['score'] >= 80
+    mask_con_fallos = df_resultado['motivo_fallo'] != ""
+    
+    df_resultado.loc[mask_bajo & mask_con_fallos, 'explicacion'] = \
+        "Problemas estacionales detectados: " + df_resultado['motivo_fallo'].str.slice(0, 100) + "..."
+        
+    df_resultado.loc[mask_bajo & ~mask_con_fallos, 'explicacion'] = \
+        "Condiciones variables o inestables reducen el potencial."
+
+    df_resultado.loc[mask_medio, 'explicacion'] = "Condiciones aceptables con variaciones."
+    df_resultado.loc[mask_alto, 'explicacion'] = "Condiciones adecuadas y estables."
+    
+    df_resultado['score'] = df_resultado['score'].fillna(0.0)
+    return df_resultado
+
 def generar_reporte_top_celdas(df_evaluado, top_n=5):
     """
     Toma el DataFrame evaluado, extrae los Top N ganadores y
@@ -482,3 +494,27 @@ def generar_reporte_top_celdas(df_evaluado, top_n=5):
         
     return reporte_texto
 
+
+def texto_estadisticas_region(df_estadisticas):
+    """
+    Resume para el LLM las estadísticas de bd.estadisticas_region: distribución anual de cada
+    atributo (nivel 'total') y, si están, los meses de mayor y menor promedio.
+    """
+    if df_estadisticas is None or df_estadisticas.empty:
+        return "Sin estadísticas climáticas de la región."
+
+    texto = "CONTEXTO CLIMÁTICO DE LA REGIÓN (todas las celdas y meses):\n"
+    texto += "-" * 40 + "\n"
+    totales = df_estadisticas[df_estadisticas['nivel'] == 'total']
+    meses = df_estadisticas[df_estadisticas['nivel'] == 'mes']
+    for _, fila in totales.iterrows():
+        texto += (f"- {fila['atributo']}: promedio {fila['promedio']:.1f} "
+                  f"(p10 {fila['p10']:.1f}, p50 {fila['p50']:.1f}, p90 {fila['p90']:.1f}; "
+                  f"mín {fila['minimo']:.1f}, máx {fila['maximo']:.1f})\n")
+        por_mes = meses[meses['atributo'] == fila['atributo']].dropna(subset=['promedio'])
+        if not por_mes.empty:
+            alto = por_mes.loc[por_mes['promedio'].idxmax()]
+            bajo = por_mes.loc[por_mes['promedio'].idxmin()]
+            texto += (f"   mes más alto: {int(alto['mes'])} ({alto['promedio']:.1f}), "
+                      f"mes más bajo: {int(bajo['mes'])} ({bajo['promedio']:.1f})\n")
+    return texto
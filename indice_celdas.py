@@ -0,0 +1,135 @@
+import numpy as np
+
+
+# Índice global de celdas
+#################################
+# Grilla global fija por resolución (tamaño de celda en metros):
+#   - filas de alto constante tamaño_m / METROS_POR_GRADO grados, desde lat -90
+#   - cada fila se divide en un número entero de columnas desde lon -180, con
+#     ancho corregido por cos(latitud) para que las celdas midan ~tamaño_m
+# El id de una celda es un BIGINT: (tamaño_m << 44) | (fila << 22) | columna.
+# Polígono, centroide y vecinos se calculan aritméticamente a partir del id.
+
+METROS_POR_GRADO = 111319.49
+BITS = 22
+MASCARA = (1 << BITS) - 1
+DESPLAZAMIENTO_TAMAÑO = 2 * BITS
+# El tamaño ocupa los bits 44..62 (el bit de signo del BIGINT queda libre)
+TAMAÑO_MAXIMO = (1 << (63 - DESPLAZAMIENTO_TAMAÑO)) - 1
+
+
+def alto_fila(tamaño_m):
+    """Alto de las filas en grados de latitud."""
+    return tamaño_m / METROS_POR_GRADO
+
+
+def columnas_por_fila(tamaño_m, fila):
+    """Cantidad de columnas de la fila (al menos 1 cerca de los polos)."""
+    lat_centro = -90.0 + (np.asarray(fila) + 0.5) * alto_fila(tamaño_m)
+    columnas = np.floor(360.0 * METROS_POR_GRADO * np.cos(np.radians(lat_centro)) / tamaño_m)
+    return np.maximum(1, columnas).astype(np.int64)
+
+
+def ancho_fila(tamaño_m, fila):
+    """Ancho de las celdas de la fila en grados de longitud."""
+    return 360.0 / columnas_por_fila(tamaño_m, fila)
+
+
+def componer(tamaño_m, fila, columna):
+    """
+    id de celda a partir de (tamaño_m, fila, columna); acepta escalares o arreglos.
+    Lanza ValueError si algún componente no cabe en sus bits: con celdas de menos de
+    ~10 m las columnas del ecuador superan 2**22 y los ids se pisarían entre sí.
+    """
+    tamaño_m = np.asarray(tamaño_m, dtype=np.int64)
+    fila = np.asarray(fila, dtype=np.int64)
+    columna = np.asarray(columna, dtype=np.int64)
+    if np.any((tamaño_m < 1) | (tamaño_m > TAMAÑO_MAXIMO)):
+        raise ValueError(f"tamaño de celda fuera de rango (1..{TAMAÑO_MAXIMO} m): {tamaño_m}")
+    if np.any((fila < 0) | (fila > MASCARA)):
+        raise ValueError(f"fila fuera de rango (0..{MASCARA}) para celdas de {tamaño_m} m")
+    if np.any((columna < 0) | (columna > MASCARA)):
+        raise ValueError(f"columna fuera de rango (0..{MASCARA}) para celdas de {tamaño_m} m")
+    return (tamaño_m << DESPLAZAMIENTO_TAMAÑO) | (fila << BITS) | columna
+
+
+def descomponer(id_celda):
+    """(tamaño_m, fila, columna) de uno o varios ids."""
+    ids = np.asarray(id_celda, dtype=np.int64)
+    return ids >> DESPLAZAMIENTO_TAMAÑO, (ids >> BITS) & MASCARA, ids & MASCARA
+
+
+def celda_de_punto(lon, lat, tamaño_m):
+    """id de la celda que contiene el punto (lon, lat)."""
+    fila = np.floor((np.asarray(lat, dtype=float) + 90.0) / alto_fila(tamaño_m)).astype(np.int64)
+    columnas = columnas_por_fila(tamaño_m, fila)
+    columna = np.floor((np.asarray(lon, dtype=float) + 180.0) / (360.0 / columnas)).astype(np.int64)
+    return componer(tamaño_m, fila, np.minimum(columna, columnas - 1))
+
+
+def limites(id_celda):
+    """(oeste, sur, este, norte) de uno o varios ids."""
+    tamaño_m, fila, columna = descomponer(id_celda)
+    alto = tamaño_m / METROS_POR_GRADO
+    ancho = 360.0 / columnas_por_fila(tamaño_m, fila)
+    sur = -90.0 + fila * alto
+    oeste = -180.0 + columna * ancho
+    return oeste, sur, oeste + ancho, sur + alto
+
+
+def centroide(id_celda):
+    """(lon, lat) del centro de uno o varios ids."""
+    oeste, sur, este, norte = limites(id_celda)
+    return (oeste + este) / 2, (sur + norte) / 2
+
+
+def poligonos(id_celda):
+    """Polígonos shapely (arreglo) de uno o varios ids."""
+    import shapely
+    return shapely.box(*limites(id_celda))
+
+
+def vecinos(id_celda: int, diagonales: bool = True) -> list:
+    """
+    ids de las celdas vecinas (4 u 8). Las filas vecinas pueden tener otro número de
+    columnas: se toma la columna que contiene la longitud del centro y sus laterales.
+    La longitud es circular; en los polos no hay fila vecina.
+    """
+    tamaño_m, fila, columna = (int(x) for x in descomponer(id_celda))
+    lon, _ = centroide(id_celda)
+    filas_totales = int(np.ceil(180.0 / alto_fila(tamaño_m)))
+
+    resultado = []
+    columnas = int(columnas_por_fila(tamaño_m, fila))
+    for desplazamiento in (-1, 1):
+        resultado.append(int(componer(tamaño_m, fila, (columna + desplazamiento) % columnas)))
+    for fila_vecina in (fila - 1, fila + 1):
+        if not 0 <= fila_vecina < filas_totales:
+            continue
+        columnas_vecina = int(columnas_por_fila(tamaño_m, fila_vecina))
+        columna_vecina = min(int((lon + 180.0) // (360.0 / columnas_vecina)), columnas_vecina - 1)
+        laterales = (-1, 0, 1) if diagonales else (0,)
+        for desplazamiento in laterales:
+            resultado.append(int(componer(tamaño_m, fila_vecina, (columna_vecina + desplazamiento) % columnas_vecina)))
+    return list(dict.fromkeys(r for r in resultado if r != int(id_celda)))
+
+
+def celdas_en_rectangulo(limites_region: tuple, tamaño_m: int):
+    """ids (arreglo int64) de todas las celdas de la grilla global que tocan el rectángulo."""
+    lon_min, lat_min, lon_max, lat_max = limites_region
+    alto = alto_fila(tamaño_m)
+    fila_min = int(np.floor((lat_min + 90.0) / alto))
+    fila_max = int(np.floor((lat_max + 90.0) / alto))
+    filas = np.arange(fila_min, fila_max + 1, dtype=np.int64)
+
+    columnas = columnas_por_fila(tamaño_m, filas)
+    ancho = 360.0 / columnas
+    col_min = np.floor((lon_min + 180.0) / ancho).astype(np.int64)
+    col_max = np.minimum(np.floor((lon_max + 180.0) / ancho).astype(np.int64), columnas - 1)
+    cantidad = np.maximum(0, col_max - col_min + 1)
+
+    # (fila, columna) de todas las celdas sin bucles de Python
+    fila = np.repeat(filas, cantidad)
+    inicio = np.repeat(np.cumsum(cantidad) - cantidad, cantidad)
+    columna = np.repeat(col_min, cantidad) + (np.arange(fila.size) - inicio)
+    return componer(tamaño_m, fila, columna)
@@ -1,15 +1,25 @@
 import psycopg2
-from psycopg2.extras import execute_batch
-from shapely.geometry import box, Point
+from shapely.geometry import Point
 from shapely import wkt
 from typing import List, Dict
 
 import time
 import logging
+import json
+import queue
+import uuid
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from functools import partial
+from datetime import datetime, timedelta
 import ee
 import os
+from cache_ee import descargar, forzar_descarga, respuesta_puede_ser_anterior
+from cache_regiones import cache_regiones, CANAL_INVALIDACION
+from diario_ingesta import DiarioIngesta, ingesta_en_curso
+import bd
+import indice_celdas
+from planificador_ee import planificador
 
 
 try:
@@ -31,6 +41,80 @@ logging.basicConfig(
 )
 registrador = logging.getLogger(__name__)
 
+# Días tras el fin de mes en que ERA5-Land y CHIRPS publican datos definitivos:
+# un mes escrito antes de ese plazo se considera desactualizado en la ingesta incremental
+DIAS_CONSOLIDACION = 30
+
+
+# Carga masiva en celdas / clima_mensual (COPY → staging → fusión)
+#################################
+
+COLUMNAS_STAGING = [
+    'id_celda', 'pais_region', 'departamento_region', 'ciudad_region',
+    'geometria', 'centroide', 'area_m2', 'fecha',
+    'temp_promedio', 'precipitacion_promedio', 'humedad_promedio', 'elevacion_promedio', 'viento_promedio',
+    'puntuacion_calidad_datos',
+]
+
+COLUMNAS_NUMERICAS = [
+    'area_m2', 'temp_promedio', 'precipitacion_promedio', 'humedad_promedio',
+    'elevacion_promedio', 'viento_promedio', 'puntuacion_calidad_datos',
+]
+
+# Regiones (país, departamento) cuya partición de celdas ya existe en este proceso
+_particiones_aseguradas = set()
+
+# DISTINCT ON evita que ON CONFLICT toque dos veces la misma fila (gana la última del lote).
+# Una celda de borde tiene una fila por ciudad (la ciudad es parte de la clave primaria).
+# La geometría y los atributos estáticos van una vez por celda a `celdas`; el clima, por mes a `clima_mensual`.
+FUSION_CELDAS = """
+    INSERT INTO celdas (
+        id_celda, pais_region, departamento_region, ciudad_region,
+        pais_clave, departamento_clave, ciudad_clave,
+        geometria, centroide, lat, lon, area_m2,
+        elevacion_promedio, puntuacion_calidad_datos, ultima_actualizacion
+    )
+    SELECT
+        s.id_celda::bigint, s.pais_region, s.departamento_region, s.ciudad_region,
+        clave_region(s.pais_region), clave_region(s.departamento_region), clave_region(s.ciudad_region),
+        ST_GeomFromText(s.geometria, 4326), s.centroide_geom, ST_Y(s.centroide_geom), ST_X(s.centroide_geom),
+        s.area_m2::double precision,
+        s.elevacion_promedio::double precision, s.puntuacion_calidad_datos::double precision, NOW()
+    FROM (
+        SELECT DISTINCT ON (id_celda, pais_region, departamento_region, ciudad_region)
+            *, ST_GeomFromText(centroide, 4326) AS centroide_geom
+        FROM celdas_terreno_staging
+        WHERE id_lote = %s AND n BETWEEN %s AND %s
+        ORDER BY id_celda, pais_region, departamento_region, ciudad_region, n DESC
+    ) s
+    ON CONFLICT (id_celda, pais_clave, departamento_clave, ciudad_clave) DO UPDATE SET
+        elevacion_promedio = EXCLUDED.elevacion_promedio,
+        puntuacion_calidad_datos = EXCLUDED.puntuacion_calidad_datos,
+        ultima_actualizacion = NOW();
+"""
+
+FUSION_CLIMA = """
+    INSERT INTO clima_mensual (
+        id_celda, fecha,
+        temp_promedio, precipitacion_promedio, humedad_promedio, viento_promedio,
+        ultima_actualizacion
+    )
+    SELECT DISTINCT ON (id_celda, fecha::date)
+        id_celda::bigint, fecha::date,
+        temp_promedio::double precision, precipitacion_promedio::double precision,
+        humedad_promedio::double precision, viento_promedio::double precision,
+        NOW()
+    FROM celdas_terreno_staging
+    WHERE id_lote = %s AND n BETWEEN %s AND %s
+    ORDER BY id_celda, fecha::date, n DESC
+    ON CONFLICT (id_celda, fecha) DO UPDATE SET
+        temp_promedio = EXCLUDED.temp_promedio,
+        precipitacion_promedio = EXCLUDED.precipitacion_promedio,
+        humedad_promedio = EXCLUDED.humedad_promedio,
+        viento_promedio = EXCLUDED.viento_promedio,
+        ultima_actualizacion = NOW();
+"""
+
 
 
 
@@ -59,79 +143,68 @@ def gee_inicializar():
 gee_inicializar()
 
 
-def generar_id_celda(lat: float, lon: float, pais: str, departamento: str, ciudad: str, 
-                     tamaño_grilla: int = 500) -> str:
-    """
-    Genera un id_celda único y descriptivo
-    
-    Formato: {PAIS}_{DEPARTAMENTO}_{CIUDAD}_{TAMAÑO_GRILLA}m_{LAT}_{LON}
-    Ejemplo: PE_CAJ_500m_-7.1234_-78.5678
-    """
-    # Redondear a la grilla
-    lat_redondeado = round(lat, 4)
-    lon_redondeado = round(lon, 4)
-    
-    id_celda = f"{pais}_{departamento}_{ciudad}_{tamaño_grilla}m_{lat_redondeado}_{lon_redondeado}"
-    return id_celda
-
-
 
 
 class IngestionCeldasTerreno:
-    def __init__(self, config_bd: dict):
-        self.conexion = psycopg2.connect(**config_bd)
+    def __init__(self):
+        # Conexión del pool compartido, reservada durante toda la ingesta (ver cerrar())
+        self.conexion = bd.pool.tomar()
         self.cursor = self.conexion.cursor()
+
+    def cerrar(self):
+        """Devuelve la conexión al pool."""
+        self.cursor.close()
+        bd.pool.devolver(self.conexion)
     
-    def crear_celdas_grilla(self, limites: tuple, tamaño_celda_m: int = 250) -> List[Dict]:
+    def crear_celdas_grilla(self, limites: tuple, tamaño_celda_m: int = 250, geometria=None) -> List[Dict]:
         """
         Crea una grilla de celdas para una región
         
         limites: (lon_min, lat_min, lon_max, lat_max)
         tamaño_celda_m: tamaño de celda en metros
+        geometria: polígono (shapely) de la región; si se indica, solo se conservan
+                   las celdas que lo intersectan (ver obtener_geometria_region)
+
+        Las celdas son las de la grilla global de indice_celdas que tocan el rectángulo:
+        filas de alto fijo y ancho corregido por cos(latitud), con id BIGINT
+        (tamaño, fila, columna) único entre regiones.
         """
-        lon_min, lat_min, lon_max, lat_max = limites
-        
-        # Convertir metros a grados (aproximado)
-        # 1 grado ≈ 111km en el ecuador
-        tamaño_celda_grados = tamaño_celda_m / (111000/1)
-        
-        print (tamaño_celda_grados)
-        print (limites)
+        import shapely
 
-        celdas = []
-        lat = lat_min
-        
-        while lat < lat_max:
-            lon = lon_min
-            while lon < lon_max:
-                # Crear polígono de la celda
-                poligono_celda = box(lon, lat, 
-                                  lon + tamaño_celda_grados, 
-                                  lat + tamaño_celda_grados)
-                
-                centroide = poligono_celda.centroid
-                
-                celda = {
-                    'id_celda': generar_id_celda(
-                        centroide.y, centroide.x, 
-                        'PE', 'LIM', tamaño_celda_m
-                    ),
-                    'geometria': poligono_celda.wkt,
-                    'centroide': centroide.wkt,
-                    'centroide_lat': centroide.y,
-                    'centroide_lon': centroide.x,
-                    'area_m2': tamaño_celda_m * tamaño_celda_m
-                }
-                
-                celdas.append(celda)
-                lon += tamaño_celda_grados
-            lat += tamaño_celda_grados
-        
-        return celdas
+        ids = indice_celdas.celdas_en_rectangulo(limites, tamaño_celda_m)
+        oeste, sur, este, norte = indice_celdas.limites(ids)
+
+        poligonos = shapely.box(oeste, sur, este, norte)
+        if geometria is not None:
+            shapely.prepare(geometria)
+            dentro = shapely.intersects(geometria, poligonos)
+            registrador.info(f"✂️ Recorte al polígono de la región: {int(dentro.sum())} de {dentro.size} celdas del rectángulo")
+            ids, poligonos, oeste, este, sur, norte = (x[dentro] for x in (ids, poligonos, oeste, este, sur, norte))
+
+        lon_centro = (oeste + este) / 2
+        lat_centro = (sur + norte) / 2
+        wkt_poligonos = shapely.to_wkt(poligonos, rounding_precision=7)
+        wkt_centroides = shapely.to_wkt(shapely.points(lon_centro, lat_centro), rounding_precision=7)
+        area_m2 = tamaño_celda_m * tamaño_celda_m
+
+        return [
+            {
+                'id_celda': id_celda,
+                'geometria': wkt_poligono,
+                'centroide': wkt_centroide,
+                'centroide_lat': lat,
+                'centroide_lon': lon,
+                'area_m2': area_m2
+            }
+            for id_celda, lat, lon, wkt_poligono, wkt_centroide in zip(
+                ids.tolist(), lat_centro.tolist(), lon_centro.tolist(), wkt_poligonos.tolist(), wkt_centroides.tolist()
+            )
+        ]
     
-    def enriquecer_con_datos_clima(self, celda: Dict) -> Dict:
+    def enriquecer_con_datos_clima(self, celda: Dict, agregacion: str = 'mensual',
+                                   fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31') -> Dict:
         """
-        Enriquece la celda con datos climáticos mensuales desde Google Earth Engine
+        Enriquece la celda con datos climáticos mensuales de [fecha_inicio, fecha_fin) desde Google Earth Engine
         Retorna diccionario con datos por mes
         """
         lat = celda['centroide_lat']
@@ -147,7 +220,7 @@ class IngestionCeldasTerreno:
             geometria = ee.Geometry.Polygon([coords])
             
             # Obtener datos mensuales de GEE
-            datos_mensuales = ingesta_ee.enriquecer_celda_gee(geometria, '2023-01-01', '2023-12-31')
+            datos_mensuales = ingesta_ee.enriquecer_celda_gee(geometria, fecha_inicio, fecha_fin, agregacion)
             
             # Convertir formato de datos mensuales a formato para inserción
             # Estructura: {'2023-01': {...datos...}, '2023-02': {...}, ..., 'elevacion': X}
@@ -157,12 +230,122 @@ class IngestionCeldasTerreno:
         except Exception as e:
             registrador.error(f"Error enriquecimiento GEE para ({lat},{lon}): {e}")
             celda['datos_mensuales'] = {}
+            celda['error_enriquecimiento'] = str(e)
             return celda
         
-    def insertar_celdas(self, celdas: List[Dict], tamaño_lote: int = 100):
+    def _feature_collection(self, celdas: List[Dict]):
+        """ee.FeatureCollection con el polígono y el id_celda de cada celda"""
+        from shapely.wkt import loads as wkt_loads
+
+        features = []
+        for celda in celdas:
+            coords = list(wkt_loads(celda['geometria']).exterior.coords)
+            # Como texto: los ids BIGINT superan la precisión de los números de GEE (double)
+            features.append(ee.Feature(ee.Geometry.Polygon([coords]), {'id_celda': str(celda['id_celda'])}))
+        return ee.FeatureCollection(features)
+
+    def enriquecer_lote_con_datos_clima(self, celdas: List[Dict], 
+                                        fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31',
+                                        agregacion: str = 'mensual', incluir_elevacion: bool = True) -> List[Dict]:
+        """
+        Enriquece un lote de celdas con una sola consulta reduceRegions a GEE
+        Deja en cada celda 'datos_mensuales' con el mismo formato que enriquecer_con_datos_clima
+        """
+        try:
+            resultados = ingesta_ee.enriquecer_celdas_gee_lote(
+                self._feature_collection(celdas), fecha_inicio, fecha_fin, agregacion, incluir_elevacion
+            )
+        except Exception as e:
+            registrador.error(f"Error enriquecimiento GEE de lote ({len(celdas)} celdas): {e}")
+            resultados = {}
+            for celda in celdas:
+                celda['error_enriquecimiento'] = str(e)
+
+        for celda in celdas:
+            celda['datos_mensuales'] = resultados.get(str(celda['id_celda']), {})
+            celda['puntuacion_calidad_datos'] = self.calcular_puntuacion_calidad(celda)
+
+        return celdas
+
+    def agrupar_celdas_por_pixel(self, celdas: List[Dict]) -> List[List[Dict]]:
+        """
+        Agrupa las celdas cuyo centroide cae en los mismos píxeles de origen (ERA5/CHIRPS)
+        """
+        grupos = ingesta_ee.agrupar_por_pixel(
+            [(celda['centroide_lon'], celda['centroide_lat']) for celda in celdas],
+            ingesta_ee.grillas_clima()
+        )
+        registrador.info(f"🧩 {len(celdas)} celdas agrupadas en {len(grupos)} píxeles de origen distintos")
+        return [[celdas[idx] for idx in grupo] for grupo in grupos]
+
+    def enriquecer_grupos_pixel(self, grupos: List[List[Dict]], 
+                                fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31',
+                                agregacion: str = 'mensual', tamaño_lote_gee: int = 100) -> List[Dict]:
+        """
+        Enriquece las celdas consultando el clima una sola vez por píxel de origen (ERA5/CHIRPS)
+        y repartiéndolo a todas las celdas que comparten ese píxel. La elevación se consulta por celda.
+        Retorna todas las celdas de los grupos.
+        """
+        import copy
+
+        # Clima: una consulta para el representante de cada grupo
+        representantes = [dict(grupo[0]) for grupo in grupos]
+        self.enriquecer_lote_con_datos_clima(representantes, fecha_inicio, fecha_fin, agregacion, False)
+
+        # Elevación: todas las celdas de los grupos, por lotes
+        miembros = [celda for grupo in grupos for celda in grupo]
+        elevaciones = {}
+        for i in range(0, len(miembros), tamaño_lote_gee):
+            lote = miembros[i:i + tamaño_lote_gee]
+            try:
+                elevaciones.update(ingesta_ee.obtener_elevacion_lote(self._feature_collection(lote)))
+            except Exception as e:
+                registrador.error(f"Error obteniendo elevación de lote ({len(lote)} celdas): {e}")
+
+        # Repartir el clima del representante a cada celda del grupo
+        for representante, grupo in zip(representantes, grupos):
+            for celda in grupo:
+                datos = copy.deepcopy(representante['datos_mensuales'])
+                if datos and str(celda['id_celda']) in elevaciones:
+                    datos['elevacion'] = elevaciones[str(celda['id_celda'])]
+                celda['datos_mensuales'] = datos
+                if 'error_enriquecimiento' in representante:
+                    celda['error_enriquecimiento'] = representante['error_enriquecimiento']
+                celda['puntuacion_calidad_datos'] = self.calcular_puntuacion_calidad(celda)
+
+        return miembros
+
+    def enriquecer_celdas_raster(self, celdas: List[Dict], 
+                                 fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31') -> List[Dict]:
+        """
+        Enriquece todas las celdas descargando las grillas de la región una sola vez
+        y calculando las estadísticas zonales en local (ver ingesta_ee.enriquecer_celdas_raster)
+        """
+        from shapely.wkt import loads as wkt_loads
+
+        try:
+            cajas = [wkt_loads(celda['geometria']).bounds for celda in celdas]
+            resultados = ingesta_ee.enriquecer_celdas_raster(cajas, fecha_inicio, fecha_fin)
+        except Exception as e:
+            registrador.error(f"Error enriquecimiento GEE en modo raster ({len(celdas)} celdas): {e}")
+            resultados = [{} for _ in celdas]
+            for celda in celdas:
+                celda['error_enriquecimiento'] = str(e)
+
+        for celda, datos_mensuales in zip(celdas, resultados):
+            celda['datos_mensuales'] = datos_mensuales
+            celda['puntuacion_calidad_datos'] = self.calcular_puntuacion_calidad(celda)
+
+        return celdas
+
+    def insertar_celdas(self, celdas: List[Dict], tamaño_lote: int = 5000):
         """
         Inserta celdas mensuales en lotes con manejo robusto de errores
         Convierte cada celda en 12 registros (uno por mes) con fechas
+        Carga masiva: COPY a una tabla de staging UNLOGGED y fusión en celdas (geometría, una vez
+        por celda) y clima_mensual (una fila por mes) con INSERT ... ON CONFLICT por lote. Los registros inválidos se aíslan sin descartar su lote.
+        Cada lote refresca resumen_clima_celda de sus celdas.
+        Retorna {'insertados', 'fallidos', 'celdas_sin_datos', 'celdas_rechazadas': {id_celda: motivo}}
         """
         #eliminar_registros = "DELETE FROM celdas_terreno"
         #self.cursor.execute(eliminar_registros)
@@ -212,60 +395,165 @@ class IngestionCeldasTerreno:
                     registrador.error(f"Error conversión mes {mes_str} para celda {celda['id_celda']}: {e}")
                     continue
         
-        # Insertar registros mensuales
-        consulta_insertar = """
-        INSERT INTO celdas_terreno (
-            id_celda, pais_region, departamento_region, ciudad_region,
-            geometria, centroide, lat, lon,
-            area_m2, fecha,
-            temp_promedio, precipitacion_promedio, humedad_promedio, elevacion_promedio, viento_promedio,
-            puntuacion_calidad_datos, ultima_actualizacion
-        ) VALUES (
-            %(id_celda)s, %(pais_region)s, %(departamento_region)s, %(ciudad_region)s,
-            ST_GeomFromText(%(geometria)s, 4326),
-            ST_GeomFromText(%(centroide)s, 4326),
-            ST_Y(ST_GeomFromText(%(centroide)s, 4326)), ST_X(ST_GeomFromText(%(centroide)s, 4326)),
-            %(area_m2)s, %(fecha)s,
-            %(temp_promedio)s, %(precipitacion_promedio)s, %(humedad_promedio)s,  %(elevacion_promedio)s, %(viento_promedio)s,    
-            %(puntuacion_calidad_datos)s, NOW()
-        )
-        ON CONFLICT (id_celda, fecha) DO UPDATE SET
-            temp_promedio = EXCLUDED.temp_promedio,
-            precipitacion_promedio = EXCLUDED.precipitacion_promedio,
-            humedad_promedio = EXCLUDED.humedad_promedio,
-            elevacion_promedio = EXCLUDED.elevacion_promedio,
-            viento_promedio = EXCLUDED.viento_promedio,
-            ultima_actualizacion = NOW();
-        """
-        
-        total_registros = len(registros_mensuales)
+        celdas_sin_datos = len(celdas) - len({r['id_celda'] for r in registros_mensuales})
+        registros_validos, rechazados = self._validar_registros(registros_mensuales)
+
         insertados = 0
-        fallidos = 0
-        
-        for idx_lote in range(0, total_registros, tamaño_lote):
-            lote = registros_mensuales[idx_lote:idx_lote + tamaño_lote]
+        id_lote = uuid.uuid4().hex
+        self._preparar_staging()
+        self._asegurar_particiones(registros_validos)
+        for idx_lote in range(0, len(registros_validos), tamaño_lote):
+            lote = registros_validos[idx_lote:idx_lote + tamaño_lote]
             try:
-                execute_batch(self.cursor, consulta_insertar, lote, page_size=tamaño_lote)
+                self._copiar_a_staging(id_lote, idx_lote, lote)
+                fusionados = self._fusionar_staging(id_lote, idx_lote, idx_lote + len(lote) - 1, lote, idx_lote, rechazados)
+                # Resumen climático solo de las celdas del lote, en la misma transacción
+                self.cursor.execute("SELECT refrescar_resumen_clima(%s::bigint[])",
+                                    (list({r['id_celda'] for r in lote}),))
+                self.cursor.execute("DELETE FROM celdas_terreno_staging WHERE id_lote = %s", (id_lote,))
+                # Avisar a la caché de regiones de los demás procesos (NOTIFY se entrega al confirmar)
+                regiones_lote = {(r['pais_region'], r['departamento_region'], r['ciudad_region']) for r in lote}
+                for region in regiones_lote:
+                    self.cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_INVALIDACION, json.dumps(region)))
                 self.conexion.commit()
-                insertados += len(lote)
-                registrador.info(f"✅ Lote {idx_lote // tamaño_lote + 1}: {len(lote)} registros mensuales insertados")
+                for region in regiones_lote:
+                    cache_regiones.invalidar(*region)
+                insertados += fusionados
+                registrador.info(f"✅ Lote {idx_lote // tamaño_lote + 1}: {len(lote)} registros mensuales cargados con COPY")
             except Exception as e:
                 self.conexion.rollback()
-                fallidos += len(lote)
+                rechazados.extend((r['id_celda'], r['fecha'], f"error de carga: {e}") for r in lote)
                 registrador.error(f"❌ Error de lote en índice {idx_lote}: {e}")
-        
+
+        for id_celda, fecha, motivo in rechazados[:20]:
+            registrador.warning(f"🚫 Registro rechazado {id_celda} {fecha}: {motivo}")
+        total_registros = len(registros_mensuales)
+        fallidos = len(rechazados)
         registrador.info(f"📊 Resumen inserción en BD: {insertados} registros insertados, {fallidos} fallidos de {total_registros} total")
+        return {
+            'insertados': insertados,
+            'fallidos': fallidos,
+            'celdas_sin_datos': celdas_sin_datos,
+            'celdas_rechazadas': {id_celda: motivo for id_celda, _, motivo in rechazados},
+        }
+
+    def _asegurar_particiones(self, registros: List[Dict]):
+        """
+        Crea las particiones de país/departamento que falten antes de la carga, en su propia
+        transacción corta (crear una partición bloquea brevemente la tabla celdas).
+        """
+        regiones = {(r['pais_region'], r['departamento_region']) for r in registros} - _particiones_aseguradas
+        for pais, departamento in regiones:
+            self.cursor.execute("SELECT asegurar_particion_celdas(%s, %s)", (pais, departamento))
+            self.conexion.commit()
+            _particiones_aseguradas.add((pais, departamento))
+
+    def _validar_registros(self, registros: List[Dict]):
+        """
+        Validación en Python antes del COPY: descarta registros sin id o con WKT inválido
+        y normaliza los numéricos (NaN/inf → NULL). Retorna (válidos, [(id_celda, fecha, motivo)]).
+        """
+        import math
+        import numpy as np
+        import shapely
+
+        if not registros:
+            return [], []
+        geometrias = shapely.from_wkt(np.array([r['geometria'] for r in registros], dtype=object), on_invalid='ignore')
+        centroides = shapely.from_wkt(np.array([r['centroide'] for r in registros], dtype=object), on_invalid='ignore')
+
+        validos, rechazados = [], []
+        for registro, geometria, centroide in zip(registros, geometrias, centroides):
+            motivo = None
+            if not registro['id_celda']:
+                motivo = "id_celda vacío"
+            elif geometria is None or geometria.is_empty:
+                motivo = "geometría WKT inválida"
+            elif centroide is None or centroide.is_empty:
+                motivo = "centroide WKT inválido"
+            else:
+                for campo in COLUMNAS_NUMERICAS:
+                    valor = registro[campo]
+                    if valor is None:
+                        continue
+                    try:
+                        valor = float(valor)
+                    except (TypeError, ValueError):
+                        motivo = f"{campo} no numérico: {valor!r}"
+                        break
+                    registro[campo] = valor if math.isfinite(valor) else None
+            if motivo:
+                rechazados.append((registro['id_celda'], registro['fecha'], motivo))
+            else:
+                validos.append(registro)
+        return validos, rechazados
+
+    def _preparar_staging(self):
+        """Tabla de staging UNLOGGED (sin WAL) con columnas de texto: el COPY nunca falla por tipos."""
+        if getattr(self, '_staging_listo', False):
+            return
+        self.cursor.execute(f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS celdas_terreno_staging (
+                id_lote TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                {', '.join(f'{columna} TEXT' for columna in COLUMNAS_STAGING)}
+            );
+            CREATE INDEX IF NOT EXISTS idx_celdas_terreno_staging_lote ON celdas_terreno_staging (id_lote, n);
+        """)
+        self.conexion.commit()
+        self._staging_listo = True
+
+    def _copiar_a_staging(self, id_lote: str, inicio: int, registros: List[Dict]):
+        """Carga los registros en la tabla de staging con COPY ... FROM STDIN (CSV)."""
+        import csv
+        import io
+
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        for n, registro in enumerate(registros, start=inicio):
+            escritor.writerow([id_lote, n] + [registro[columna] for columna in COLUMNAS_STAGING])
+        buffer.seek(0)
+        self.cursor.copy_expert(
+            f"COPY celdas_terreno_staging (id_lote, n, {', '.join(COLUMNAS_STAGING)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+    def _fusionar_staging(self, id_lote: str, desde: int, hasta: int, lote: List[Dict], inicio: int,
+                          rechazados: list) -> int:
+        """
+        Fusiona las filas [desde, hasta] del lote en celdas y clima_mensual con INSERT ... ON CONFLICT.
+        Si la sentencia falla, divide el rango en dos y reintenta cada mitad para aislar las filas
+        problemáticas, que se agregan a rechazados sin descartar el resto del lote.
+        Retorna la cantidad de filas fusionadas.
+        """
+        self.cursor.execute("SAVEPOINT fusion")
+        try:
+            self.cursor.execute(FUSION_CELDAS, (id_lote, desde, hasta))
+            self.cursor.execute(FUSION_CLIMA, (id_lote, desde, hasta))
+            fusionadas = self.cursor.rowcount
+            self.cursor.execute("RELEASE SAVEPOINT fusion")
+            return fusionadas
+        except Exception as e:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT fusion")
+            if desde == hasta:
+                registro = lote[desde - inicio]
+                rechazados.append((registro['id_celda'], registro['fecha'], str(e).strip()))
+                return 0
+            medio = (desde + hasta) // 2
+            return (self._fusionar_staging(id_lote, desde, medio, lote, inicio, rechazados)
+                    + self._fusionar_staging(id_lote, medio + 1, hasta, lote, inicio, rechazados))
     
 
 
     
-    def enriquecer_celda(self, celda: Dict, idx_celda: int, total_celdas: int) -> Dict:
+    def enriquecer_celda(self, celda: Dict, idx_celda: int, total_celdas: int, agregacion: str = 'mensual',
+                         fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31') -> Dict:
         """
         Enriquece una celda individual con datos mensuales desde GEE
         """
         try:
-            # Obtener datos mensuales completos (12 meses + elevación)
-            celda = self.enriquecer_con_datos_clima(celda)
+            # Obtener datos mensuales del rango (un valor por mes + elevación)
+            celda = self.enriquecer_con_datos_clima(celda, agregacion, fecha_inicio, fecha_fin)
             
             # Calcular score de calidad (basado en disponibilidad de datos)
             celda['puntuacion_calidad_datos'] = self.calcular_puntuacion_calidad(celda)
@@ -277,29 +565,267 @@ class IngestionCeldasTerreno:
         except Exception as e:
             registrador.error(f"Error al prerparar celda {idx_celda}: {e}")
             celda['datos_mensuales'] = {}
+            celda['error_enriquecimiento'] = str(e)
             return celda
     
+    def _unidades_de_trabajo(self, celdas: List[Dict], modo: str, agregacion: str, 
+                             deduplicar_pixeles: bool, tamaño_lote_gee: int,
+                             fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31') -> list:
+        """
+        Divide el enriquecimiento en unidades independientes: cada una es una función
+        sin argumentos que retorna la lista de celdas enriquecidas que le tocan.
+        """
+        if modo == 'raster':
+            # Las grillas cubren toda la región: una sola unidad
+            return [partial(self.enriquecer_celdas_raster, celdas, fecha_inicio, fecha_fin)]
+
+        if modo == 'lote' and deduplicar_pixeles:
+            grupos = self.agrupar_celdas_por_pixel(celdas)
+            return [
+                partial(self.enriquecer_grupos_pixel, grupos[i:i + tamaño_lote_gee],
+                        fecha_inicio, fecha_fin, agregacion, tamaño_lote_gee)
+                for i in range(0, len(grupos), tamaño_lote_gee)
+            ]
+
+        if modo == 'lote':
+            # Un lote de celdas por consulta reduceRegions
+            return [
+                partial(self.enriquecer_lote_con_datos_clima, celdas[i:i + tamaño_lote_gee],
+                        fecha_inicio, fecha_fin, agregacion)
+                for i in range(0, len(celdas), tamaño_lote_gee)
+            ]
+
+        return [
+            (lambda celda=celda, idx=idx: [self.enriquecer_celda(celda, idx, len(celdas), agregacion,
+                                                                 fecha_inicio, fecha_fin)])
+            for idx, celda in enumerate(celdas)
+        ]
+
+    def meses_faltantes(self, celdas: List[Dict], fecha_inicio: str, fecha_fin: str,
+                        max_antiguedad_dias: int = None) -> Dict[int, List[str]]:
+        """
+        Consulta en clima_mensual los meses ya guardados de cada celda y retorna
+        {id_celda: ['YYYY-MM', ...]} con los meses del rango que faltan o están desactualizados
+        (escritos antes de consolidarse sus datos o hace más de max_antiguedad_dias).
+        """
+        meses = [f"{mes[:4]}-{mes[4:]}" for mes, _, _ in ingesta_ee.meses_entre(fecha_inicio, fecha_fin)]
+        ahora = datetime.now()
+
+        self.cursor.execute("""
+            SELECT id_celda, fecha, ultima_actualizacion FROM clima_mensual
+            WHERE id_celda = ANY(%s) AND fecha >= %s AND fecha < %s;
+        """, ([celda['id_celda'] for celda in celdas], fecha_inicio, fecha_fin))
+
+        vigentes = {}
+        for id_celda, fecha, ultima_actualizacion in self.cursor.fetchall():
+            fin_mes = datetime(fecha.year + fecha.month // 12, fecha.month % 12 + 1, 1)
+            consolidado = ultima_actualizacion >= fin_mes + timedelta(days=DIAS_CONSOLIDACION)
+            reciente = max_antiguedad_dias is None or ahora - ultima_actualizacion <= timedelta(days=max_antiguedad_dias)
+            if consolidado and reciente:
+                vigentes.setdefault(id_celda, set()).add(fecha.strftime('%Y-%m'))
+
+        return {
+            celda['id_celda']: [mes for mes in meses if mes not in vigentes.get(celda['id_celda'], ())]
+            for celda in celdas
+        }
+
+    def _filtrar_meses(self, unidad, meses: set, sin_cache: bool = False) -> List[Dict]:
+        """
+        Ejecuta una unidad de trabajo y deja en cada celda solo los meses pedidos (y la elevación).
+        sin_cache: consultar GEE aunque la caché tenga una respuesta (ver forzar_descarga).
+        """
+        if sin_cache:
+            with forzar_descarga():
+                celdas = unidad()
+        else:
+            celdas = unidad()
+        for celda in celdas:
+            if celda.get('datos_mensuales'):
+                celda['datos_mensuales'] = {
+                    mes: datos for mes, datos in celda['datos_mensuales'].items()
+                    if mes == 'elevacion' or mes in meses
+                }
+        return celdas
+
+    def _unidades_incrementales(self, celdas: List[Dict], faltantes: Dict[int, List[str]], modo: str,
+                                agregacion: str, deduplicar_pixeles: bool, tamaño_lote_gee: int,
+                                fecha_inicio: str, fecha_fin: str) -> list:
+        """
+        Unidades de trabajo que piden a GEE solo los meses faltantes: las celdas se agrupan
+        por conjunto de meses faltantes y cada grupo consulta el rango que los cubre.
+        """
+        rangos = {f"{mes[:4]}-{mes[4:]}": (inicio, fin)
+                  for mes, inicio, fin in ingesta_ee.meses_entre(fecha_inicio, fecha_fin)}
+
+        grupos = {}
+        for celda in celdas:
+            meses = tuple(faltantes[celda['id_celda']])
+            if meses:
+                grupos.setdefault(meses, []).append(celda)
+
+        unidades = []
+        for meses, grupo in grupos.items():
+            inicio, fin = rangos[meses[0]][0], rangos[meses[-1]][1]
+            # Una respuesta guardada antes de que el rango se consolidara tiene datos provisionales
+            # (o vacíos): se consulta GEE de nuevo en lugar de escribirla como definitiva
+            sin_cache = respuesta_puede_ser_anterior(datetime.fromisoformat(fin) + timedelta(days=DIAS_CONSOLIDACION))
+            registrador.info(f"🧮 {len(grupo)} celdas con {len(meses)} meses faltantes ({inicio} → {fin})"
+                             f"{' sin caché de GEE' if sin_cache else ''}")
+            unidades.extend(
+                partial(self._filtrar_meses, unidad, set(meses), sin_cache)
+                for unidad in self._unidades_de_trabajo(grupo, modo, agregacion, deduplicar_pixeles,
+                                                        tamaño_lote_gee, inicio, fin)
+            )
+        return unidades
+
+    def _escritor(self, cola: queue.Queue, resumen: Dict, total_celdas: int, tamaño_lote_escritura: int,
+                  diario: DiarioIngesta = None):
+        """
+        Consumidor del pipeline: toma celdas enriquecidas de la cola y las escribe en
+        PostgreSQL por lotes a medida que llegan. Termina al recibir None.
+        Si hay diario, marca cada celda escrita como completada o fallida.
+        """
+        pendientes = []
+
+        def escribir():
+            resultado = self.insertar_celdas(pendientes)
+            if diario is not None:
+                self._registrar_en_diario(diario, pendientes, resultado)
+            resumen['registros_insertados'] += resultado['insertados']
+            resumen['registros_fallidos'] += resultado['fallidos']
+            resumen['celdas_sin_datos'] += resultado['celdas_sin_datos']
+            # Las celdas rechazadas (lote revertido o registros inválidos) no cuentan como escritas
+            rechazadas = resultado.get('celdas_rechazadas', {})
+            resumen['celdas_escritas'] += sum(1 for celda in pendientes if celda['id_celda'] not in rechazadas)
+            transcurrido = max(1e-9, time.time() - resumen['inicio'])
+            registrador.info(
+                f"📝 Progreso: {resumen['celdas_escritas']}/{total_celdas} celdas escritas | "
+                f"{resumen['registros_insertados']} filas ({resumen['registros_insertados'] / transcurrido:.1f} filas/s)"
+            )
+            pendientes.clear()
+
+        while True:
+            celdas = cola.get()
+            if celdas is None:
+                break
+            try:
+                pendientes.extend(celdas)
+                resumen['celdas_enriquecidas'] += len(celdas)
+                resumen['celdas_fallidas'] += sum(1 for c in celdas if 'error_enriquecimiento' in c)
+                if len(pendientes) >= tamaño_lote_escritura:
+                    escribir()
+            except Exception as e:
+                registrador.error(f"❌ Error escribiendo lote en BD: {e}")
+                pendientes.clear()
+        try:
+            if pendientes:
+                escribir()
+        except Exception as e:
+            registrador.error(f"❌ Error escribiendo lote final en BD: {e}")
+
+    def _registrar_en_diario(self, diario: DiarioIngesta, celdas: List[Dict], resultado: Dict):
+        """Marca en el diario el resultado de un lote escrito por insertar_celdas."""
+        completadas, fallidas = [], {}
+        rechazadas = resultado.get('celdas_rechazadas', {})
+        for celda in celdas:
+            if celda['id_celda'] in rechazadas:
+                fallidas[celda['id_celda']] = rechazadas[celda['id_celda']]
+            elif 'error_enriquecimiento' in celda:
+                fallidas[celda['id_celda']] = celda['error_enriquecimiento']
+            elif not celda.get('datos_mensuales'):
+                fallidas[celda['id_celda']] = "sin datos mensuales"
+            else:
+                completadas.append(celda['id_celda'])
+        try:
+            diario.marcar(completadas, fallidas)
+        except Exception as e:
+            diario.conexion.rollback()
+            registrador.error(f"❌ Error actualizando diario de ingesta: {e}")
+
+    def ejecutar_pipeline(self, unidades: list, total_celdas: int, 
+                          tamaño_lote_escritura: int = 50, max_en_cola: int = 8,
+                          diario: DiarioIngesta = None) -> Dict:
+        """
+        Pipeline productor/consumidor: las unidades de enriquecimiento corren en paralelo
+        (concurrencia regulada por el planificador de GEE) y sus celdas pasan por una cola
+        acotada a un hilo escritor que inserta en PostgreSQL a medida que se completan.
+        La memoria queda acotada por las unidades en vuelo más la cola, no por la región.
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        resumen = {
+            'inicio': time.time(),
+            'celdas': total_celdas,
+            'celdas_enriquecidas': 0,
+            'celdas_fallidas': 0,
+            'celdas_sin_datos': 0,
+            'celdas_escritas': 0,
+            'registros_insertados': 0,
+            'registros_fallidos': 0,
+        }
+        cola = queue.Queue(maxsize=max_en_cola)
+        escritor = threading.Thread(
+            target=self._escritor, args=(cola, resumen, total_celdas, tamaño_lote_escritura, diario), daemon=True
+        )
+        escritor.start()
+
+        max_en_vuelo = 2 * planificador.concurrencia_max
+        try:
+            with ThreadPoolExecutor(max_workers=planificador.concurrencia_max) as ejecutor:
+                en_vuelo = set()
+                for unidad in unidades:
+                    if len(en_vuelo) >= max_en_vuelo:
+                        hechos, en_vuelo = wait(en_vuelo, return_when=FIRST_COMPLETED)
+                        for futuro in hechos:
+                            cola.put(futuro.result())
+                    en_vuelo.add(ejecutor.submit(unidad))
+                for futuro in as_completed(en_vuelo):
+                    cola.put(futuro.result())
+        finally:
+            cola.put(None)
+            escritor.join()
+
+        resumen['segundos'] = round(time.time() - resumen.pop('inicio'), 1)
+        return resumen
+
     def ingestar_region(self, pais: str, departamento: str, ciudad: str,  
-                     tamaño_celda_m: int = 5000):
+                     tamaño_celda_m: int = 5000, modo: str = 'lote', tamaño_lote_gee: int = 100,
+                     agregacion: str = 'mensual', deduplicar_pixeles: bool = True,
+                     fecha_inicio: str = '2023-01-01', fecha_fin: str = '2023-12-31',
+                     reanudar: bool = True, solo_fallidas: bool = False,
+                     incremental: bool = False, max_antiguedad_dias: int = None) -> Dict:
         
         limites = obtener_region(pais, departamento, ciudad)
         """
         Pipeline completo de ingesta para una región con enriquecimiento paralelo y GEE
+        modo: 'lote' (reduceRegions por lotes de tamaño_lote_gee celdas), 'celda' (una consulta por celda)
+              o 'raster' (grillas de la región descargadas una vez, estadísticas zonales en local)
+        agregacion: 'mensual' (agregado en GEE, 12 valores por variable) o 'diaria' (series diarias)
+        deduplicar_pixeles: en modo 'lote', consultar el clima una vez por píxel ERA5/CHIRPS
+        reanudar: usar el diario de ingesta para saltar las celdas ya completadas
+                  (las fallidas quedan en la cola de reintento, ver reintentar_fallidas)
+        solo_fallidas: procesar únicamente las celdas de la cola de reintento
+        incremental: pedir a GEE solo los meses que faltan en clima_mensual o están desactualizados
+                     (ver meses_faltantes) y escribir solo esos meses; revisa todas las celdas de la
+                     grilla, también las ya completadas en el diario (salvo con solo_fallidas)
+        Retorna el resumen de la ingesta (celdas, filas, fallos y tiempos)
         """
         registrador.info(f"\n{'='*70}")
         registrador.info(f"🚀 INICIANDO INGESTA DE TERRENO PARA: {ciudad}, {departamento}, {pais}")
         registrador.info(f"Límites: {limites} | Tamaño celda: {tamaño_celda_m}m")
         if _ee_initialized:
-            registrador.info(f"⚡ MODO: Google Earth Engine ")        
+            registrador.info(f"⚡ MODO: Google Earth Engine ({modo}, agregación {agregacion})")        
+        diario = None
         try:
             # Inicializar GEE si está disponible
             if _ee_initialized:
                 registrador.info("🔌 Inicializando Google Earth Engine...")
                 gee_inicializar()
             
-            # Paso 1: Crear grid
+            # Paso 1: Crear grid recortada al polígono de la región
             registrador.info("📍 Creando celdas de grilla...")
-            celdas = self.crear_celdas_grilla(limites, tamaño_celda_m)
+            geometria = obtener_geometria_region(pais, departamento, ciudad, tolerancia_m=tamaño_celda_m / 10)
+            celdas = self.crear_celdas_grilla(limites, tamaño_celda_m, geometria)
             registrador.info(f"✅ Se crearon {len(celdas)} celdas de grilla\n")
             
             # Agregar datos básicos a todas las celdas
@@ -307,37 +833,58 @@ class IngestionCeldasTerreno:
                 celda['pais_region'] = pais
                 celda['departamento_region'] = departamento
                 celda['ciudad_region'] = ciudad
+
+            # Diario de ingesta: reanudar donde quedó la ejecución anterior
+            if reanudar or solo_fallidas:
+                diario = DiarioIngesta(bd.pool.tomar(), pais, departamento, ciudad,
+                                       tamaño_celda_m, fecha_inicio, fecha_fin)
+                diario.registrar(celda['id_celda'] for celda in celdas)
+                # En modo incremental las celdas completadas también se revisan (meses_faltantes decide)
+                if solo_fallidas or not incremental:
+                    estados = diario.estados()
+                    buscado = 'fallida' if solo_fallidas else 'pendiente'
+                    celdas = [celda for celda in celdas if estados.get(celda['id_celda']) == buscado]
+                registrador.info(f"📒 Diario {diario.id_ingesta}: {diario.progreso()} → {len(celdas)} celdas por procesar")
             
-            # Paso 2: Enriquecer con datos EN PARALELO (12 workers)
-            registrador.info(f"📡 Enriqueciendo {len(celdas)} celdas con datos clima y elevación (MODO PARALELO)...")
-            tiempo_inicio = time.time()
-            
-            celdas_enriquecidas = []
-            with ThreadPoolExecutor(max_workers=4) as ejecutor:
-                # Enviar todas las celdas para enriquecimiento paralelo
-                futuros = {
-                    ejecutor.submit(self.enriquecer_celda, celda, idx, len(celdas)): idx 
-                    for idx, celda in enumerate(celdas)
-                }
-                
-                # Recopilar resultados a medida que se completan
-                for futuro in as_completed(futuros):
-                    celdas_enriquecidas.append(futuro.result())
-            
-            tiempo_transcurrido = time.time() - tiempo_inicio
-            registrador.info(f"✅ Enriquecimiento completado para {len(celdas_enriquecidas)} celdas en {tiempo_transcurrido:.1f} segundos\n")
-            
-            # Paso 3: Insertar en BD
-            registrador.info("💾 Insertando celdas en base de datos PostgreSQL...")
-            self.insertar_celdas(celdas_enriquecidas)
-            tiempo_total = time.time() - tiempo_inicio
+            # Paso 2 y 3: Enriquecer en paralelo e insertar en BD a medida que se completan
+            registrador.info(f"📡 Enriqueciendo {len(celdas)} celdas con datos clima y elevación e insertando en PostgreSQL...")
+            if incremental:
+                faltantes = self.meses_faltantes(celdas, fecha_inicio, fecha_fin, max_antiguedad_dias)
+                al_dia = [celda['id_celda'] for celda in celdas if not faltantes[celda['id_celda']]]
+                registrador.info(f"♻️ Modo incremental: {len(al_dia)} celdas al día, "
+                                 f"{sum(len(m) for m in faltantes.values())} meses-celda por descargar")
+                if diario is not None and al_dia:
+                    diario.marcar(al_dia, {})
+                celdas = [celda for celda in celdas if faltantes[celda['id_celda']]]
+                unidades = self._unidades_incrementales(celdas, faltantes, modo, agregacion, deduplicar_pixeles,
+                                                        tamaño_lote_gee, fecha_inicio, fecha_fin)
+            else:
+                unidades = self._unidades_de_trabajo(celdas, modo, agregacion, deduplicar_pixeles, tamaño_lote_gee,
+                                                     fecha_inicio, fecha_fin)
+            resumen = self.ejecutar_pipeline(unidades, len(celdas), diario=diario)
+
+            if diario is not None:
+                resumen['diario'] = diario.finalizar()
+            if resumen['celdas_fallidas']:
+                registrador.warning(f"⚠️ {resumen['celdas_fallidas']} celdas no se pudieron enriquecer tras los reintentos "
+                                    f"(quedan en la cola de reintento del diario)")
+            registrador.info(f"📶 Planificador GEE: {planificador.metricas()}")
             registrador.info(f"\n{'='*70}")
             registrador.info(f"🎉 ¡INGESTA COMPLETADA EXITOSAMENTE!")
-            registrador.info(f"Tiempo total: {tiempo_total:.1f} segundos ({tiempo_total/60:.1f} minutos)")
+            registrador.info(f"📊 Resumen: {resumen}")
+            registrador.info(f"Tiempo total: {resumen['segundos']:.1f} segundos ({resumen['segundos']/60:.1f} minutos)")
+            return resumen
             
         except Exception as e:
             registrador.error(f"\n❌ ERROR CRÍTICO DURANTE INGESTA: {e}")
             raise
+        finally:
+            # La conexión del diario vuelve al pool también si la ingesta falla
+            if diario is not None:
+                try:
+                    diario.cerrar()
+                finally:
+                    bd.pool.devolver(diario.conexion)
     
 
     def calcular_puntuacion_calidad(self, celda: Dict) -> float:
@@ -368,44 +915,30 @@ class IngestionCeldasTerreno:
 def existe_region (pais: str, departamento: str, ciudad: str) -> bool:
     """
     Consulta rápida para saber si ya existen celdas de esa ciudad.
-    Retorna True si hay datos, False si no.
+    Retorna True si hay datos y ninguna ingesta de la región quedó en curso en el diario
+    (una ingesta en segundo plano escribe por lotes), False si no.
     """
-    import psycopg2
-    from dotenv import load_dotenv
-    import os
-    
-    load_dotenv(dotenv_path="_mientorno.env")
-    
-    # Configuración de conexión (Asegúrate de que coincida con la tuya)
-    config_bd = {
-        'host': 'localhost',
-        'database': 'postgres',
-        'user': 'postgres',
-        'password': 'postgres',
-        'port': 5432
-    }
-    
     existe = False
     try:
-        conn = psycopg2.connect(**config_bd)
-        cur = conn.cursor()
+        with bd.conexion(cursor_factory=None) as conn:
+            cur = conn.cursor()
         
-        # Consulta optimizada: SELECT 1 ... LIMIT 1 es muy rápido
-        # Normalizamos a mayúsculas para evitar errores de "Lima" vs "LIMA"
-        consulta = """
-            SELECT 1 FROM celdas_terreno 
-            WHERE UPPER(pais_region) = UPPER(%s)
-              AND UPPER(departamento_region) = UPPER(%s)
-              AND UPPER(ciudad_region) = UPPER(%s)
-            LIMIT 1;
-        """
-        cur.execute(consulta, (pais, departamento, ciudad))
+            # Consulta optimizada: SELECT 1 ... LIMIT 1 es muy rápido
+            # Las claves normalizadas evitan errores de "Lima" vs "LIMA" o "Huarochirí" vs "Huarochiri"
+            # y permiten podar particiones y usar idx_celdas_clave_region
+            consulta = """
+                SELECT 1 FROM celdas 
+                WHERE pais_clave = clave_region(%s)
+                  AND departamento_clave = clave_region(%s)
+                  AND ciudad_clave = clave_region(%s)
+                LIMIT 1;
+            """
+            cur.execute(consulta, (pais, departamento, ciudad))
         
-        if cur.fetchone():
-            existe = True
+            if cur.fetchone():
+                existe = not ingesta_en_curso(conn, pais, departamento, ciudad)
             
-        cur.close()
-        conn.close()
+            cur.close()
 
     except Exception as e:
         print(f"⚠️ Error verificando existencia: {e}")
@@ -415,12 +948,73 @@ def existe_region (pais: str, departamento: str, ciudad: str) -> bool:
     return existe
 
 
+def buscar_limites_locales(adm0, adm1, adm2):
+    """Bounding box de la región en la tabla local limites_gaul, o None si no está cargada."""
+    try:
+        with bd.conexion(cursor_factory=None) as conexion, conexion.cursor() as cursor:
+            cursor.execute("""
+                SELECT lon_min, lat_min, lon_max, lat_max FROM limites_gaul
+                WHERE clave_region(adm0_name) = clave_region(%s) AND clave_region(adm1_name) = clave_region(%s)
+                  AND clave_region(adm2_name) = clave_region(%s)
+            """, (adm0, adm1, adm2))
+            fila = cursor.fetchone()
+        return tuple(fila) if fila else None
+    except Exception as e:
+        print(f"⚠️ No se pudo consultar limites_gaul: {e}")
+        return None
+
+
+def guardar_limites_locales(adm0, adm1, adm2, geojson):
+    """Guarda el polígono GAUL de la región (y su bounding box) en limites_gaul."""
+    from shapely.geometry import shape
+
+    lon_min, lat_min, lon_max, lat_max = shape(geojson).bounds
+    try:
+        with bd.conexion(cursor_factory=None) as conexion, conexion.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO limites_gaul (adm0_name, adm1_name, adm2_name, lon_min, lat_min, lon_max, lat_max, geometria)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, ST_Multi(ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326)))
+                ON CONFLICT (adm0_name, adm1_name, adm2_name) DO UPDATE SET
+                    lon_min = EXCLUDED.lon_min, lat_min = EXCLUDED.lat_min,
+                    lon_max = EXCLUDED.lon_max, lat_max = EXCLUDED.lat_max,
+                    geometria = EXCLUDED.geometria, cargado = NOW();
+            """, (adm0, adm1, adm2, lon_min, lat_min, lon_max, lat_max, json.dumps(geojson)))
+            conexion.commit()
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la región en limites_gaul: {e}")
+    return (lon_min, lat_min, lon_max, lat_max)
+
+
+def cargar_limites_gaul(adm0):
+    """
+    Carga de una vez en limites_gaul todas las regiones de nivel 2 de un país.
+    Retorna la cantidad de regiones cargadas.
+    """
+    import ee
+
+    regiones = ee.FeatureCollection("FAO/GAUL/2015/level2").filter(ee.Filter.eq("ADM0_NAME", adm0))
+    # getInfo directo (sin la caché de GEE, que solo conserva propiedades)
+    info = planificador.ejecutar(regiones.getInfo)
+    for feature in info['features']:
+        propiedades = feature['properties']
+        guardar_limites_locales(propiedades['ADM0_NAME'], propiedades['ADM1_NAME'], propiedades['ADM2_NAME'],
+                                feature['geometry'])
+    print(f"✅ {len(info['features'])} regiones de {adm0} cargadas en limites_gaul")
+    return len(info['features'])
+
+
 def obtener_region(adm0, adm1, adm2):
     """
     Recibe País (adm0), Región/Depto (adm1) y Ciudad/Provincia (adm2).
+    Busca primero en la tabla local limites_gaul; si no está, la consulta en GEE y la guarda.
     """
     import ee
 
+    limites = buscar_limites_locales(adm0, adm1, adm2)
+    if limites:
+        print(f"✅ Bounds (limites_gaul): {limites[0]:.4f}, {limites[1]:.4f}, {limites[2]:.4f}, {limites[3]:.4f}")
+        return limites
+
     print(f"🌍 Buscando límites para: {adm0} > {adm1} > {adm2} ...")
 
     # Usamos la colección GAUL Nivel 2 (Distrital/Provincial)
@@ -435,47 +1029,64 @@ def obtener_region(adm0, adm1, adm2):
     )
     
     # Verificamos si existe la región
-    if region.size().getInfo() == 0:
+    if descargar(region.size()) == 0:
         print("❌ No se encontró la región en GAUL. Verifica la ortografía (ej: 'Peru' vs 'Perú').")
         return None
 
-    # Obtenemos el rectángulo envolvente (Bounding Box)
-    geom = region.geometry().bounds()
-    
-    # Extraemos las coordenadas del polígono rectangular
-    coords_info = geom.coordinates().get(0).getInfo()
-    
-    lons = [p[0] for p in coords_info]
-    lats = [p[1] for p in coords_info]
-    
-    lon_min, lat_min = min(lons), min(lats)
-    lon_max, lat_max = max(lons), max(lats)
+    # Polígono completo: se guarda en limites_gaul y de él sale el rectángulo envolvente
+    lon_min, lat_min, lon_max, lat_max = guardar_limites_locales(adm0, adm1, adm2, descargar(region.geometry()))
     
     print(f"✅ Bounds encontrados: {lon_min:.4f}, {lat_min:.4f}, {lon_max:.4f}, {lat_max:.4f}")
     
     return (lon_min, lat_min, lon_max, lat_max)
 
 
-# Uso:
-def ingestar(pais, departamento, ciudad):
-    from dotenv import load_dotenv
-    import os
+def obtener_geometria_region(adm0, adm1, adm2, tolerancia_m=100):
+    """
+    Polígono (shapely) de la región desde limites_gaul, simplificado con tolerancia_m metros.
+    Si la región no está cargada la obtiene con obtener_region. Retorna None si no se pudo obtener.
+    """
+    from shapely import wkb
+
+    try:
+        if not buscar_limites_locales(adm0, adm1, adm2) and not obtener_region(adm0, adm1, adm2):
+            return None
+        with bd.conexion(cursor_factory=None) as conexion, conexion.cursor() as cursor:
+            cursor.execute("""
+                SELECT ST_AsBinary(ST_SimplifyPreserveTopology(geometria, %s)) FROM limites_gaul
+                WHERE clave_region(adm0_name) = clave_region(%s) AND clave_region(adm1_name) = clave_region(%s)
+                  AND clave_region(adm2_name) = clave_region(%s)
+            """, (tolerancia_m / ingesta_ee.METROS_POR_GRADO, adm0, adm1, adm2))
+            fila = cursor.fetchone()
+        return wkb.loads(bytes(fila[0])) if fila and fila[0] else None
+    except Exception as e:
+        print(f"⚠️ No se pudo obtener el polígono de la región, se usará el rectángulo: {e}")
+        return None
 
-    load_dotenv(dotenv_path="_mientorno.env") 
+
+def reintentar_fallidas(pais, departamento, ciudad, tamaño_celda_m=2500,
+                        fecha_inicio='2023-01-01', fecha_fin='2023-12-31'):
+    """
+    Vuelve a enriquecer solo las celdas de la cola de reintento del diario de ingesta.
+    Usa lotes sin deduplicar por píxel para aislar mejor las celdas problemáticas.
+    """
+    ingestion = IngestionCeldasTerreno()
     try:
+        return ingestion.ingestar_region(pais, departamento, ciudad, tamaño_celda_m=tamaño_celda_m,
+                                         tamaño_lote_gee=25, deduplicar_pixeles=False,
+                                         fecha_inicio=fecha_inicio, fecha_fin=fecha_fin, solo_fallidas=True)
+    finally:
+        ingestion.cerrar()
 
-        config_bd = {
-        'host': 'localhost',
-        'database': 'postgres',
-        'user': 'postgres',
-        'password': 'postgres',
-        'port': 5432
-        }
-        
-        ingestion = IngestionCeldasTerreno(config_bd)
-        ingestion.ingestar_region(pais, departamento, ciudad, tamaño_celda_m=2500)
-        ingestion.conexion.close()
 
+# Uso:
+def ingestar(pais, departamento, ciudad):
+    try:
+        ingestion = IngestionCeldasTerreno()
+        try:
+            ingestion.ingestar_region(pais, departamento, ciudad, tamaño_celda_m=2500)
+        finally:
+            ingestion.cerrar()
 
     except Exception as e:
         registrador.error(f"Error fatal: {e}")
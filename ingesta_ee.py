@@ -4,6 +4,9 @@ from typing import List, Dict, Any, Optional
 import os
 from modelosIA import llm
 import pandas as pd
+from cache_ee import cache, clave, clave_objeto_ee, descargar
+# ErrorGEE (reintentos agotados) se propaga para no guardar celdas vacías en silencio
+from planificador_ee import ErrorGEE, planificador
 
 
 # Cargar variables de entorno
@@ -13,6 +16,20 @@ load_dotenv(dotenv_path="_mientorno.env")
 gee_project = os.getenv("GEE_PROJECT", "pelagic-cat-476623-u0")
 GEE_DISPONIBLE = False
 
+# Datasets de GEE
+#################################
+
+ERA5_DIARIO = "ECMWF/ERA5_LAND/DAILY_AGGR"
+CHIRPS_DIARIO = "UCSB-CHG/CHIRPS/DAILY"
+SRTM = "CGIAR/SRTM90_V4"
+
+BANDAS_ERA5 = [
+    "temperature_2m",
+    "dewpoint_temperature_2m",
+    "u_component_of_wind_10m",
+    "v_component_of_wind_10m",
+]
+
 # Sesion en Google Earth Engine
 #################################
 
@@ -39,77 +56,57 @@ def log (evento: str):
     print (f"[{ahora}] {evento}")
     return
 
-# Consulta de Viento
+
+# Consulta ERA5 combinada (temperatura, humedad y viento)
 ################################
-def obtener_viento_diaria(geometria, fecha_inicio, fecha_fin):
 
+def obtener_era5_diaria(geometria, fecha_inicio, fecha_fin):
+    """
+    Obtiene temperatura, humedad relativa y viento diarios desde ERA5-Land
+    con un solo reduceRegion por imagen sobre las cuatro bandas.
+    Retorna FeatureCollection con temp_c, humidity_pct y wind_speed.
+    """
     import ee
-    log("Obteniendo viento diario desde EE")
+    log("Obteniendo ERA5 diario (temperatura, humedad, viento) desde EE")
 
     collection = (
-        ee.ImageCollection("ECMWF/ERA5_LAND/DAILY_AGGR")
+        ee.ImageCollection(ERA5_DIARIO)
         .filterDate(fecha_inicio, fecha_fin)
-        .select("u_component_of_wind_10m", "v_component_of_wind_10m")
+        .select(BANDAS_ERA5)
     )
 
-    def viento(img):
-        u_wind = img.select("u_component_of_wind_10m").reduceRegion(
+    def era5(img):
+        valores = img.reduceRegion(
             reducer=ee.Reducer.mean(),
             geometry=geometria,
             scale=10000,
             maxPixels=1e9
         )
-        v_wind = img.select("v_component_of_wind_10m").reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=geometria,
-            scale=10000,
-            maxPixels=1e9
-        )
-        
-    
-        
-        # Calcular magnitud del viento
-        u_value = ee.Number(u_wind.get("u_component_of_wind_10m"))
-        v_value = ee.Number(v_wind.get("v_component_of_wind_10m"))
-        wind_speed = u_value.pow(2).add(v_value.pow(2)).sqrt()
-
-        return ee.Feature(None, {
-            "date": img.date().format("YYYY-MM-dd"),
-            "wind_speed": wind_speed
-        })
-
-    return collection.map(viento)
 
-# Consulta de Temperatura
-################################
-
-def obtener_temperatura_diaria(geometria, fecha_inicio, fecha_fin):
-    import ee
-    log("Obteniendo temperatura diaria desde EE")
+        # Convertir Kelvin a Celsius
+        temp_c = ee.Number(valores.get("temperature_2m")).subtract(273.15)
+        dewpoint_c = ee.Number(valores.get("dewpoint_temperature_2m")).subtract(273.15)
 
-    collection = (
-        ee.ImageCollection("ECMWF/ERA5_LAND/DAILY_AGGR")
-        .filterDate(fecha_inicio, fecha_fin)
-        .select("temperature_2m")
-    )
+        # Humedad relativa con la fórmula de Magnus
+        b = ee.Number(17.27)
+        c = ee.Number(237.7)
+        numerador = b.multiply(temp_c).divide(c.add(temp_c)).exp()
+        denominador = b.multiply(dewpoint_c).divide(c.add(dewpoint_c)).exp()
+        humidity_pct = denominador.divide(numerador).multiply(100)
 
-    def temp(img):
-        temp = img.reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=geometria,
-            scale=10000, # 
-            maxPixels=1e4
-        )
-        
-        # Obtener el valor - la clave es el nombre de la banda seleccionada
-        temp_value = ee.Number(temp.get("temperature_2m")) 
+        # Magnitud del viento
+        u_value = ee.Number(valores.get("u_component_of_wind_10m"))
+        v_value = ee.Number(valores.get("v_component_of_wind_10m"))
+        wind_speed = u_value.pow(2).add(v_value.pow(2)).sqrt()
 
         return ee.Feature(None, {
             "date": img.date().format("YYYY-MM-dd"),
-            "temp_c": temp_value.subtract(273.15) # Convertir de Kelvin a Celsius
+            "temp_c": temp_c,
+            "humidity_pct": humidity_pct,
+            "wind_speed": wind_speed
         })
 
-    return collection.map(temp)
+    return collection.map(era5)
 
 
 # Consulta de Precipitación
@@ -157,65 +154,6 @@ def obtener_precipitacion_diaria(geometria, fecha_inicio, fecha_fin):
         raise
 
 
-# Consulta de Humedad
-################################
-
-def obtener_humedad_diaria(geometria, fecha_inicio, fecha_fin):
-    """
-    Obtiene humedad relativa diaria desde GEE usando ERA5-Land
-    Calcula a partir de temperatura y punto de rocío
-    Retorna FeatureCollection con datos de humedad
-    """
-    import ee
-    log("Obteniendo humedad diaria desde EE")
-
-    collection = (
-        ee.ImageCollection("ECMWF/ERA5_LAND/DAILY_AGGR")
-        .filterDate(fecha_inicio, fecha_fin)
-        .select(["temperature_2m", "dewpoint_temperature_2m"])
-    )
-
-    def humedad(img):
-        # Extraer promedios de T y Td usando reduceRegion
-        temp_value = img.select("temperature_2m").reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=geometria,
-            scale=10000,
-            maxPixels=1e9
-        )
-        
-        dewpoint_value = img.select("dewpoint_temperature_2m").reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=geometria,
-            scale=10000,
-            maxPixels=1e9
-        )
-        
-        # Obtener valores numéricos
-        temp_k = ee.Number(temp_value.get("temperature_2m"))
-        dewpoint_k = ee.Number(dewpoint_value.get("dewpoint_temperature_2m"))
-        
-        # Convertir Kelvin a Celsius
-        temp_c = temp_k.subtract(273.15)
-        dewpoint_c = dewpoint_k.subtract(273.15)
-        
-        # Calcular humedad relativa usando la fórmula de Magnus
-        # RH = 100 * (exp((b*Td)/(c+Td)) / exp((b*T)/(c+T)))
-        b = ee.Number(17.27)
-        c = ee.Number(237.7)
-        
-        numerador = b.multiply(temp_c).divide(c.add(temp_c)).exp()
-        denominador = b.multiply(dewpoint_c).divide(c.add(dewpoint_c)).exp()
-        humidity_pct = denominador.divide(numerador).multiply(100)
-
-        return ee.Feature(None, {
-            "date": img.date().format("YYYY-MM-dd"),
-            "humidity_pct": humidity_pct
-        })
-
-    return collection.map(humedad)
-
-
 # Consulta de Elevación
 ################################
 
@@ -238,7 +176,9 @@ def obtener_elevacion(geometria):
         )
         
         elevation_m = ee.Number(elevation.get("elevation"))
-        return elevation_m.getInfo()
+        return descargar(elevation_m)
+    except ErrorGEE:
+        raise
     except Exception as e:
         log(f"Error obteniendo elevación: {e}")
         # Retornar None si hay error
@@ -248,74 +188,47 @@ def obtener_elevacion(geometria):
 # Descargar serie temporal a python
 #####################################
 
-def ee_to_python(feature_collection):
-    log ("Descargando datos de EE a Python")
-    try:
-        data = feature_collection.getInfo()["features"]
-        result = []
-        for f in data:
-            try:
-                temp_val = f["properties"].get("temp_c")
-                if temp_val is not None:
-                    # Manejo robusto de diferentes formatos de GEE
-                    if isinstance(temp_val, dict):
-                        # Si es diccionario, extraer el valor
-                        temp_val = temp_val.get("value", list(temp_val.values())[0] if temp_val else None)
-                    
-                    if temp_val is not None:
-                        temp_val = float(temp_val)
-                        # si el día de la fecha es el primero del mes
-                        if f["properties"]["date"].endswith("-01"):     # Si es el 1er día del mes
-                            result.append({
-                                "fecha": f["properties"]["date"],
-                                "valor": temp_val
-                        })
-            except Exception as e:
-                log(f"Error procesando valor de temperatura: {e}")
-                continue
-        log(f"✅ Se obtuvieron {len(result)} registros de temperatura")
-        return result
-    except Exception as e:
-        log(f"Error en ee_to_python: {e}")
-        return []
+def _valor_ee(valor):
+    """GEE puede retornar: float, dict, o None"""
+    if isinstance(valor, dict):
+        valor = valor.get("value", list(valor.values())[0] if valor else None)
+    return float(valor) if valor is not None else None
 
 
-def ee_to_python_viento(feature_collection):
-    """Convierte FeatureCollection de viento a diccionario Python"""
-    log("Descargando datos de viento de EE a Python")
+def ee_to_python_era5(feature_collection):
+    """
+    Convierte la FeatureCollection de obtener_era5_diaria a tres series Python
+    (temperatura, humedad, viento) con una sola descarga.
+    """
+    log("Descargando datos ERA5 de EE a Python")
+    temp_data, humedad_data, viento_data = [], [], []
     try:
-        data = feature_collection.getInfo()["features"]
-        result = []
+        data = descargar(feature_collection)["features"]
         for f in data:
-            try:
-                viento_val = f["properties"].get("wind_speed")
-                if viento_val is not None:
-                    # Convertir a float directamente
-                    # GEE puede retornar: float, dict, o None
-                    if isinstance(viento_val, dict):
-                        viento_val = viento_val.get("value", list(viento_val.values())[0] if viento_val else None)
-                    
-                    if viento_val is not None:
-                        viento_val = float(viento_val)
-                        result.append({
-                            "fecha": f["properties"]["date"],
-                            "valor": viento_val
-                        })
-            except Exception as e:
-                log(f"Error procesando valor de viento: {e}")
-                continue
-        log(f"✅ Se obtuvieron {len(result)} registros de viento")
-        return result
+            props = f["properties"]
+            fecha = props["date"]
+            for clave, destino in (("temp_c", temp_data),
+                                   ("humidity_pct", humedad_data),
+                                   ("wind_speed", viento_data)):
+                try:
+                    valor = _valor_ee(props.get(clave))
+                    if valor is not None:
+                        destino.append({"fecha": fecha, "valor": valor})
+                except Exception as e:
+                    log(f"Error procesando valor {clave}: {e}")
+        log(f"✅ Se obtuvieron {len(temp_data)} registros ERA5")
+    except ErrorGEE:
+        raise
     except Exception as e:
-        log(f"Error en ee_to_python_viento: {e}")
-        return []
-    
+        log(f"Error en ee_to_python_era5: {e}")
+    return temp_data, humedad_data, viento_data
+
 
 def ee_to_python_precip(feature_collection):
     """Convierte FeatureCollection de precipitación a diccionario Python"""
     log("Descargando datos de precipitación de EE a Python")
     try:
-        data = feature_collection.getInfo()["features"]
+        data = descargar(feature_collection)["features"]
         if not data:
             log("⚠️ No hay datos de precipitación disponibles")
             return []
@@ -342,135 +255,113 @@ def ee_to_python_precip(feature_collection):
         
         log(f"✅ Se obtuvieron {len(result)} registros de precipitación")
         return result
+    except ErrorGEE:
+        raise
     except Exception as e:
         log(f"Error crítico en ee_to_python_precip: {e}")
         return []
 
 
-def ee_to_python_humedad(feature_collection):
-    """Convierte FeatureCollection de humedad a diccionario Python"""
-    log("Descargando datos de humedad de EE a Python")
-    try:
-        data = feature_collection.getInfo()["features"]
-        result = []
-        for f in data:
-            try:
-                humedad_val = f["properties"].get("humidity_pct")
-                if humedad_val is not None:
-                    # Convertir a float directamente
-                    # GEE puede retornar: float, dict, o None
-                    if isinstance(humedad_val, dict):
-                        humedad_val = humedad_val.get("value", list(humedad_val.values())[0] if humedad_val else None)
-                    
-                    if humedad_val is not None:
-                        humedad_val = float(humedad_val)
-                        result.append({
-                            "fecha": f["properties"]["date"],
-                            "valor": humedad_val
-                        })
-            except Exception as e:
-                log(f"Error procesando valor de humedad: {e}")
-                continue
-        log(f"✅ Se obtuvieron {len(result)} registros de humedad")
-        return result
-    except Exception as e:
-        log(f"Error en ee_to_python_humedad: {e}")
-        return []
+def agregar_series_mensuales(temp_data, precip_data, humedad_data, viento_data):
+    """
+    Agrega series diarias [{'fecha': 'YYYY-MM-DD', 'valor': x}, ...] por mes.
+    Retorna {'2023-01': {...datos...}, ...} (sin la elevación).
+    """
+    import pandas as pd
+    datos_mensuales = {}
+
+    # Convertir a DataFrames para procesamiento mensual
+    df_temp = pd.DataFrame(temp_data)
+    if not df_temp.empty:
+        df_temp['fecha'] = pd.to_datetime(df_temp['fecha'])
+        df_temp['mes'] = df_temp['fecha'].dt.strftime('%Y-%m')
+    
+    df_precip = pd.DataFrame(precip_data)
+    if not df_precip.empty:
+        df_precip['fecha'] = pd.to_datetime(df_precip['fecha'])
+        df_precip['mes'] = df_precip['fecha'].dt.strftime('%Y-%m')
+
+    df_humedad = pd.DataFrame(humedad_data)
+    if not df_humedad.empty:
+        df_humedad['fecha'] = pd.to_datetime(df_humedad['fecha'])
+        df_humedad['mes'] = df_humedad['fecha'].dt.strftime('%Y-%m')
+
+    df_viento = pd.DataFrame(viento_data)
+    if not df_viento.empty:
+        df_viento['fecha'] = pd.to_datetime(df_viento['fecha'])
+        df_viento['mes'] = df_viento['fecha'].dt.strftime('%Y-%m')
+    
+    # Obtener todos los meses únicos
+    meses_unicos = set()
+    if not df_temp.empty:
+        meses_unicos.update(df_temp['mes'].unique())
+    if not df_precip.empty:
+        meses_unicos.update(df_precip['mes'].unique())
+    if not df_humedad.empty:
+        meses_unicos.update(df_humedad['mes'].unique())
+    if not df_viento.empty:
+        meses_unicos.update(df_viento['mes'].unique())
+    
+    # Agregar por mes
+    for mes in sorted(meses_unicos):
+        datos_mes = {}
+        
+        # Temperatura: promedio, mín y máx del mes
+        if not df_temp.empty:
+            temp_mes = df_temp[df_temp['mes'] == mes]['valor'].values
+            if len(temp_mes) > 0:
+                datos_mes['temp_avg'] = round(float(temp_mes.mean()), 2)
+                datos_mes['temp_min'] = round(float(temp_mes.min()), 2)
+                datos_mes['temp_max'] = round(float(temp_mes.max()), 2)
+        
+        # Precipitación: total del mes
+        if not df_precip.empty:
+            precip_mes = df_precip[df_precip['mes'] == mes]['valor'].values
+            if len(precip_mes) > 0:
+                datos_mes['precip_total'] = round(float(precip_mes.sum()), 2)
+                datos_mes['precip_promedio'] = round(float(precip_mes.mean()), 2)
+                datos_mes['precip_total'] = round(float(precip_mes.sum()), 2)   # ESF : Nuevo
+        
+        # Humedad: promedio del mes
+        if not df_humedad.empty:
+            humedad_mes = df_humedad[df_humedad['mes'] == mes]['valor'].values
+            if len(humedad_mes) > 0:
+                datos_mes['humedad_promedio'] = round(float(humedad_mes.mean()), 2)
+
+        # Humedad: promedio del mes
+        if not df_viento.empty:
+            viento_mes = df_viento[df_viento['mes'] == mes]['valor'].values
+            if len(viento_mes) > 0:
+                datos_mes['viento_promedio'] = round(float(viento_mes.mean()), 2)
+        
+        if datos_mes:
+            datos_mensuales[mes] = datos_mes
 
+    return datos_mensuales
 
 
-def enriquecer_celda_gee(geometria, fecha_inicio='2023-01-01', fecha_fin='2023-12-31'):
+def enriquecer_celda_gee(geometria, fecha_inicio='2023-01-01', fecha_fin='2023-12-31', agregacion='diaria'):
+    """
+    agregacion: 'diaria' descarga las series diarias y agrega por mes en pandas;
+                'mensual' agrega en el servidor de GEE (ver enriquecer_celda_gee_mensual).
+    """
+    if agregacion == 'mensual':
+        return enriquecer_celda_gee_mensual(geometria, fecha_inicio, fecha_fin)
 
-    import pandas as pd
     log("Enriqueciendo celda con datos mensuales de GEE...")
-    datos_mensuales = {}
     
     try:
-        # Temperatura diaria
-        log("  Procesando temperatura...")
-        fc_temp = obtener_temperatura_diaria(geometria, fecha_inicio, fecha_fin)
-        temp_data = ee_to_python(fc_temp)
+        # Temperatura, humedad y viento diarios (una sola reducción ERA5)
+        log("  Procesando temperatura, humedad y viento...")
+        fc_era5 = obtener_era5_diaria(geometria, fecha_inicio, fecha_fin)
+        temp_data, humedad_data, viento_data = ee_to_python_era5(fc_era5)
         
         # Precipitación diaria
         log("  Procesando precipitación...")
         fc_precip = obtener_precipitacion_diaria(geometria, fecha_inicio, fecha_fin)
         precip_data = ee_to_python_precip(fc_precip)
         
-        # Humedad diaria
-        log("  Procesando humedad...")
-        fc_humedad = obtener_humedad_diaria(geometria, fecha_inicio, fecha_fin)
-        humedad_data = ee_to_python_humedad(fc_humedad)
-
-        log("  Procesando viento...")
-        fc_viento = obtener_viento_diaria(geometria, fecha_inicio, fecha_fin)
-        viento_data = ee_to_python_viento(fc_viento)
-        
-        # Convertir a DataFrames para procesamiento mensual
-        df_temp = pd.DataFrame(temp_data)
-        if not df_temp.empty:
-            df_temp['fecha'] = pd.to_datetime(df_temp['fecha'])
-            df_temp['mes'] = df_temp['fecha'].dt.strftime('%Y-%m')
-        
-        df_precip = pd.DataFrame(precip_data)
-        if not df_precip.empty:
-            df_precip['fecha'] = pd.to_datetime(df_precip['fecha'])
-            df_precip['mes'] = df_precip['fecha'].dt.strftime('%Y-%m')
-
-        df_humedad = pd.DataFrame(humedad_data)
-        if not df_humedad.empty:
-            df_humedad['fecha'] = pd.to_datetime(df_humedad['fecha'])
-            df_humedad['mes'] = df_humedad['fecha'].dt.strftime('%Y-%m')
-
-        df_viento = pd.DataFrame(viento_data)
-        if not df_viento.empty:
-            df_viento['fecha'] = pd.to_datetime(df_viento['fecha'])
-            df_viento['mes'] = df_viento['fecha'].dt.strftime('%Y-%m')
-        
-        # Obtener todos los meses únicos
-        meses_unicos = set()
-        if not df_temp.empty:
-            meses_unicos.update(df_temp['mes'].unique())
-        if not df_precip.empty:
-            meses_unicos.update(df_precip['mes'].unique())
-        if not df_humedad.empty:
-            meses_unicos.update(df_humedad['mes'].unique())
-        if not df_viento.empty:
-            meses_unicos.update(df_viento['mes'].unique())
-        
-        # Agregar por mes
-        for mes in sorted(meses_unicos):
-            datos_mes = {}
-            
-            # Temperatura: promedio, mín y máx del mes
-            if not df_temp.empty:
-                temp_mes = df_temp[df_temp['mes'] == mes]['valor'].values
-                if len(temp_mes) > 0:
-                    datos_mes['temp_avg'] = round(float(temp_mes.mean()), 2)
-                    datos_mes['temp_min'] = round(float(temp_mes.min()), 2)
-                    datos_mes['temp_max'] = round(float(temp_mes.max()), 2)
-            
-            # Precipitación: total del mes
-            if not df_precip.empty:
-                precip_mes = df_precip[df_precip['mes'] == mes]['valor'].values
-                if len(precip_mes) > 0:
-                    datos_mes['precip_total'] = round(float(precip_mes.sum()), 2)
-                    datos_mes['precip_promedio'] = round(float(precip_mes.mean()), 2)
-                    datos_mes['precip_total'] = round(float(precip_mes.sum()), 2)   # ESF : Nuevo
-            
-            # Humedad: promedio del mes
-            if not df_humedad.empty:
-                humedad_mes = df_humedad[df_humedad['mes'] == mes]['valor'].values
-                if len(humedad_mes) > 0:
-                    datos_mes['humedad_promedio'] = round(float(humedad_mes.mean()), 2)
-
-            # Humedad: promedio del mes
-            if not df_viento.empty:
-                viento_mes = df_viento[df_viento['mes'] == mes]['valor'].values
-                if len(viento_mes) > 0:
-                    datos_mes['viento_promedio'] = round(float(viento_mes.mean()), 2)
-            
-            if datos_mes:
-                datos_mensuales[mes] = datos_mes
+        datos_mensuales = agregar_series_mensuales(temp_data, precip_data, humedad_data, viento_data)
         
         # Elevación (constante para toda la celda)
         log("  Procesando elevación...")
@@ -481,11 +372,625 @@ def enriquecer_celda_gee(geometria, fecha_inicio='2023-01-01', fecha_fin='2023-1
         log(f"✅ Celda enriquecida con datos de {len(datos_mensuales)-1} meses")
         return datos_mensuales
         
+    except ErrorGEE:
+        raise
+    except Exception as e:
+        log(f"❌ Error enriqueciendo celda: {e}")
+        return {}
+
+
+# Agregación mensual en el servidor
+########################################
+# En lugar de descargar 365 valores diarios por variable, GEE agrega cada mes
+# y solo viajan 12 x N valores por celda. Se construyen dos imágenes apiladas
+# (una banda por mes y variable, p.ej. '202301_temp_avg'):
+#   - clima: derivadas de ERA5, se reducen con mean a 10 km
+#   - lluvia: CHIRPS, se reduce con sum a 5 km (igual que la consulta diaria)
+
+VARIABLES_CLIMA_MENSUAL = ["temp_avg", "temp_min", "temp_max", "humedad_promedio", "viento_promedio"]
+VARIABLES_LLUVIA_MENSUAL = ["precip_total", "precip_promedio"]
+
+
+def meses_entre(fecha_inicio, fecha_fin):
+    """
+    Lista de (YYYYMM, inicio, fin) para cada mes de [fecha_inicio, fecha_fin),
+    recortando el primer y el último mes al rango pedido.
+    """
+    from datetime import date
+
+    inicio = date.fromisoformat(fecha_inicio)
+    fin = date.fromisoformat(fecha_fin)
+    meses = []
+    actual = date(inicio.year, inicio.month, 1)
+    while actual < fin:
+        siguiente = date(actual.year + (actual.month // 12), actual.month % 12 + 1, 1)
+        meses.append((
+            actual.strftime("%Y%m"),
+            max(actual, inicio).isoformat(),
+            min(siguiente, fin).isoformat(),
+        ))
+        actual = siguiente
+    return meses
+
+
+def _derivar_era5(img):
+    """Bandas diarias temp_c, humidity_pct y wind_speed calculadas por píxel."""
+    import ee
+    temp_c = img.select("temperature_2m").subtract(273.15)
+    dewpoint_c = img.select("dewpoint_temperature_2m").subtract(273.15)
+    humedad = img.expression(
+        "100 * exp((17.27 * TD) / (237.7 + TD)) / exp((17.27 * T) / (237.7 + T))",
+        {"T": temp_c, "TD": dewpoint_c},
+    )
+    viento = img.expression(
+        "sqrt(U ** 2 + V ** 2)",
+        {"U": img.select("u_component_of_wind_10m"), "V": img.select("v_component_of_wind_10m")},
+    )
+    return ee.Image.cat([temp_c.rename("temp_c"), humedad.rename("humidity_pct"), viento.rename("wind_speed")])
+
+
+def _mes_o_vacia(coleccion, imagen, bandas):
+    """Si el mes no tiene imágenes (p.ej. meses recientes sin publicar) retorna una imagen enmascarada."""
+    import ee
+    vacia = ee.Image.constant([0] * len(bandas)).rename(bandas).updateMask(0)
+    return ee.Image(ee.Algorithms.If(coleccion.size().gt(0), imagen, vacia))
+
+
+def imagenes_mensuales(fecha_inicio, fecha_fin):
+    """
+    Retorna (img_clima, img_lluvia) con una banda por mes y variable.
+    Nota: temp_min/temp_max son mín/máx diarios por píxel; en celdas que caen en
+    un solo píxel ERA5 coincide con el mín/máx de la serie diaria de la celda.
+    """
+    import ee
+
+    era5 = (
+        ee.ImageCollection(ERA5_DIARIO)
+        .filterDate(fecha_inicio, fecha_fin)
+        .select(BANDAS_ERA5)
+        .map(_derivar_era5)
+    )
+    chirps = (
+        ee.ImageCollection(CHIRPS_DIARIO)
+        .filterDate(fecha_inicio, fecha_fin)
+        .select("precipitation")
+    )
+
+    bandas_clima, bandas_lluvia = [], []
+    for mes, inicio, fin in meses_entre(fecha_inicio, fecha_fin):
+        era5_mes = era5.filterDate(inicio, fin)
+        temp = era5_mes.select("temp_c")
+        nombres = [f"{mes}_{v}" for v in VARIABLES_CLIMA_MENSUAL]
+        clima = ee.Image.cat([
+            temp.mean().rename(nombres[0]),
+            temp.min().rename(nombres[1]),
+            temp.max().rename(nombres[2]),
+            era5_mes.select("humidity_pct").mean().rename(nombres[3]),
+            era5_mes.select("wind_speed").mean().rename(nombres[4]),
+        ])
+        bandas_clima.append(_mes_o_vacia(era5_mes, clima, nombres))
+
+        chirps_mes = chirps.filterDate(inicio, fin)
+        nombres = [f"{mes}_{v}" for v in VARIABLES_LLUVIA_MENSUAL]
+        lluvia = ee.Image.cat([
+            chirps_mes.sum().rename(nombres[0]),
+            chirps_mes.mean().rename(nombres[1]),
+        ])
+        bandas_lluvia.append(_mes_o_vacia(chirps_mes, lluvia, nombres))
+
+    return ee.Image.cat(bandas_clima), ee.Image.cat(bandas_lluvia)
+
+
+def _datos_mensuales_desde_mensual(prop_clima, prop_lluvia, prop_srtm):
+    """Convierte propiedades '202301_temp_avg': x, ... al diccionario datos_mensuales."""
+    datos_mensuales = {}
+    for propiedades in (prop_clima, prop_lluvia):
+        for nombre, valor in propiedades.items():
+            partes = nombre.split("_", 1)
+            if len(partes) != 2 or len(partes[0]) != 6 or not partes[0].isdigit():
+                continue
+            valor = _valor_ee(valor)
+            if valor is None:
+                continue
+            mes = f"{partes[0][0:4]}-{partes[0][4:6]}"
+            datos_mensuales.setdefault(mes, {})[partes[1]] = round(valor, 2)
+
+    datos_mensuales = dict(sorted(datos_mensuales.items()))
+
+    elevacion = _valor_ee(prop_srtm.get("mean", prop_srtm.get("elevation")))
+    if elevacion is not None:
+        datos_mensuales['elevacion'] = round(elevacion, 2)
+    return datos_mensuales
+
+
+def enriquecer_celda_gee_mensual(geometria, fecha_inicio='2023-01-01', fecha_fin='2023-12-31'):
+    """
+    Enriquece una celda agregando por mes en GEE: una sola descarga con
+    12 x N valores más la elevación. Mismo formato que enriquecer_celda_gee.
+    """
+    import ee
+    log("Enriqueciendo celda con agregación mensual en GEE...")
+
+    try:
+        img_clima, img_lluvia = imagenes_mensuales(fecha_inicio, fecha_fin)
+        prop_clima, prop_lluvia, prop_srtm = descargar(ee.List([
+            img_clima.reduceRegion(reducer=ee.Reducer.mean(), geometry=geometria, scale=10000, maxPixels=1e9),
+            img_lluvia.reduceRegion(reducer=ee.Reducer.sum(), geometry=geometria, scale=5000, maxPixels=1e9),
+            ee.Image(SRTM).select("elevation").reduceRegion(reducer=ee.Reducer.mean(), geometry=geometria, scale=90, maxPixels=1e9),
+        ]))
+
+        datos_mensuales = _datos_mensuales_desde_mensual(prop_clima, prop_lluvia, prop_srtm)
+        log(f"✅ Celda enriquecida con datos de {len(datos_mensuales)-1} meses")
+        return datos_mensuales
+    except ErrorGEE:
+        raise
     except Exception as e:
         log(f"❌ Error enriqueciendo celda: {e}")
         return {}
 
 
+# Extracción por lotes (reduceRegions)
+########################################
+# Una sola descarga (getInfo) por lote de celdas: cada colección diaria se
+# apila con toBands() (una banda por día y variable) y se reduce sobre toda
+# la FeatureCollection de celdas con reduceRegions.
+
+def kelvin_a_celsius(temp_k):
+    return temp_k - 273.15
+
+
+def humedad_magnus(temp_c, dewpoint_c):
+    """Humedad relativa (%) con la fórmula de Magnus, igual que obtener_era5_diaria."""
+    import numpy as np
+    b, c = 17.27, 237.7
+    numerador = np.exp((b * temp_c) / (c + temp_c))
+    denominador = np.exp((b * dewpoint_c) / (c + dewpoint_c))
+    return denominador / numerador * 100
+
+
+def velocidad_viento(u, v):
+    import numpy as np
+    return np.sqrt(np.power(u, 2) + np.power(v, 2))
+
+
+def _reducir_celdas(imagen, fc_celdas, reductor, escala):
+    """reduceRegions sobre las celdas, sin devolver geometrías (solo propiedades)."""
+    return imagen.reduceRegions(
+        collection=fc_celdas,
+        reducer=reductor,
+        scale=escala,
+    ).select([".*"], None, False)
+
+
+def _series_por_banda(propiedades):
+    """
+    Convierte propiedades de toBands() ('20230101_temperature_2m': x, ...)
+    a {banda: {'2023-01-01': x, ...}}.
+    """
+    series = {}
+    for nombre, valor in propiedades.items():
+        partes = nombre.split("_", 1)
+        if len(partes) != 2 or len(partes[0]) != 8 or not partes[0].isdigit():
+            continue
+        if valor is None:
+            continue
+        dia, banda = partes
+        fecha = f"{dia[0:4]}-{dia[4:6]}-{dia[6:8]}"
+        series.setdefault(banda, {})[fecha] = float(valor)
+    return series
+
+
+def _datos_mensuales_desde_lote(prop_era5, prop_chirps, prop_srtm):
+    """Reconstruye el diccionario datos_mensuales de una celda a partir de las propiedades del lote."""
+    era5 = _series_por_banda(prop_era5)
+    chirps = _series_por_banda(prop_chirps)
+
+    temp_data, humedad_data, viento_data = [], [], []
+    temp = era5.get("temperature_2m", {})
+    dewpoint = era5.get("dewpoint_temperature_2m", {})
+    u_wind = era5.get("u_component_of_wind_10m", {})
+    v_wind = era5.get("v_component_of_wind_10m", {})
+
+    for fecha in sorted(temp):
+        temp_c = kelvin_a_celsius(temp[fecha])
+        temp_data.append({"fecha": fecha, "valor": temp_c})
+        if fecha in dewpoint:
+            humedad = humedad_magnus(temp_c, kelvin_a_celsius(dewpoint[fecha]))
+            humedad_data.append({"fecha": fecha, "valor": float(humedad)})
+
+    for fecha in sorted(u_wind):
+        if fecha in v_wind:
+            viento = velocidad_viento(u_wind[fecha], v_wind[fecha])
+            viento_data.append({"fecha": fecha, "valor": float(viento)})
+
+    precip_data = [
+        {"fecha": fecha, "valor": valor}
+        for fecha, valor in sorted(chirps.get("precipitation", {}).items())
+    ]
+
+    datos_mensuales = agregar_series_mensuales(temp_data, precip_data, humedad_data, viento_data)
+
+    # Imagen de una banda con reductor de una salida -> propiedad 'mean'
+    elevacion = prop_srtm.get("mean", prop_srtm.get("elevation"))
+    if elevacion is not None:
+        datos_mensuales['elevacion'] = round(float(elevacion), 2)
+
+    return datos_mensuales
+
+
+def enriquecer_celdas_gee_lote(fc_celdas, fecha_inicio='2023-01-01', fecha_fin='2023-12-31', agregacion='diaria',
+                               incluir_elevacion=True):
+    """
+    Enriquece un lote de celdas en una sola llamada a GEE.
+
+    fc_celdas: ee.FeatureCollection con la propiedad 'id_celda' en cada feature.
+    agregacion: 'diaria' (series diarias con toBands) o 'mensual' (agregado en GEE).
+    incluir_elevacion: False para pedir solo el clima (ver obtener_elevacion_lote).
+    Retorna {id_celda: datos_mensuales} con la misma forma que enriquecer_celda_gee.
+    """
+    import ee
+    log(f"Enriqueciendo lote de celdas con reduceRegions ({agregacion})...")
+
+    if agregacion == 'mensual':
+        era5, chirps = imagenes_mensuales(fecha_inicio, fecha_fin)
+        convertir = _datos_mensuales_desde_mensual
+    else:
+        era5 = (
+            ee.ImageCollection(ERA5_DIARIO)
+            .filterDate(fecha_inicio, fecha_fin)
+            .select(BANDAS_ERA5)
+            .toBands()
+        )
+        chirps = (
+            ee.ImageCollection(CHIRPS_DIARIO)
+            .filterDate(fecha_inicio, fecha_fin)
+            .select("precipitation")
+            .toBands()
+        )
+        convertir = _datos_mensuales_desde_lote
+
+    # Mismos reductores y escalas que las consultas por celda
+    consultas = [
+        _reducir_celdas(era5, fc_celdas, ee.Reducer.mean(), 10000),
+        _reducir_celdas(chirps, fc_celdas, ee.Reducer.sum(), 5000),
+    ]
+    if incluir_elevacion:
+        consultas.append(_reducir_celdas(ee.Image(SRTM).select("elevation"), fc_celdas, ee.Reducer.mean(), 90))
+    respuesta = descargar(ee.List(consultas))
+
+    props_era5, props_chirps = _propiedades_por_celda(respuesta[0]), _propiedades_por_celda(respuesta[1])
+    props_srtm = _propiedades_por_celda(respuesta[2]) if incluir_elevacion else {}
+
+    resultados = {}
+    for id_celda, prop_era5 in props_era5.items():
+        try:
+            resultados[id_celda] = convertir(
+                prop_era5,
+                props_chirps.get(id_celda, {}),
+                props_srtm.get(id_celda, {}),
+            )
+        except Exception as e:
+            log(f"Error procesando celda {id_celda} del lote: {e}")
+            resultados[id_celda] = {}
+
+    log(f"✅ Lote enriquecido: {len(resultados)} celdas")
+    return resultados
+
+
+def _propiedades_por_celda(fc_info):
+    return {
+        f["properties"]["id_celda"]: f["properties"]
+        for f in fc_info["features"]
+    }
+
+
+def obtener_elevacion_lote(fc_celdas):
+    """Elevación promedio (SRTM) de un lote de celdas: {id_celda: metros}."""
+    import ee
+    log("Obteniendo elevación del lote desde EE")
+    info = descargar(_reducir_celdas(ee.Image(SRTM).select("elevation"), fc_celdas, ee.Reducer.mean(), 90))
+    elevaciones = {}
+    for id_celda, props in _propiedades_por_celda(info).items():
+        elevacion = _valor_ee(props.get("mean", props.get("elevation")))
+        if elevacion is not None:
+            elevaciones[id_celda] = round(elevacion, 2)
+    return elevaciones
+
+
+# Deduplicación por píxel de origen
+########################################
+# Con celdas más finas que ERA5 (~10 km) o CHIRPS (~5 km), muchas celdas vecinas
+# caen en los mismos píxeles de origen. Se agrupan por los píxeles que contienen
+# su centroide, se consulta el clima una vez por grupo y se reparte a todas las
+# celdas del grupo. La elevación (SRTM, 90 m) sí se consulta por celda.
+
+def indice_pixel(lon, lat, grilla):
+    """(columna, fila) del píxel de una grilla nativa (escala, lon_ref, lat_ref) que contiene el punto."""
+    import math
+    escala, lon_ref, lat_ref = grilla
+    return math.floor((lon - lon_ref) / escala), math.floor((lat_ref - lat) / escala)
+
+
+def grillas_clima():
+    """Grillas nativas de ERA5 y CHIRPS (una consulta en caché cada una)."""
+    import ee
+    return [
+        grilla_nativa(ee.ImageCollection(ERA5_DIARIO).first()),
+        grilla_nativa(ee.ImageCollection(CHIRPS_DIARIO).first()),
+    ]
+
+
+def agrupar_por_pixel(puntos, grillas):
+    """
+    Agrupa puntos [(lon, lat), ...] que caen en los mismos píxeles de todas las grillas.
+    Retorna lista de grupos, cada uno con los índices de sus puntos.
+    """
+    grupos = {}
+    for idx, (lon, lat) in enumerate(puntos):
+        clave_pixel = tuple(indice_pixel(lon, lat, grilla) for grilla in grillas)
+        grupos.setdefault(clave_pixel, []).append(idx)
+    return list(grupos.values())
+
+
+
+
+# Modo raster: grillas por región
+########################################
+# ERA5 (~0.1°) y CHIRPS (0.05°) son mucho más gruesos que las celdas. En este
+# modo cada variable se descarga una sola vez como arreglo NumPy para todo el
+# rectángulo de la región (ee.data.computePixels, por tiles) y las estadísticas
+# zonales de cada celda se calculan localmente.
+
+SIN_DATO = -9999.0
+MAX_BYTES_TILE = 32 * 1024 * 1024
+METROS_POR_GRADO = 111319.49
+
+
+def grilla_nativa(imagen):
+    """
+    (escala, lon_ref, lat_ref) de la proyección nativa EPSG:4326 de una imagen,
+    para pedir los píxeles alineados a la grilla original del dataset.
+    """
+    proyeccion = descargar(imagen.projection())
+    escala_x, _, lon_ref, _, escala_y, lat_ref = proyeccion["transform"]
+    return abs(escala_x), lon_ref, lat_ref
+
+
+def _descargar_tile(imagen, lon_origen, lat_origen, escala, ancho, alto):
+    """Descarga un tile (bandas, alto, ancho) con computePixels, pasando por la caché."""
+    import ee
+    import numpy as np
+
+    clave_tile = clave("tile", clave_objeto_ee(imagen), lon_origen, lat_origen, escala, ancho, alto)
+    arreglo = cache.obtener_arreglo(clave_tile)
+    nombres = cache.obtener(clave_tile + ":bandas")
+    if arreglo is None or nombres is None:
+        datos = planificador.ejecutar(ee.data.computePixels, {
+            "expression": imagen,
+            "fileFormat": "NUMPY_NDARRAY",
+            "grid": {
+                "dimensions": {"width": ancho, "height": alto},
+                "affineTransform": {
+                    "scaleX": escala, "shearX": 0, "translateX": lon_origen,
+                    "shearY": 0, "scaleY": -escala, "translateY": lat_origen,
+                },
+                "crsCode": "EPSG:4326",
+            },
+        })
+        nombres = list(datos.dtype.names)
+        arreglo = np.stack([datos[n] for n in nombres]).astype(np.float32)
+        cache.guardar_arreglo(clave_tile, arreglo)
+        cache.guardar(clave_tile + ":bandas", nombres)
+
+    arreglo = arreglo.copy()
+    arreglo[arreglo == SIN_DATO] = np.nan
+    return arreglo, nombres
+
+
+def descargar_grilla(imagen, limites, grilla, num_bandas=1):
+    """
+    Descarga una imagen como arreglo float32 (bandas, filas, columnas) que cubre
+    limites = (lon_min, lat_min, lon_max, lat_max), alineado a grilla = (escala, lon_ref, lat_ref).
+    Retorna (arreglo, nombres_bandas, transformacion) con
+    transformacion = (lon_origen, lat_origen, escala) de la esquina superior izquierda.
+    Los píxeles sin dato quedan como NaN.
+    """
+    import math
+    import numpy as np
+
+    escala, lon_ref, lat_ref = grilla
+    lon_min, lat_min, lon_max, lat_max = limites
+    lon_origen = lon_ref + math.floor((lon_min - lon_ref) / escala) * escala
+    lat_origen = lat_ref - math.floor((lat_ref - lat_max) / escala) * escala
+    ancho = max(1, math.ceil((lon_max - lon_origen) / escala))
+    alto = max(1, math.ceil((lat_origen - lat_min) / escala))
+
+    # Tiles cuadrados que respeten el límite de tamaño por petición
+    lado = int(max(1, min(1024, math.sqrt(MAX_BYTES_TILE / (4 * max(1, num_bandas))))))
+    imagen = imagen.toFloat().unmask(SIN_DATO)
+
+    log(f"Descargando grilla {alto}x{ancho} px ({num_bandas} bandas) en tiles de {lado}px")
+    arreglo, nombres = None, None
+    for fila in range(0, alto, lado):
+        for col in range(0, ancho, lado):
+            alto_tile = min(lado, alto - fila)
+            ancho_tile = min(lado, ancho - col)
+            tile, nombres = _descargar_tile(
+                imagen,
+                lon_origen + col * escala,
+                lat_origen - fila * escala,
+                escala, ancho_tile, alto_tile,
+            )
+            if arreglo is None:
+                arreglo = np.full((tile.shape[0], alto, ancho), np.nan, dtype=np.float32)
+            arreglo[:, fila:fila + alto_tile, col:col + ancho_tile] = tile
+
+    return arreglo, nombres, (lon_origen, lat_origen, escala)
+
+
+def estadistica_zonal(arreglo, transformacion, cajas, estadistico="mean", escala_suma_m=None):
+    """
+    Estadística por celda sobre un arreglo (bandas, filas, columnas).
+    cajas: arreglo (N, 4) con lon_min, lat_min, lon_max, lat_max de cada celda.
+    Cada píxel pesa según la fracción que cubre la celda, como en reduceRegion:
+      - 'mean': media ponderada
+      - 'sum': suma ponderada; escala_suma_m reproduce la escala (m) usada por
+        reduceRegion(ee.Reducer.sum()) en la consulta por celda.
+    Retorna arreglo (bandas, N); NaN donde la celda no tiene píxeles válidos.
+    """
+    import numpy as np
+
+    lon_origen, lat_origen, escala = transformacion
+    _, alto, ancho = arreglo.shape
+    cajas = np.asarray(cajas, dtype=np.float64)
+
+    # Coordenadas de las cajas en unidades de píxel
+    u0 = (cajas[:, 0] - lon_origen) / escala
+    u1 = (cajas[:, 2] - lon_origen) / escala
+    v0 = (lat_origen - cajas[:, 3]) / escala
+    v1 = (lat_origen - cajas[:, 1]) / escala
+    col0 = np.floor(u0).astype(np.int64)
+    fila0 = np.floor(v0).astype(np.int64)
+    span_x = int((np.ceil(u1) - col0).max())
+    span_y = int((np.ceil(v1) - fila0).max())
+
+    numerador = np.zeros((arreglo.shape[0], len(cajas)))
+    pesos = np.zeros((arreglo.shape[0], len(cajas)))
+
+    for i in range(span_y):
+        fila = fila0 + i
+        peso_y = np.clip(np.minimum(v1, fila + 1) - np.maximum(v0, fila), 0, 1)
+        for j in range(span_x):
+            col = col0 + j
+            peso_x = np.clip(np.minimum(u1, col + 1) - np.maximum(u0, col), 0, 1)
+            peso = peso_x * peso_y
+            dentro = (peso > 0) & (fila >= 0) & (fila < alto) & (col >= 0) & (col < ancho)
+            idx = np.nonzero(dentro)[0]
+            if len(idx) == 0:
+                continue
+            valores = arreglo[:, fila[idx], col[idx]]
+            valido = ~np.isnan(valores)
+            numerador[:, idx] += np.where(valido, valores, 0) * peso[idx]
+            pesos[:, idx] += valido * peso[idx]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if estadistico == "sum":
+            factor = 1.0
+            if escala_suma_m:
+                factor = (escala * METROS_POR_GRADO / escala_suma_m) ** 2
+            return np.where(pesos > 0, numerador * factor, np.nan)
+        return np.where(pesos > 0, numerador / pesos, np.nan)
+
+
+def _fechas_de_bandas(nombres):
+    """'20230101_temperature_2m' -> '2023-01-01'"""
+    return [f"{n[0:4]}-{n[4:6]}-{n[6:8]}" for n in nombres]
+
+
+def _agregar_mensual_arreglos(fechas_era5, temp_c, humedad, viento, fechas_precip, precip, elevacion):
+    """
+    Agrega series diarias (días, N) por mes en forma vectorizada y arma la lista
+    de diccionarios datos_mensuales (uno por celda, mismo formato que enriquecer_celda_gee).
+    """
+    import warnings
+    import numpy as np
+
+    meses_era5 = np.array([f[:7] for f in fechas_era5])
+    meses_precip = np.array([f[:7] for f in fechas_precip])
+    meses = sorted(set(meses_era5.tolist()) | set(meses_precip.tolist()))
+
+    variables = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for mes in meses:
+            sel = meses_era5 == mes
+            if sel.any():
+                variables[(mes, "temp_avg")] = np.nanmean(temp_c[sel], axis=0)
+                variables[(mes, "temp_min")] = np.nanmin(temp_c[sel], axis=0)
+                variables[(mes, "temp_max")] = np.nanmax(temp_c[sel], axis=0)
+                variables[(mes, "humedad_promedio")] = np.nanmean(humedad[sel], axis=0)
+                variables[(mes, "viento_promedio")] = np.nanmean(viento[sel], axis=0)
+
+            sel = meses_precip == mes
+            if sel.any():
+                precip_mes = precip[sel]
+                total = np.nansum(precip_mes, axis=0)
+                total[np.isnan(precip_mes).all(axis=0)] = np.nan
+                variables[(mes, "precip_total")] = total
+                variables[(mes, "precip_promedio")] = np.nanmean(precip_mes, axis=0)
+
+    n_celdas = len(elevacion)
+    resultados = []
+    for k in range(n_celdas):
+        datos_mensuales = {}
+        for (mes, variable), valores in variables.items():
+            valor = valores[k]
+            if not np.isnan(valor):
+                datos_mensuales.setdefault(mes, {})[variable] = round(float(valor), 2)
+        datos_mensuales = dict(sorted(datos_mensuales.items()))
+        if not np.isnan(elevacion[k]):
+            datos_mensuales['elevacion'] = round(float(elevacion[k]), 2)
+        resultados.append(datos_mensuales)
+    return resultados
+
+
+def enriquecer_celdas_raster(cajas, fecha_inicio='2023-01-01', fecha_fin='2023-12-31', limites=None):
+    """
+    Enriquece todas las celdas de una región descargando las grillas de ERA5,
+    CHIRPS y SRTM una sola vez (O(tiles) llamadas en lugar de O(celdas)).
+
+    cajas: lista/arreglo (N, 4) de lon_min, lat_min, lon_max, lat_max por celda.
+    limites: rectángulo a descargar; por defecto el que envuelve todas las cajas.
+    Retorna lista de datos_mensuales alineada con cajas.
+    """
+    import ee
+    import numpy as np
+    from datetime import date
+
+    cajas = np.asarray(cajas, dtype=np.float64)
+    if limites is None:
+        limites = (cajas[:, 0].min(), cajas[:, 1].min(), cajas[:, 2].max(), cajas[:, 3].max())
+    num_dias = (date.fromisoformat(fecha_fin) - date.fromisoformat(fecha_inicio)).days + 1
+    log(f"Enriqueciendo {len(cajas)} celdas en modo raster...")
+
+    era5 = ee.ImageCollection(ERA5_DIARIO).filterDate(fecha_inicio, fecha_fin)
+    chirps = ee.ImageCollection(CHIRPS_DIARIO).filterDate(fecha_inicio, fecha_fin).select("precipitation")
+    srtm = ee.Image(SRTM).select("elevation")
+
+    # ERA5: media zonal de cada banda cruda, luego derivadas en local
+    grilla_era5 = grilla_nativa(era5.first())
+    medias_era5 = {}
+    fechas_era5 = None
+    for banda in BANDAS_ERA5:
+        arreglo, nombres, transformacion = descargar_grilla(
+            era5.select(banda).toBands(), limites, grilla_era5, num_dias
+        )
+        medias_era5[banda] = estadistica_zonal(arreglo, transformacion, cajas, "mean")
+        fechas_era5 = _fechas_de_bandas(nombres)
+
+    temp_c = kelvin_a_celsius(medias_era5["temperature_2m"])
+    dewpoint_c = kelvin_a_celsius(medias_era5["dewpoint_temperature_2m"])
+    humedad = humedad_magnus(temp_c, dewpoint_c)
+    viento = velocidad_viento(medias_era5["u_component_of_wind_10m"], medias_era5["v_component_of_wind_10m"])
+
+    # CHIRPS: suma zonal a 5 km, igual que obtener_precipitacion_diaria
+    arreglo, nombres, transformacion = descargar_grilla(
+        chirps.toBands(), limites, grilla_nativa(chirps.first()), num_dias
+    )
+    precip = estadistica_zonal(arreglo, transformacion, cajas, "sum", escala_suma_m=5000)
+    fechas_precip = _fechas_de_bandas(nombres)
+
+    # SRTM: media zonal a resolución nativa
+    arreglo, _, transformacion = descargar_grilla(srtm, limites, grilla_nativa(srtm), 1)
+    elevacion = estadistica_zonal(arreglo, transformacion, cajas, "mean")[0]
+
+    resultados = _agregar_mensual_arreglos(
+        fechas_era5, temp_c, humedad, viento, fechas_precip, precip, elevacion
+    )
+    log(f"✅ Modo raster: {len(resultados)} celdas enriquecidas")
+    return resultados
+
+
 
 
 #########################################
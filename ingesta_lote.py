@@ -0,0 +1,185 @@
+"""
+Ingesta por lotes de varias regiones GAUL con un pool de procesos.
+
+Ejemplos:
+    python ingesta_lote.py --region "Peru/Lima/Huarochirí" --region "Peru/Lima/Canta"
+    python ingesta_lote.py --pais Peru --departamento Lima --tamaño 2500 --procesos 4
+    python ingesta_lote.py --archivo regiones.csv --desde 2022-01-01 --hasta 2023-12-31 --incremental
+
+La concurrencia hacia GEE y las conexiones a PostgreSQL son presupuestos globales:
+se reparten entre los procesos trabajadores.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+
+# Conexiones a PostgreSQL que necesita una ingesta a la vez
+PG_POR_INGESTA = 3
+
+COLUMNAS_RESUMEN = [
+    'pais', 'departamento', 'ciudad', 'estado', 'celdas', 'celdas_fallidas',
+    'registros_insertados', 'registros_fallidos', 'segundos', 'error',
+]
+
+
+def _inicializar_trabajador(gee_concurrencia: int, pg_conexiones: int):
+    """
+    Corre en cada proceso antes de importar los módulos de ingesta: fija su parte del
+    presupuesto global (planificador_ee y bd leen estas variables al importarse).
+    """
+    os.environ["GEE_CONCURRENCIA_MAX"] = str(gee_concurrencia)
+    os.environ["GEE_CONCURRENCIA_INICIAL"] = str(min(gee_concurrencia, int(os.getenv("GEE_CONCURRENCIA_INICIAL", "4"))))
+    os.environ["PG_POOL_MAX"] = str(pg_conexiones)
+
+
+def _ingestar_region(pais: str, departamento: str, ciudad: str, opciones: dict) -> dict:
+    """Ingesta de una región en un proceso trabajador; nunca lanza, retorna su resumen."""
+    inicio = time.time()
+    fila = {'pais': pais, 'departamento': departamento, 'ciudad': ciudad}
+    try:
+        from ingesta_bd import IngestionCeldasTerreno
+
+        ingestion = IngestionCeldasTerreno()
+        try:
+            resumen = ingestion.ingestar_region(pais, departamento, ciudad, **opciones)
+        finally:
+            ingestion.cerrar()
+        fila.update({
+            'estado': 'con_fallos' if resumen['celdas_fallidas'] or resumen['registros_fallidos'] else 'completa',
+            'celdas': resumen['celdas'],
+            'celdas_fallidas': resumen['celdas_fallidas'],
+            'registros_insertados': resumen['registros_insertados'],
+            'registros_fallidos': resumen['registros_fallidos'],
+            'error': '',
+        })
+    except Exception as e:
+        fila.update({'estado': 'error', 'error': str(e)})
+    fila['segundos'] = round(time.time() - inicio, 1)
+    return fila
+
+
+def regiones_de_gaul(pais: str, departamento: str = None) -> list:
+    """
+    Regiones de nivel 2 de un país (o de un departamento) desde la tabla local limites_gaul.
+    Si el país no está cargado, lo carga una vez desde GEE.
+    """
+    import bd
+    from ingesta_bd import cargar_limites_gaul
+
+    consulta = """
+        SELECT adm0_name, adm1_name, adm2_name FROM limites_gaul
+        WHERE clave_region(adm0_name) = clave_region(%s)
+          AND (%s IS NULL OR clave_region(adm1_name) = clave_region(%s))
+        ORDER BY adm1_name, adm2_name
+    """
+    with bd.conexion(cursor_factory=None) as conexion, conexion.cursor() as cursor:
+        cursor.execute(consulta, (pais, departamento, departamento))
+        regiones = cursor.fetchall()
+    if not regiones:
+        cargar_limites_gaul(pais)
+        with bd.conexion(cursor_factory=None) as conexion, conexion.cursor() as cursor:
+            cursor.execute(consulta, (pais, departamento, departamento))
+            regiones = cursor.fetchall()
+    return [tuple(region) for region in regiones]
+
+
+def leer_regiones(args) -> list:
+    regiones = []
+    for texto in args.region or []:
+        partes = [parte.strip() for parte in texto.split("/")]
+        if len(partes) != 3:
+            raise SystemExit(f"Región inválida '{texto}': use País/Departamento/Ciudad")
+        regiones.append(tuple(partes))
+    if args.archivo:
+        with open(args.archivo, encoding="utf-8") as archivo:
+            for fila in csv.reader(archivo):
+                if len(fila) >= 3 and not fila[0].startswith("#") and fila[0].lower() != "pais":
+                    regiones.append(tuple(valor.strip() for valor in fila[:3]))
+    if args.pais:
+        regiones.extend(regiones_de_gaul(args.pais, args.departamento))
+    # Sin duplicados, conservando el orden
+    return list(dict.fromkeys(regiones))
+
+
+def ejecutar_lote(regiones: list, opciones: dict, procesos: int, gee_concurrencia: int,
+                  pg_conexiones: int, ruta_resumen: str) -> list:
+    """Ingesta todas las regiones con `procesos` trabajadores y escribe el resumen CSV."""
+    # Cada ingesta usa una conexión para escribir, una para el diario y una ocasional para límites
+    if pg_conexiones < PG_POR_INGESTA or gee_concurrencia < 1:
+        raise SystemExit(f"Presupuesto insuficiente: se necesitan al menos {PG_POR_INGESTA} conexiones "
+                         f"a PostgreSQL y 1 consulta concurrente a GEE por proceso")
+    # Se reducen los procesos para no exceder los presupuestos globales
+    procesos = max(1, min(procesos, len(regiones), pg_conexiones // PG_POR_INGESTA, gee_concurrencia))
+    gee_por_proceso = gee_concurrencia // procesos
+    pg_por_proceso = pg_conexiones // procesos
+    print(f"🚀 {len(regiones)} regiones | {procesos} procesos | GEE {gee_por_proceso}/proceso | "
+          f"PostgreSQL {pg_por_proceso} conexiones/proceso")
+
+    resumen = []
+    inicio = time.time()
+    with ProcessPoolExecutor(
+        max_workers=procesos,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_inicializar_trabajador,
+        initargs=(gee_por_proceso, pg_por_proceso),
+    ) as ejecutor:
+        futuros = [ejecutor.submit(_ingestar_region, pais, departamento, ciudad, opciones)
+                   for pais, departamento, ciudad in regiones]
+        for futuro in as_completed(futuros):
+            fila = futuro.result()
+            resumen.append(fila)
+            print(f"{'✅' if fila['estado'] == 'completa' else '⚠️'} [{len(resumen)}/{len(regiones)}] "
+                  f"{fila['ciudad']}, {fila['departamento']}: {fila['estado']} "
+                  f"({fila.get('celdas', 0)} celdas, {fila.get('registros_insertados', 0)} filas, {fila['segundos']:.0f} s)")
+            _escribir_resumen(resumen, ruta_resumen)
+
+    print(f"🏁 Lote terminado en {(time.time() - inicio) / 60:.1f} minutos. Resumen en {ruta_resumen}")
+    return resumen
+
+
+def _escribir_resumen(resumen: list, ruta: str):
+    """Reescribe el CSV tras cada región para no perder el resumen si el lote se interrumpe."""
+    with open(ruta, "w", newline="", encoding="utf-8") as archivo:
+        escritor = csv.DictWriter(archivo, fieldnames=COLUMNAS_RESUMEN, extrasaction="ignore")
+        escritor.writeheader()
+        escritor.writerows(resumen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingesta por lotes de regiones GAUL nivel 2")
+    parser.add_argument("--region", action="append", help="País/Departamento/Ciudad (repetible)")
+    parser.add_argument("--archivo", help="CSV con columnas pais,departamento,ciudad")
+    parser.add_argument("--pais", help="Todas las regiones de nivel 2 de un país")
+    parser.add_argument("--departamento", help="Con --pais, solo las de este departamento")
+    parser.add_argument("--tamaño", type=int, default=2500, help="Tamaño de celda en metros")
+    parser.add_argument("--desde", default="2023-01-01", help="Fecha de inicio (YYYY-MM-DD)")
+    parser.add_argument("--hasta", default="2023-12-31", help="Fecha de fin (YYYY-MM-DD)")
+    parser.add_argument("--modo", default="lote", choices=["lote", "raster", "celda"])
+    parser.add_argument("--incremental", action="store_true", help="Solo meses faltantes o desactualizados")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--gee-concurrencia", type=int, default=32, help="Solicitudes simultáneas a GEE (total)")
+    parser.add_argument("--pg-conexiones", type=int, default=20, help="Conexiones a PostgreSQL (total)")
+    parser.add_argument("--salida", default=f"resumen_ingesta_{datetime.now():%Y%m%d_%H%M}.csv")
+    args = parser.parse_args()
+
+    regiones = leer_regiones(args)
+    if not regiones:
+        parser.error("indique al menos una región con --region, --archivo o --pais")
+
+    opciones = {
+        'tamaño_celda_m': args.tamaño,
+        'fecha_inicio': args.desde,
+        'fecha_fin': args.hasta,
+        'modo': args.modo,
+        'incremental': args.incremental,
+    }
+    ejecutar_lote(regiones, opciones, args.procesos, args.gee_concurrencia, args.pg_conexiones, args.salida)
+
+
+if __name__ == "__main__":
+    main()
@@ -198,18 +198,17 @@ def ingestar_referencia_demanda(pais, departamento, ciudad, tipo):
         if not datos_a_insertar:
             return f"⚠️ No se encontraron datos reales de {tipo} en la zona."
 
-        conn = bd.conexion_bd()
-        cur = conn.cursor()
-        
-        # Usamos ST_GeomFromText para convertir el WKT de Python a Geometría PostGIS
-        cur.executemany("""
-            INSERT INTO referencias_geo (pais_region, departamento_region, ciudad_region, tipo, nombre, geometria)
-            VALUES (%s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromText(%s), 4326))
-        """, datos_a_insertar)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with bd.conexion() as conn:
+            cur = conn.cursor()
+            
+            # Usamos ST_GeomFromText para convertir el WKT de Python a Geometría PostGIS
+            cur.executemany("""
+                INSERT INTO referencias_geo (pais_region, departamento_region, ciudad_region, tipo, nombre, geometria)
+                VALUES (%s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromText(%s), 4326))
+            """, datos_a_insertar)
+            
+            conn.commit()
+            cur.close()
         
         return f"✅ INGESTA REAL: Se guardaron {len(datos_a_insertar)} elementos de {tipo}."
 
@@ -223,24 +222,33 @@ def analisis_postgis(pais, departamento, ciudad, criterios):
     Construye una QUERY DINÁMICA DE POSTGIS basada en N criterios.
     (Misma lógica que tenías, solo asegura que ingestar_referencia_demanda sea la nueva)
     """
-    conn = bd.conexion_bd()
-    
-    # 1. Asegurar ingesta
-    logs_ingesta = []
-    for crit in criterios:
-        tipo = crit['referencia']
-        # Forzamos re-check o ingesta si no existe
-        if not verificar_existencia_referencia(conn, pais, departamento, ciudad, tipo):
-            res = ingestar_referencia_demanda(pais, departamento, ciudad, tipo)
-            logs_ingesta.append(res)
+    # 1. Asegurar ingesta (sin retener una conexión: la ingesta toma las suyas del pool)
+    logs_ingesta = asegurar_referencias(pais, departamento, ciudad, criterios)
+    with bd.conexion() as conn:
+        return _analisis_postgis(conn, pais, departamento, ciudad, criterios, logs_ingesta)
+
+
+def asegurar_referencias(pais, departamento, ciudad, criterios):
+    """
+    Ingesta las referencias de los criterios que aún no existen para la ciudad.
+    La conexión de la verificación vuelve al pool antes de ingestar.
+    """
+    with bd.conexion() as conn:
+        faltantes = [
+            tipo for tipo in dict.fromkeys(crit['referencia'] for crit in criterios)
+            if not verificar_existencia_referencia(conn, pais, departamento, ciudad, tipo)
+        ]
+    return [ingestar_referencia_demanda(pais, departamento, ciudad, tipo) for tipo in faltantes]
+
 
+def _analisis_postgis(conn, pais, departamento, ciudad, criterios, logs_ingesta):
     # 2. Construir Query (Igual que antes)
     sql_base = """
         SELECT c.id_celda, c.lat, c.lon, round(puntuacion_calidad_datos::numeric, 2) as puntuacion_calidad, c.temp_promedio, c.humedad_promedio
         FROM celdas_terreno c
-        WHERE c.ciudad_region = %s
+        WHERE c.pais_clave = clave_region(%s) AND c.departamento_clave = clave_region(%s) AND c.ciudad_clave = clave_region(%s)
     """
-    params = [ciudad]
+    params = [pais, departamento, ciudad]
     
     for crit in criterios:
         tipo = crit['referencia']
@@ -304,7 +312,6 @@ def analisis_postgis(pais, departamento, ciudad, criterios):
                 })
             
         cursor.close()
-        conn.close()
         
         return {
             "logs": logs_ingesta,
@@ -0,0 +1,187 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+
+# Cargar variables de entorno
+#################################
+
+load_dotenv(dotenv_path="_mientorno.env")
+GEE_CONCURRENCIA_INICIAL = int(os.getenv("GEE_CONCURRENCIA_INICIAL", "4"))
+GEE_CONCURRENCIA_MAX = int(os.getenv("GEE_CONCURRENCIA_MAX", "32"))
+GEE_MAX_REINTENTOS = int(os.getenv("GEE_MAX_REINTENTOS", "6"))
+
+# Fragmentos de mensajes de error de GEE que indican saturación o fallos
+# transitorios: se reintentan en lugar de perder la celda.
+ERRORES_TRANSITORIOS = (
+    "too many requests",
+    "429",
+    "quota",
+    "rate limit",
+    "too many concurrent",
+    "timed out",
+    "timeout",
+    "deadline",
+    "503",
+    "502",
+    "service unavailable",
+    "backend error",
+    "internal error",
+    "connection",
+)
+
+# Subconjunto que indica que GEE nos está limitando: reduce la concurrencia
+ERRORES_LIMITE = ("too many requests", "429", "quota", "rate limit", "too many concurrent")
+
+
+def log(evento: str):
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{ahora}] {evento}")
+
+
+class ErrorGEE(Exception):
+    """Una llamada a GEE falló de forma definitiva (agotó reintentos o error no transitorio)."""
+
+
+def es_transitorio(error: Exception) -> bool:
+    mensaje = str(error).lower()
+    return isinstance(error, TimeoutError) or any(f in mensaje for f in ERRORES_TRANSITORIOS)
+
+
+def es_limite(error: Exception) -> bool:
+    mensaje = str(error).lower()
+    return any(f in mensaje for f in ERRORES_LIMITE)
+
+
+class PlanificadorEE:
+    """
+    Planificador de llamadas bloqueantes a GEE (getInfo, computePixels).
+
+    - Concurrencia adaptativa (AIMD): sube de a poco mientras la latencia esté por
+      debajo del objetivo y se reduce a la mitad ante un 429 o una latencia excesiva.
+    - Reintentos con espera exponencial y jitter para errores transitorios.
+    - Contadores de throughput, reintentos y fallos (ver metricas()).
+    """
+
+    def __init__(self, concurrencia_inicial: int = GEE_CONCURRENCIA_INICIAL,
+                 concurrencia_min: int = 1, concurrencia_max: int = GEE_CONCURRENCIA_MAX,
+                 max_reintentos: int = GEE_MAX_REINTENTOS, espera_base: float = 1.0,
+                 espera_max: float = 60.0, latencia_objetivo: float = 30.0):
+        self.concurrencia_min = concurrencia_min
+        self.concurrencia_max = concurrencia_max
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self.latencia_objetivo = latencia_objetivo
+
+        self._limite = float(max(concurrencia_min, min(concurrencia_inicial, concurrencia_max)))
+        self._en_curso = 0
+        self._ultima_reduccion = 0.0
+        self._condicion = threading.Condition()
+
+        self._inicio = time.time()
+        self.solicitudes = 0
+        self.exitosas = 0
+        self.reintentos = 0
+        self.fallidas = 0
+        self.limitadas = 0
+        self._latencia_total = 0.0
+
+    @property
+    def concurrencia(self) -> int:
+        return int(self._limite)
+
+    def _adquirir(self):
+        with self._condicion:
+            while self._en_curso >= int(self._limite):
+                self._condicion.wait()
+            self._en_curso += 1
+
+    def _liberar(self):
+        with self._condicion:
+            self._en_curso -= 1
+            self._condicion.notify_all()
+
+    def _aumentar(self):
+        """Incremento aditivo: ~+1 de concurrencia por cada ventana completa de éxitos."""
+        with self._condicion:
+            self._limite = min(self.concurrencia_max, self._limite + 1.0 / self._limite)
+            self._condicion.notify_all()
+
+    def _reducir(self, motivo: str):
+        """Reducción multiplicativa, como máximo una vez por espera_base segundos."""
+        with self._condicion:
+            ahora = time.time()
+            if ahora - self._ultima_reduccion < self.espera_base:
+                return
+            self._ultima_reduccion = ahora
+            anterior = self.concurrencia
+            self._limite = max(float(self.concurrencia_min), self._limite / 2)
+        log(f"⚠️ GEE {motivo}: concurrencia {anterior} → {self.concurrencia}")
+
+    def _espera(self, intento: int) -> float:
+        """Espera exponencial con jitter completo."""
+        return random.uniform(0, min(self.espera_max, self.espera_base * (2 ** intento)))
+
+    def ejecutar(self, funcion, *args, **kwargs):
+        """Ejecuta funcion(*args, **kwargs) respetando la concurrencia y reintentando errores transitorios."""
+        with self._condicion:
+            self.solicitudes += 1
+
+        for intento in range(self.max_reintentos + 1):
+            self._adquirir()
+            inicio = time.time()
+            try:
+                resultado = funcion(*args, **kwargs)
+            except Exception as e:
+                self._liberar()
+                if not es_transitorio(e):
+                    with self._condicion:
+                        self.fallidas += 1
+                    raise
+                if es_limite(e):
+                    with self._condicion:
+                        self.limitadas += 1
+                    self._reducir("limitó las solicitudes")
+                if intento == self.max_reintentos:
+                    with self._condicion:
+                        self.fallidas += 1
+                    raise ErrorGEE(f"GEE falló tras {intento + 1} intentos: {e}") from e
+                with self._condicion:
+                    self.reintentos += 1
+                espera = self._espera(intento)
+                log(f"🔁 Reintento {intento + 1}/{self.max_reintentos} en {espera:.1f}s: {e}")
+                time.sleep(espera)
+                continue
+
+            latencia = time.time() - inicio
+            self._liberar()
+            with self._condicion:
+                self.exitosas += 1
+                self._latencia_total += latencia
+            if latencia > self.latencia_objetivo:
+                self._reducir(f"respondió lento ({latencia:.1f}s)")
+            else:
+                self._aumentar()
+            return resultado
+
+    def metricas(self) -> dict:
+        with self._condicion:
+            transcurrido = max(1e-9, time.time() - self._inicio)
+            return {
+                "concurrencia": self.concurrencia,
+                "en_curso": self._en_curso,
+                "solicitudes": self.solicitudes,
+                "exitosas": self.exitosas,
+                "reintentos": self.reintentos,
+                "fallidas": self.fallidas,
+                "limitadas": self.limitadas,
+                "latencia_promedio_s": round(self._latencia_total / self.exitosas, 2) if self.exitosas else None,
+                "solicitudes_por_minuto": round(self.exitosas / transcurrido * 60, 1),
+            }
+
+
+planificador = PlanificadorEE()
@@ -24,7 +24,8 @@ import funciones
 import bd
 from langsmith import traceable
 
-from ingesta_bd import ingestar, existe_region
+from ingesta_bd import existe_region
+from trabajos_ingesta import cola_ingestas
 import ingesta_ref  
 import folium
 
@@ -56,7 +57,11 @@ builtins.open = open_utf8_safe
 
 
 
-conexion = bd.conexion_bd()
+
+# Turnos de chat simultáneos (sesiones distintas). El seguimiento de una ingesta mantiene su
+# turno abierto hasta que termina, así que no debe bloquear a las demás sesiones. Cada turno
+# usa a lo sumo una conexión a la vez: no más turnos que conexiones del pool de PostgreSQL.
+CHAT_CONCURRENCIA = min(int(os.getenv("CHAT_CONCURRENCIA", str(bd.PG_POOL_MAX))), bd.PG_POOL_MAX)
 
 # --- 2. CONFIGURACIÓN DEL ESTADO ---
 AgentState = TypedDict("AgentState", {
@@ -69,7 +74,9 @@ AgentState = TypedDict("AgentState", {
     "ciudad": str,
     "resultados_evaluacion": list,
     "datos_celdas": str,
-    "capas_referencia": list
+    "capas_referencia": list,
+    "trabajo_ingesta": str,
+    "estadisticas_region": list
 })
 
 def formatear_reglas_html(reglas):
@@ -214,6 +221,48 @@ def formatear_reglas_html(reglas):
 
     return f"<div>{str(reglas)}</div>"
 
+def formatear_estadisticas_html(estadisticas):
+    """
+    Tabla HTML (Atributo x Meses + Anual) con el promedio de cada atributo climático de la región,
+    a partir de los registros de bd.estadisticas_region (niveles 'mes' y 'total').
+    """
+    if not estadisticas:
+        return ""
+
+    promedios = {}
+    for item in estadisticas:
+        columna = 'anual' if item.get('nivel') == 'total' else item.get('mes')
+        if item.get('nivel') not in ('total', 'mes') or columna is None or item.get('promedio') is None:
+            continue
+        promedios.setdefault(item['atributo'], {})[columna if columna == 'anual' else int(columna)] = item['promedio']
+    if not promedios:
+        return ""
+
+    html = """
+    <div style='max-height: 200px; overflow: auto; border: 1px solid #eee; border-radius: 8px; background: white; margin-top: 8px;'>
+        <table style='width:100%; border-collapse: collapse; font-family: sans-serif; font-size: 11px; white-space: nowrap;'>
+            <thead>
+                <tr style='background-color: #2b3137; color: white;'>
+                    <th style='padding: 6px; position: sticky; top: 0; left: 0; z-index: 2; background-color: #2b3137; border-right: 1px solid #555;'>Clima región</th>
+    """
+    for m in list(range(1, 13)) + ['Anual']:
+        html += f"<th style='padding: 4px 8px; text-align:center; position: sticky; top: 0; z-index: 1; background-color: #2b3137;color: white;'>{m}</th>"
+    html += "</tr></thead><tbody>"
+
+    for i, (atributo, valores) in enumerate(promedios.items()):
+        bg_color = "#f9f9f9" if i % 2 == 0 else "#ffffff"
+        nombre = atributo.replace('_promedio', '').capitalize()
+        html += f"<tr style='background-color: {bg_color}; border-bottom: 1px solid #eee;'>"
+        html += f"<td style='padding: 4px 6px; font-weight: 600; position: sticky; left: 0; background-color: {bg_color}; border-right: 1px solid #eee;'>{nombre}</td>"
+        for m in list(range(1, 13)) + ['anual']:
+            valor = valores.get(m)
+            texto = f"{valor:.1f}" if valor is not None else "-"
+            peso = "font-weight: 600;" if m == 'anual' else ""
+            html += f"<td style='padding: 4px 8px; text-align:center; color: #444; {peso}'>{texto}</td>"
+        html += "</tr>"
+    html += "</tbody></table></div>"
+    return html
+
 # TOOLS 
 
 
@@ -310,10 +359,17 @@ def agente_region(state: AgentState):
             #departamento = bd.normalizar_texto(departamento)
             #ciudad = bd.normalizar_texto(ciudad)
 
-            if not existe_region(pais, departamento, ciudad):
-                print ("⚠️ Región no existe en BD, iniciando ingesta...")
-                ingestar(pais, departamento, ciudad)       
+            id_trabajo = ""
+            # Con una ingesta activa la región ya tiene celdas (llegan por lotes) pero no está completa
+            trabajo = cola_ingestas.activo(pais, departamento, ciudad)
+            if trabajo is None and not existe_region(pais, departamento, ciudad):
+                print ("⚠️ Región sin datos completos en BD, iniciando ingesta en segundo plano...")
+                trabajo = cola_ingestas.encolar(pais, departamento, ciudad)
+            if trabajo is not None:
+                id_trabajo = trabajo.id
+                resultado += f"\n\n⏳ Descargando datos climáticos de {ciudad} en segundo plano (trabajo {trabajo.id}). Verás el avance aquí y en el mapa."
         except json.JSONDecodeError:
+            id_trabajo = ""
             tabla_md = contenido_limpio
             contenido_dict = {}
             resultado = contenido_limpio
@@ -324,7 +380,8 @@ def agente_region(state: AgentState):
             "ultimo_agente": "",
             "pais": contenido_dict.get('pais', ''),
             "departamento": contenido_dict.get('departamento', ''),
-            "ciudad": contenido_dict.get('ciudad', '')
+            "ciudad": contenido_dict.get('ciudad', ''),
+            "trabajo_ingesta": id_trabajo
         }
     
     else:
@@ -400,28 +457,47 @@ def agente_geoclimatico(state: AgentState):
     ciudad = state.get("ciudad", "")
     print(f"🕵️ Buscando datos para: {ciudad}...")
     
-    data = bd.obtener_datos_celda(conexion, pais, departamento, ciudad, limit=10000)
-
-    if data.empty:
+    # 3. EVALUACIÓN EN LA BD: se transfiere una fila por celda en lugar de todas las filas mensuales
+    try:
+        with bd.conexion() as conexion:
+            df_evaluado = bd.evaluar_idoneidad(conexion, pais, departamento, ciudad, reglas_terreno)
+    except Exception as e:
+        print(f"❌ Error evaluación: {e}")
         return {
-            "mensajes": [AIMessage(content=f"No hay datos para {ciudad}.")],
+            "mensajes": [AIMessage(content="Error técnico en evaluación.")],
             "siguiente_nodo": "end",
             "resultados_evaluacion": []
         }
 
-    # 3. EVALUACIÓN
-    try:
-        df_evaluado = funciones.evaluar_idoneidad_terreno(data.copy(), reglas_terreno)
-    except Exception as e:
-        print(f"❌ Error evaluación: {e}")
+    if df_evaluado.empty:
+        trabajo = cola_ingestas.activo(pais, departamento, ciudad)
+        if trabajo:
+            progreso = trabajo.progreso()
+            return {
+                "mensajes": [AIMessage(content=f"⏳ Los datos de {ciudad} aún se están descargando ({progreso['porcentaje']:.0f}%). Intenta de nuevo en unos minutos.")],
+                "siguiente_nodo": "end",
+                "resultados_evaluacion": []
+            }
         return {
-            "mensajes": [AIMessage(content="Error técnico en evaluación.")],
+            "mensajes": [AIMessage(content=f"No hay datos para {ciudad}.")],
             "siguiente_nodo": "end",
             "resultados_evaluacion": []
         }
+
+    df_evaluado = funciones.explicar_idoneidad(df_evaluado)
     
     # 4. REPORTE
     texto_top_ranking = funciones.generar_reporte_top_celdas(df_evaluado, top_n=5)
+
+    # Estadísticas de la región (una lectura, en caché hasta la próxima ingesta)
+    try:
+        with bd.conexion() as conexion:
+            df_estadisticas = bd.estadisticas_region(conexion, pais, departamento, ciudad, agrupar=('mes',))
+    except Exception as e:
+        print(f"⚠️ Error estadísticas: {e}")
+        df_estadisticas = pd.DataFrame()
+    texto_estadisticas = funciones.texto_estadisticas_region(df_estadisticas)
+    estadisticas = df_estadisticas.astype(object).where(df_estadisticas.notna(), None).to_dict(orient='records')
     
     # 5. LLM
     prompt_narrativo = f"""
@@ -441,6 +517,8 @@ def agente_geoclimatico(state: AgentState):
     Si no pregunta por infraestructura, haz tu evaluación agrónoma normal basada en clima.
     Finalmente indica cuántas celdas cumplen los criterios.
 
+    {texto_estadisticas}
+
     {texto_top_ranking}
     """
 
@@ -481,7 +559,8 @@ def agente_geoclimatico(state: AgentState):
                 "siguiente_nodo": "end",
                 "ultimo_agente": "nodo_geoclimatico",
                 "resultados_evaluacion": datos_para_mapa, # <--- MAPA FILTRADO
-                "capas_referencia": nuevas_capas        # <--- RIOS PINTADOS
+                "capas_referencia": nuevas_capas,       # <--- RIOS PINTADOS
+                "estadisticas_region": estadisticas
             }
         
 
@@ -491,7 +570,8 @@ def agente_geoclimatico(state: AgentState):
         "mensajes": [respuesta_llm],
         "siguiente_nodo": "end",
         "ultimo_agente": "nodo_geoclimatico",
-        "resultados_evaluacion": datos_para_mapa
+        "resultados_evaluacion": datos_para_mapa,
+        "estadisticas_region": estadisticas
     }
 
 # --- 5. GRAFO ---
@@ -539,6 +619,7 @@ def logica_chat(mensaje, history, session_id):
     info_actual = None
     
     capas_visuales = [] # Inicializar
+    id_trabajo = None
 
     try:
         for chunk in app_graph.stream(inputs, config=config, stream_mode="updates"):
@@ -579,6 +660,11 @@ def logica_chat(mensaje, history, session_id):
                             "Diagnostico": d.get("explicacion", "")[:60] + "..."
                         })
 
+                # B2) ESTADÍSTICAS DE LA REGIÓN -> TABLA BAJO LAS REGLAS
+                if valores.get("estadisticas_region"):
+                    html_estadisticas = formatear_estadisticas_html(valores["estadisticas_region"])
+                    html_esperada = (html_esperada or "") + html_estadisticas
+
                 # C) CHAT
                 if "mensajes" in valores:
                     mensajes_nuevos = valores["mensajes"]
@@ -591,11 +677,45 @@ def logica_chat(mensaje, history, session_id):
                 if "capas_referencia" in valores:
                     capas_visuales = valores["capas_referencia"]
 
+                if valores.get("trabajo_ingesta"):
+                    id_trabajo = valores["trabajo_ingesta"]
+
                 yield texto_acumulado, datos_mapa_final, html_esperada, info_actual, capas_visuales
 
+        # D) INGESTA EN SEGUNDO PLANO: avance en el chat y celdas en el mapa a medida que llegan
+        if id_trabajo:
+            yield from seguir_ingesta(id_trabajo, texto_acumulado, html_esperada, info_actual, capas_visuales)
+
     except Exception as e:
         yield f"❌ Error: {str(e)}", None, None, None, []
 
+def seguir_ingesta(id_trabajo, texto_acumulado, html_esperada, info_actual, capas_visuales):
+    trabajo = cola_ingestas.obtener(id_trabajo)
+    if trabajo is None:
+        return
+    completadas_mapa = -1
+    datos_mapa = None
+    for progreso in cola_ingestas.seguir(id_trabajo):
+        if progreso['estado'] == "completado":
+            linea = f"✅ Ingesta de {trabajo.ciudad} completada: {progreso['completadas']} celdas en {progreso['segundos']:.0f} s."
+        elif progreso['estado'] == "fallido":
+            linea = f"❌ La ingesta de {trabajo.ciudad} falló: {progreso['error']}"
+        elif progreso['total']:
+            linea = f"⏳ Ingesta de {trabajo.ciudad}: {progreso['completadas']}/{progreso['total']} celdas ({progreso['porcentaje']:.0f}%)"
+        else:
+            linea = f"⏳ Ingesta de {trabajo.ciudad}: preparando grilla..."
+
+        # Refrescar el mapa solo cuando llegaron celdas nuevas
+        if progreso['completadas'] != completadas_mapa:
+            completadas_mapa = progreso['completadas']
+            try:
+                with bd.conexion() as conexion:
+                    datos_mapa = bd.obtener_celdas_mapa(conexion, trabajo.pais, trabajo.departamento, trabajo.ciudad) or None
+            except Exception as e:
+                print(f"⚠️ No se pudo actualizar el mapa de la ingesta: {e}")
+
+        yield f"{texto_acumulado}\n\n{linea}", datos_mapa, html_esperada, info_actual, capas_visuales
+
 def interaccion_usuario(mensaje, history):
     if not mensaje: return "", history
     if history is None: history = []
@@ -738,13 +858,15 @@ with gr.Blocks(title="Geo-Agente") as interfaz:
     msg.submit(
         interaccion_usuario, [msg, chatbot], [msg, chatbot], queue=False
     ).then(
-        interaccion_bot, [chatbot, estado_datos, session_id], lista_outputs
+        interaccion_bot, [chatbot, estado_datos, session_id], lista_outputs,
+        concurrency_limit=CHAT_CONCURRENCIA, concurrency_id="chat"
     )
 
     submit_btn.click(
         interaccion_usuario, [msg, chatbot], [msg, chatbot], queue=False
     ).then(
-        interaccion_bot, [chatbot, estado_datos, session_id], lista_outputs
+        interaccion_bot, [chatbot, estado_datos, session_id], lista_outputs,
+        concurrency_limit=CHAT_CONCURRENCIA, concurrency_id="chat"
     )
     
     def limpiar_todo():
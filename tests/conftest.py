@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos del proyecto están en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ConsultaFalsa:
+    """Objeto con la interfaz de un objeto de Earth Engine que usa cache_ee.descargar()."""
+
+    def __init__(self, respuestas):
+        self.respuestas = list(respuestas)
+        self.llamadas = 0
+
+    def serialize(self):
+        return "ERA5_LAND/MONTHLY|2025-09-01|2025-10-01"
+
+    def getInfo(self):
+        self.llamadas += 1
+        return self.respuestas.pop(0)
+
+
+@pytest.fixture
+def consulta_falsa():
+    return ConsultaFalsa
+
+
+@pytest.fixture
+def cache_temporal(tmp_path, monkeypatch):
+    """Caché de GEE vacía en un directorio temporal."""
+    import cache_ee
+
+    cache = cache_ee.CacheEE(ruta=str(tmp_path / "cache_ee.sqlite"))
+    monkeypatch.setattr(cache_ee, "cache", cache)
+    monkeypatch.setattr(cache_ee, "CACHE_ACTIVO", True)
+    return cache
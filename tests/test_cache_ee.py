@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+import cache_ee
+
+
+def test_descargar_reutiliza_la_respuesta_guardada(cache_temporal, consulta_falsa):
+    consulta = consulta_falsa([{"temp": 1.0}])
+    assert cache_ee.descargar(consulta) == {"temp": 1.0}
+    assert cache_ee.descargar(consulta) == {"temp": 1.0}
+    assert consulta.llamadas == 1
+
+
+def test_forzar_descarga_consulta_gee_de_nuevo_y_reemplaza_la_respuesta(cache_temporal, consulta_falsa):
+    # Primera descarga de un mes provisional, luego el dato consolidado
+    consulta = consulta_falsa([{"temp": 1.0}, {"temp": 2.0}])
+    assert cache_ee.descargar(consulta) == {"temp": 1.0}
+
+    with cache_ee.forzar_descarga():
+        assert cache_ee.descargar(consulta) == {"temp": 2.0}
+    assert consulta.llamadas == 2
+
+    # Fuera del bloque se lee la respuesta nueva sin volver a GEE
+    assert cache_ee.descargar(consulta) == {"temp": 2.0}
+    assert consulta.llamadas == 2
+
+
+def test_respuesta_puede_ser_anterior_segun_ttl(cache_temporal):
+    ahora = datetime(2025, 10, 15)
+    ttl = timedelta(seconds=cache_temporal.ttl_segundos)
+    # Datos que cambian después de ahora (mes provisional) o dentro del TTL: la caché no sirve
+    assert cache_ee.respuesta_puede_ser_anterior(ahora + timedelta(days=5), ahora)
+    assert cache_ee.respuesta_puede_ser_anterior(ahora - ttl + timedelta(days=1), ahora)
+    # Cambiaron hace más que el TTL: toda respuesta guardada es posterior
+    assert not cache_ee.respuesta_puede_ser_anterior(ahora - ttl - timedelta(days=1), ahora)
@@ -0,0 +1,36 @@
+import pytest
+
+import indice_celdas
+
+
+def test_componer_y_descomponer_son_inversas():
+    id_celda = indice_celdas.componer(1000, 12345, 40000)
+    assert [int(x) for x in indice_celdas.descomponer(id_celda)] == [1000, 12345, 40000]
+
+
+def test_celda_de_punto_en_los_extremos_de_la_grilla():
+    for tamaño_m in (10, 1000, indice_celdas.TAMAÑO_MAXIMO):
+        for lon, lat in ((-180.0, -90.0), (179.9999, 89.9999), (0.0, 0.0)):
+            id_celda = indice_celdas.celda_de_punto(lon, lat, tamaño_m)
+            oeste, sur, este, norte = indice_celdas.limites(id_celda)
+            assert oeste <= lon <= este and sur <= lat <= norte
+
+
+@pytest.mark.parametrize("tamaño_m, fila, columna", [
+    (0, 0, 0),
+    (indice_celdas.TAMAÑO_MAXIMO + 1, 0, 0),
+    (1000, -1, 0),
+    (1000, indice_celdas.MASCARA + 1, 0),
+    (1000, 0, indice_celdas.MASCARA + 1),
+])
+def test_componer_rechaza_componentes_fuera_de_rango(tamaño_m, fila, columna):
+    with pytest.raises(ValueError):
+        indice_celdas.componer(tamaño_m, fila, columna)
+
+
+def test_celdas_demasiado_chicas_no_son_codificables():
+    # En el ecuador, celdas de 5 m necesitan más de 2**22 columnas
+    with pytest.raises(ValueError):
+        indice_celdas.celda_de_punto(179.9999, 0.0, 5)
+    with pytest.raises(ValueError):
+        indice_celdas.celdas_en_rectangulo((179.0, 0.0, 179.0001, 0.0001), 5)
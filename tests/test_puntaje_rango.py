@@ -0,0 +1,62 @@
+import ast
+import math
+import os
+import re
+import sqlite3
+
+import numpy as np
+import pytest
+
+import esquema
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _calcular_score_ponderado():
+    """funciones.py importa neo4j, geemap y el LLM al cargarse: se compila solo la función."""
+    ruta = os.path.join(RAIZ, "funciones.py")
+    with open(ruta, encoding="utf-8") as archivo:
+        arbol = ast.parse(archivo.read())
+    nodo = next(n for n in arbol.body
+                if isinstance(n, ast.FunctionDef) and n.name == "calcular_score_ponderado")
+    espacio = {"np": np}
+    exec(compile(ast.Module(body=[nodo], type_ignores=[]), ruta, "exec"), espacio)
+    return espacio["calcular_score_ponderado"]
+
+
+def _puntaje_rango_sql():
+    """
+    puntaje_rango de la última migración que la define, evaluada en SQLite: el CASE solo usa
+    SQL estándar salvo GREATEST (MAX escalar en SQLite). SQLite guarda NaN como NULL.
+    """
+    for _, _, sql in reversed(esquema.MIGRACIONES):
+        coincidencia = re.search(r"FUNCTION puntaje_rango\(.*?\$\$\s*SELECT (CASE.*?END)\s*\$\$", sql, re.S)
+        if coincidencia:
+            break
+    expresion = re.sub(r"\b(valor|minimo|maximo)\b", r":\1", coincidencia.group(1))
+    expresion = expresion.replace("GREATEST(", "MAX(")
+    conexion = sqlite3.connect(":memory:")
+
+    def puntaje(valor, minimo, maximo):
+        parametros = {"valor": valor, "minimo": minimo, "maximo": maximo}
+        return conexion.execute(f"SELECT {expresion}", parametros).fetchone()[0]
+    return puntaje
+
+
+@pytest.mark.parametrize("valor, minimo, maximo, esperado", [
+    (None, 10.0, 10.0, 0.0),          # sin dato, rango nulo
+    (math.nan, 10.0, 10.0, 0.0),
+    (None, 0.0, 10.0, 0.0),           # sin dato
+    (math.nan, 0.0, 10.0, 0.0),
+    (10.0, 10.0, 10.0, 100.0),        # rango nulo
+    (3.0, 10.0, 10.0, 100.0),
+    (0.0, 0.0, 10.0, 100.0),          # dentro del rango (bordes incluidos)
+    (5.0, 0.0, 10.0, 100.0),
+    (10.0, 0.0, 10.0, 100.0),
+    (-1.0, 0.0, 10.0, 70.0),          # fuera: 3 puntos por cada 1 % del rango
+    (12.0, 0.0, 10.0, 40.0),
+    (50.0, 0.0, 10.0, 0.0),
+])
+def test_puntaje_rango_sql_igual_a_calcular_score_ponderado(valor, minimo, maximo, esperado):
+    assert _calcular_score_ponderado()(valor, minimo, maximo) == pytest.approx(esperado)
+    assert _puntaje_rango_sql()(valor, minimo, maximo) == pytest.approx(esperado)
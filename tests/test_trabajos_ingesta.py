@@ -0,0 +1,57 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import trabajos_ingesta
+
+
+@pytest.fixture
+def cola(monkeypatch):
+    """ColaIngestas con hilos en lugar de procesos y una ingesta que espera a `liberar`."""
+    liberar = threading.Event()
+
+    def ingesta_falsa(pais, departamento, ciudad, opciones):
+        liberar.wait(5)
+        return {'celdas': 1}
+
+    monkeypatch.setattr(trabajos_ingesta, "_ejecutar_ingesta", ingesta_falsa)
+    monkeypatch.setattr(trabajos_ingesta.Trabajo, "progreso", lambda self: {'id': self.id, 'estado': self.estado})
+    cola = trabajos_ingesta.ColaIngestas()
+    ejecutor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(cola, "_obtener_ejecutor", lambda: ejecutor)
+    cola.liberar = liberar
+    yield cola
+    liberar.set()
+    ejecutor.shutdown(wait=True)
+
+
+def test_misma_region_con_otra_escritura_comparte_el_trabajo(cola):
+    primero = cola.encolar("Perú", "Lima", "Huarochirí")
+    segundo = cola.encolar(" PERU", "lima", "Huarochiri ")
+    assert segundo is primero
+    assert cola.activo("peru", "LIMA", "huarochiri") is primero
+
+
+def test_seguir_descarta_el_trabajo_tras_reportar_el_final(cola):
+    trabajo = cola.encolar("Perú", "Lima", "Lima")
+    cola.liberar.set()
+    estados = [progreso['estado'] for progreso in cola.seguir(trabajo.id, intervalo=0.01)]
+    assert estados[-1] == trabajos_ingesta.COMPLETADO
+    assert cola.obtener(trabajo.id) is None
+    assert cola.activo("Perú", "Lima", "Lima") is None
+
+
+def test_encolar_poda_trabajos_terminados_sin_seguir(cola):
+    viejo = cola.encolar("Perú", "Lima", "Lima")
+    cola.liberar.set()
+    viejo.futuro.result(timeout=5)
+    while viejo.activo:
+        time.sleep(0.01)
+    viejo.terminado = datetime.now() - timedelta(seconds=trabajos_ingesta.INGESTA_RETENCION_S + 1)
+
+    nuevo = cola.encolar("Perú", "Cusco", "Cusco")
+    assert cola.obtener(viejo.id) is None
+    assert cola.obtener(nuevo.id) is nuevo
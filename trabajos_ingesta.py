@@ -0,0 +1,207 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait
+from datetime import datetime
+from dotenv import load_dotenv
+import bd
+from diario_ingesta import clave_ingesta, progreso_ingesta, COMPLETADA, FALLIDA, PENDIENTE
+
+
+# Cargar variables de entorno
+#################################
+
+load_dotenv(dotenv_path="_mientorno.env")
+INGESTA_PROCESOS = int(os.getenv("INGESTA_PROCESOS", "2"))
+# Segundos que se conserva un trabajo terminado que nadie siguió hasta el final
+INGESTA_RETENCION_S = float(os.getenv("INGESTA_RETENCION_S", "3600"))
+
+# Estados de un trabajo
+EN_COLA = "en_cola"
+EN_CURSO = "en_curso"
+COMPLETADO = "completado"
+FALLIDO = "fallido"
+
+# Opciones de ingestar_region usadas por defecto (las mismas que ingesta_bd.ingestar)
+OPCIONES_POR_DEFECTO = {
+    'tamaño_celda_m': 2500,
+    'fecha_inicio': '2023-01-01',
+    'fecha_fin': '2023-12-31',
+}
+
+
+def _ejecutar_ingesta(pais, departamento, ciudad, opciones):
+    """Se ejecuta en un proceso trabajador: ingesta completa de la región."""
+    from ingesta_bd import IngestionCeldasTerreno
+
+    ingestion = IngestionCeldasTerreno()
+    try:
+        return ingestion.ingestar_region(pais, departamento, ciudad, **opciones)
+    finally:
+        ingestion.cerrar()
+
+
+class Trabajo:
+    """Una ingesta de región encolada o en ejecución."""
+
+    def __init__(self, pais: str, departamento: str, ciudad: str, opciones: dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.pais = pais
+        self.departamento = departamento
+        self.ciudad = ciudad
+        self.opciones = opciones
+        self.id_ingesta = clave_ingesta(pais, departamento, ciudad, opciones['tamaño_celda_m'],
+                                        opciones['fecha_inicio'], opciones['fecha_fin'])
+        self.estado = EN_COLA
+        self.creado = datetime.now()
+        self.terminado = None
+        self.resumen = None
+        self.error = None
+        self.futuro = None
+
+    @property
+    def clave(self) -> str:
+        """Región, grilla y fechas normalizadas con clave_region (ver diario_ingesta.clave_ingesta)."""
+        return self.id_ingesta
+
+    @property
+    def activo(self) -> bool:
+        return self.estado in (EN_COLA, EN_CURSO)
+
+    def progreso(self) -> dict:
+        """Estado del trabajo y avance de sus celdas según el diario de ingesta."""
+        if self.estado == EN_COLA and self.futuro is not None and self.futuro.running():
+            self.estado = EN_CURSO
+        conteo = {PENDIENTE: 0, COMPLETADA: 0, FALLIDA: 0}
+        try:
+            with bd.conexion(cursor_factory=None) as conexion:
+                conteo = progreso_ingesta(conexion, self.id_ingesta)
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el progreso de {self.id}: {e}")
+        total = sum(conteo.values())
+        procesadas = conteo[COMPLETADA] + conteo[FALLIDA]
+        return {
+            'id': self.id,
+            'region': f"{self.ciudad}, {self.departamento}, {self.pais}",
+            'estado': self.estado,
+            'total': total,
+            'completadas': conteo[COMPLETADA],
+            'fallidas': conteo[FALLIDA],
+            'pendientes': conteo[PENDIENTE],
+            'porcentaje': round(100 * procesadas / total, 1) if total else 0.0,
+            'segundos': round(((self.terminado or datetime.now()) - self.creado).total_seconds(), 1),
+            'error': self.error,
+        }
+
+
+class ColaIngestas:
+    """
+    Cola local de ingestas en segundo plano con procesos trabajadores.
+
+    - encolar() retorna de inmediato; la ingesta corre en otro proceso.
+    - Dos pedidos de la misma región mientras hay uno activo comparten el mismo trabajo.
+    - progreso() / seguir() exponen el avance leyendo el diario de ingesta en PostgreSQL.
+    - Un trabajo terminado se descarta cuando seguir() reporta su estado final, o al
+      encolar otro si pasaron INGESTA_RETENCION_S segundos sin que nadie lo siguiera.
+    """
+
+    def __init__(self, max_procesos: int = INGESTA_PROCESOS):
+        self.max_procesos = max_procesos
+        self._ejecutor = None
+        self._candado = threading.Lock()
+        self._trabajos = {}
+        self._activos = {}
+
+    def _obtener_ejecutor(self) -> ProcessPoolExecutor:
+        if self._ejecutor is None:
+            # spawn: cada trabajador inicia GEE y su propio pool de PostgreSQL
+            # en lugar de heredar las conexiones abiertas del proceso principal
+            self._ejecutor = ProcessPoolExecutor(
+                max_workers=self.max_procesos, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._ejecutor
+
+    def encolar(self, pais: str, departamento: str, ciudad: str, **opciones) -> Trabajo:
+        """Encola la ingesta de la región, o retorna el trabajo activo si ya hay uno para ella."""
+        trabajo = Trabajo(pais, departamento, ciudad, {**OPCIONES_POR_DEFECTO, **opciones})
+        with self._candado:
+            self._podar()
+            existente = self._activos.get(trabajo.clave)
+            if existente is not None and existente.activo:
+                print(f"🔁 Ingesta de {ciudad} ya en curso (trabajo {existente.id})")
+                return existente
+            self._trabajos[trabajo.id] = trabajo
+            self._activos[trabajo.clave] = trabajo
+            trabajo.futuro = self._obtener_ejecutor().submit(
+                _ejecutar_ingesta, pais, departamento, ciudad, trabajo.opciones
+            )
+        trabajo.futuro.add_done_callback(lambda futuro: self._al_terminar(trabajo, futuro))
+        print(f"📥 Ingesta de {ciudad} encolada (trabajo {trabajo.id})")
+        return trabajo
+
+    def _al_terminar(self, trabajo: Trabajo, futuro):
+        with self._candado:
+            trabajo.terminado = datetime.now()
+            try:
+                trabajo.resumen = futuro.result()
+                trabajo.estado = COMPLETADO
+            except Exception as e:
+                trabajo.error = str(e)
+                trabajo.estado = FALLIDO
+            if self._activos.get(trabajo.clave) is trabajo:
+                del self._activos[trabajo.clave]
+        print(f"🏁 Trabajo {trabajo.id} ({trabajo.ciudad}): {trabajo.estado}")
+
+    def _podar(self):
+        """Descarta los trabajos terminados hace más de INGESTA_RETENCION_S (con el candado tomado)."""
+        limite = datetime.now().timestamp() - INGESTA_RETENCION_S
+        for id_trabajo, trabajo in list(self._trabajos.items()):
+            if trabajo.terminado is not None and trabajo.terminado.timestamp() < limite:
+                del self._trabajos[id_trabajo]
+
+    def _descartar(self, trabajo: Trabajo):
+        with self._candado:
+            if not trabajo.activo:
+                self._trabajos.pop(trabajo.id, None)
+
+    def obtener(self, id_trabajo: str) -> Trabajo:
+        return self._trabajos.get(id_trabajo)
+
+    def activo(self, pais: str, departamento: str, ciudad: str) -> Trabajo:
+        """Trabajo activo de la región (con las opciones por defecto), o None."""
+        clave = clave_ingesta(pais, departamento, ciudad, OPCIONES_POR_DEFECTO['tamaño_celda_m'],
+                              OPCIONES_POR_DEFECTO['fecha_inicio'], OPCIONES_POR_DEFECTO['fecha_fin'])
+        with self._candado:
+            trabajo = self._activos.get(clave)
+        return trabajo if trabajo is not None and trabajo.activo else None
+
+    def progreso(self, id_trabajo: str) -> dict:
+        trabajo = self.obtener(id_trabajo)
+        return trabajo.progreso() if trabajo else None
+
+    def seguir(self, id_trabajo: str, intervalo: float = 5.0):
+        """
+        Generador de progreso del trabajo cada `intervalo` segundos hasta que termina.
+        Reportado el estado final, el trabajo se descarta de la cola.
+        """
+        trabajo = self.obtener(id_trabajo)
+        if trabajo is None:
+            return
+        try:
+            while not trabajo.futuro.done():
+                yield trabajo.progreso()
+                wait([trabajo.futuro], timeout=intervalo)
+            # El callback de fin corre en otro hilo: esperar a que registre el estado final
+            while trabajo.activo:
+                time.sleep(0.05)
+            yield trabajo.progreso()
+        finally:
+            self._descartar(trabajo)
+
+    def listar(self) -> list:
+        return [trabajo.progreso() for trabajo in list(self._trabajos.values())]
+
+
+cola_ingestas = ColaIngestas()